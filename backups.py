@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+##    This file is part of Gertrude.
+##
+##    Gertrude is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation; either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    Gertrude is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
+
+import os, time, zlib, hashlib
+try:
+    import sqlite3
+except:
+    from pysqlite2 import dbapi2 as sqlite3
+
+# sauvegardes conservees : les plus recentes de chaque heure, jour et mois (option "backups-retention")
+RETENTION = (24, 30, 12)
+
+HASH_SIZE = 20
+
+class BackupStore(object):
+    # sauvegardes compressees d'une base, dedupliquees par page : une page identique a celle
+    # d'une sauvegarde precedente n'est stockee qu'une fois, une sauvegarde est la liste
+    # des empreintes de ses pages
+    def __init__(self, filename):
+        self.filename = filename
+        self.con = None
+
+    def open(self):
+        if self.con is None:
+            self.con = sqlite3.connect(self.filename)
+            self.con.execute("CREATE TABLE IF NOT EXISTS PAGES (hash BLOB PRIMARY KEY, data BLOB)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS SAUVEGARDES (idx INTEGER PRIMARY KEY, date FLOAT, page_size INTEGER, pages BLOB)")
+        return self.con
+
+    def close(self):
+        if self.con:
+            self.con.commit()
+            self.con.close()
+            self.con = None
+
+    def Backup(self, database):
+        # le module sqlite3 de python 2 n'a pas l'API de sauvegarde : le fichier est lu pendant
+        # que les autres connexions ne peuvent pas ecrire (BEGIN IMMEDIATE). En mode WAL, le
+        # journal doit d'abord etre entierement reporte dans la base ; si un autre poste lit
+        # encore une version anterieure, le contenu est recopie dans une base temporaire
+        con = self.open()
+        known = set(str(hash) for hash, in con.execute("SELECT hash FROM PAGES"))
+        hashes = []
+        filename = database
+        verrou = sqlite3.connect(database, timeout=30, isolation_level=None)
+        try:
+            verrou.execute("BEGIN IMMEDIATE")
+            if verrou.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal":
+                source = sqlite3.connect(database, timeout=30)
+                busy, log, checkpointed = source.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                source.close()
+                if busy or log != checkpointed:
+                    filename = database + ".copie"
+                    self.Copie(verrou, filename)
+            source = sqlite3.connect(filename)
+            page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            source.close()
+            f = file(filename, "rb")
+            for page in iter(lambda: f.read(page_size), ""):
+                hash = hashlib.sha1(page).digest()
+                if hash not in known:
+                    con.execute("INSERT INTO PAGES (hash, data) VALUES (?, ?)", (buffer(hash), buffer(zlib.compress(page))))
+                    known.add(hash)
+                hashes.append(hash)
+            f.close()
+        finally:
+            verrou.close()
+            if filename != database and os.path.exists(filename):
+                os.remove(filename)
+        result = con.execute("INSERT INTO SAUVEGARDES (idx, date, page_size, pages) VALUES (NULL, ?, ?, ?)", (time.time(), page_size, buffer(zlib.compress("".join(hashes)))))
+        con.commit()
+        return result.lastrowid
+
+    def Copie(self, source, filename):
+        # copie complete du contenu vu par la transaction de source
+        if os.path.exists(filename):
+            os.remove(filename)
+        destination = sqlite3.connect(filename)
+        destination.executescript("\n".join(source.iterdump()))
+        destination.close()
+
+    def Liste(self):
+        # [(idx, date)], de la plus recente a la plus ancienne
+        return self.open().execute("SELECT idx, date FROM SAUVEGARDES ORDER BY date DESC, idx DESC").fetchall()
+
+    def Restore(self, idx, database):
+        con = self.open()
+        entry = con.execute("SELECT pages FROM SAUVEGARDES WHERE idx=?", (idx,)).fetchone()
+        if entry is None:
+            return False
+        hashes = zlib.decompress(str(entry[0]))
+        tmp = database + ".restore"
+        f = file(tmp, "wb")
+        for i in range(0, len(hashes), HASH_SIZE):
+            data, = con.execute("SELECT data FROM PAGES WHERE hash=?", (buffer(hashes[i:i+HASH_SIZE]),)).fetchone()
+            f.write(zlib.decompress(str(data)))
+        f.close()
+        # un journal (ou WAL) restant serait rejoue sur la base restauree
+        for filename in (database, database + "-journal", database + "-wal", database + "-shm"):
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.rename(tmp, database)
+        return True
+
+    def Purge(self, retention=None, keep=[]):
+        if retention is None:
+            retention = RETENTION
+        sauvegardes = self.Liste()
+        kept = set(keep + [idx for idx, date in sauvegardes[:1]])
+        for count, period in zip(retention, ("%Y%m%d%H", "%Y%m%d", "%Y%m")):
+            periods = set()
+            for idx, date in sauvegardes:
+                key = time.strftime(period, time.localtime(date))
+                if key not in periods:
+                    if len(periods) >= count:
+                        break
+                    periods.add(key)
+                    kept.add(idx)
+        removed = [(idx,) for idx, date in sauvegardes if idx not in kept]
+        if removed:
+            con = self.open()
+            con.executemany("DELETE FROM SAUVEGARDES WHERE idx=?", removed)
+            used = set()
+            for pages, in con.execute("SELECT pages FROM SAUVEGARDES"):
+                hashes = zlib.decompress(str(pages))
+                used.update(hashes[i:i+HASH_SIZE] for i in range(0, len(hashes), HASH_SIZE))
+            unused = [(hash,) for hash, in con.execute("SELECT hash FROM PAGES") if str(hash) not in used]
+            con.executemany("DELETE FROM PAGES WHERE hash=?", unused)
+            con.commit()
+        return len(removed)
@@ -19,8 +19,9 @@ import __builtin__
 import sys, os.path, shutil, time
 import urllib2
 import ConfigParser
+import sqlinterface, backups
 from functions import *
-from data import FileConnection, SharedFileConnection, HttpConnection
+from data import FileConnection, SharedFileConnection, LiveFileConnection, HttpConnection
 
 CONFIG_FILENAME = "gertrude.ini"
 DEFAULT_SECTION = "gertrude"
@@ -68,6 +69,10 @@ def getOptions(parser):
             options |= TABLETTE
         if "decloture" in str:
             options |= DECLOTURE
+        if "ecriture-immediate" in str:
+            options |= ECRITURE_IMMEDIATE
+        if "chargement-complet" in str:
+            options |= CHARGEMENT_COMPLET
     except:
         pass
     return options
@@ -117,6 +122,15 @@ def getBackupsDirectory(parser):
     except:
         return ""
 
+def getBackupsRetention(parser):
+    # nombre de sauvegardes conservees par heure, par jour et par mois
+    try:
+        retention = tuple(int(count) for count in parser.get(DEFAULT_SECTION, "backups-retention").split(","))
+        assert len(retention) == 3
+        return retention
+    except:
+        return backups.RETENTION
+
 def getDefaultSection(parser):
     try:
         return parser.get(DEFAULT_SECTION, "default-database")
@@ -177,7 +191,15 @@ def getDatabase(parser, section):
             identity = parser.get(section, "identity")
         except:
             identity = datetime.time()
-        database.connection = SharedFileConnection(url[7:], filename, identity)
+        try:
+            # partage = wal (ou delete) : base ouverte en direct par tous les postes
+            journal_mode = parser.get(section, "partage").upper()
+        except:
+            journal_mode = None
+        if journal_mode in ("WAL", "DELETE"):
+            database.connection = LiveFileConnection(url[7:], filename, identity, journal_mode)
+        else:
+            database.connection = SharedFileConnection(url[7:], filename, identity)
         
     return database
     
@@ -199,12 +221,15 @@ def LoadConfig(progress_handler=default_progress_handler):
     config.column_width = getColumnWidth(parser)
     
     config.options = getOptions(parser)
+    sqlinterface.ECRITURE_DIFFEREE = not (config.options & ECRITURE_IMMEDIATE)
+    sqlinterface.CHARGEMENT_PARTIEL = not (config.options & CHARGEMENT_COMPLET)
 
     config.original_documents_directory = getDocumentsDirectory(parser)
     config.documents_directory = config.original_documents_directory
     
     config.original_backups_directory = getBackupsDirectory(parser)
     config.backups_directory = config.original_backups_directory
+    backups.RETENTION = getBackupsRetention(parser)
     
     config.original_default_section = getDefaultSection(parser)
     config.default_section = config.original_default_section
@@ -180,6 +180,8 @@ HEURES_CONTRAT = 1 << 1
 TABLETTE = 1 << 2
 CATEGORIES = 1 << 3
 DECLOTURE = 1 << 4
+ECRITURE_IMMEDIATE = 1 << 5
+CHARGEMENT_COMPLET = 1 << 6
 
 # Atributs de plages horaires spéciales
 PLAGE_FERMETURE = 0
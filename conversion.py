@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+##    This file is part of Gertrude.
+##
+##    Gertrude is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation; either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    Gertrude is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
+
+import sys, os, time, shutil, tempfile, hashlib, subprocess, atexit, urllib
+from distutils.spawn import find_executable
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+except:
+    uno = None
+
+# nombre de documents envoyes au convertisseur en une fois
+TAILLE_LOT = 20
+
+SOFFICE = ["soffice", "libreoffice", "ooffice",
+           "/Applications/LibreOffice.app/Contents/MacOS/soffice",
+           "/Applications/OpenOffice.app/Contents/MacOS/soffice"]
+
+def GetSoffice():
+    for name in SOFFICE:
+        path = find_executable(name)
+        if path:
+            return path
+    return None
+
+def GetOptionProfil(profil):
+    # profil LibreOffice prive : avec celui de l'utilisateur, soffice confie le travail a une
+    # instance deja ouverte (pour lire les documents generes) et se termine aussitot
+    return "-env:UserInstallation=file://%s" % urllib.pathname2url(profil)
+
+def GetFiltre(filename):
+    if filename.endswith("ods"):
+        return "calc_pdf_Export"
+    else:
+        return "writer_pdf_Export"
+
+class ConvertisseurCOM(object):
+    # OpenOffice pilote par COM (Windows) : le contexte est obtenu une fois par lot
+    def Convertit(self, documents):
+        from ooffice import getOOoContext, MakePropertyValues
+        echecs = {}
+        StarDesktop, objServiceManager, corereflection = getOOoContext()
+        for filename, pdffilename in documents:
+            try:
+                url = ''.join(["file:", urllib.pathname2url(unicode(os.path.abspath(filename)).encode("utf8"))])
+                pdfurl = ''.join(["file:", urllib.pathname2url(unicode(os.path.abspath(pdffilename)).encode("utf8"))])
+                document = StarDesktop.LoadComponentFromURL(url, "_blank", 0,
+                    MakePropertyValues(objServiceManager,
+                                [["ReadOnly", True],
+                                ["Hidden", True]]))
+                document.storeToUrl(pdfurl,
+                    MakePropertyValues(objServiceManager,
+                                [["CompressMode", 1],
+                                ["FilterName", GetFiltre(filename)]]))
+                document.close(False)
+            except Exception, e:
+                echecs[filename] = e
+        return echecs
+
+    def Arrete(self):
+        pass
+
+class ConvertisseurUno(object):
+    # un processus LibreOffice invisible, lance au premier lot et garde pour les suivants,
+    # pilote par UNO a travers un tube nomme local
+    def __init__(self, soffice):
+        self.soffice = soffice
+        self.tube = "gertrude%d" % os.getpid()
+        self.profil = None
+        self.process = None
+        self.desktop = None
+
+    def Demarre(self):
+        if self.profil is None:
+            self.profil = tempfile.mkdtemp(prefix="gertrude-soffice-")
+        self.process = subprocess.Popen([self.soffice, GetOptionProfil(self.profil), "--headless", "--invisible", "--norestore", "--nologo",
+                                         "--accept=pipe,name=%s;urp;StarOffice.ComponentContext" % self.tube])
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        for i in range(100):
+            try:
+                context = resolver.resolve("uno:pipe,name=%s;urp;StarOffice.ComponentContext" % self.tube)
+                break
+            except NoConnectException:
+                if self.process.poll() is not None:
+                    raise
+                time.sleep(0.2)
+        else:
+            self.Arrete()
+            raise Exception(u"LibreOffice ne répond pas")
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+    def Convertit(self, documents):
+        if self.process is None or self.process.poll() is not None:
+            self.Demarre()
+        echecs = {}
+        for filename, pdffilename in documents:
+            try:
+                document = self.desktop.loadComponentFromURL(uno.systemPathToFileUrl(os.path.abspath(filename)), "_blank", 0,
+                                                             (Propriete("ReadOnly", True), Propriete("Hidden", True)))
+                try:
+                    document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(pdffilename)),
+                                        (Propriete("CompressMode", 1), Propriete("FilterName", GetFiltre(filename))))
+                finally:
+                    document.close(True)
+            except Exception, e:
+                echecs[filename] = e
+        return echecs
+
+    def Arrete(self):
+        if self.desktop:
+            try:
+                self.desktop.terminate()
+            except:
+                pass
+            self.desktop = None
+        if self.process:
+            if self.process.poll() is None:
+                time.sleep(1)
+                if self.process.poll() is None:
+                    self.process.kill()
+            self.process = None
+        if self.profil:
+            shutil.rmtree(self.profil, ignore_errors=True)
+            self.profil = None
+
+def Propriete(name, value):
+    propriete = PropertyValue()
+    propriete.Name = name
+    propriete.Value = value
+    return propriete
+
+class ConvertisseurLigneCommande(object):
+    # sans le module uno : un appel a soffice --convert-to par lot et par repertoire
+    def __init__(self, soffice):
+        self.soffice = soffice
+        self.profil = None
+
+    def Convertit(self, documents):
+        # le profil est garde d'un lot a l'autre : sa creation ralentit le premier lancement
+        if self.profil is None:
+            self.profil = tempfile.mkdtemp(prefix="gertrude-soffice-")
+        echecs = {}
+        repertoires = {}
+        for filename, pdffilename in documents:
+            repertoires.setdefault(os.path.dirname(os.path.abspath(filename)), []).append((filename, pdffilename))
+        for repertoire, lot in repertoires.items():
+            # soffice ecrit ses PDF dans un repertoire temporaire, deplaces ensuite sous leur nom
+            destination = tempfile.mkdtemp()
+            try:
+                subprocess.call([self.soffice, GetOptionProfil(self.profil), "--headless", "--invisible", "--norestore", "--nologo",
+                                 "--convert-to", "pdf", "--outdir", destination] + [filename for filename, pdffilename in lot])
+                for filename, pdffilename in lot:
+                    resultat = os.path.join(destination, os.path.splitext(os.path.basename(filename))[0] + ".pdf")
+                    if os.path.isfile(resultat):
+                        shutil.move(resultat, pdffilename)
+                    else:
+                        echecs[filename] = Exception(u"Conversion en PDF impossible")
+            finally:
+                shutil.rmtree(destination, ignore_errors=True)
+        return echecs
+
+    def Arrete(self):
+        if self.profil:
+            shutil.rmtree(self.profil, ignore_errors=True)
+            self.profil = None
+
+class ConvertisseurTest(object):
+    # convertisseur deterministe pour les tests : le PDF contient l'empreinte du document
+    def __init__(self):
+        self.lots = []
+
+    def Convertit(self, documents):
+        self.lots.append([filename for filename, pdffilename in documents])
+        for filename, pdffilename in documents:
+            data = file(filename, "rb").read()
+            file(pdffilename, "wb").write("%%PDF-1.4\n%% %s %s\n%%%%EOF\n" % (os.path.basename(filename), hashlib.md5(data).hexdigest()))
+        return {}
+
+    def Arrete(self):
+        pass
+
+convertisseur = None
+
+def GetConvertisseur():
+    global convertisseur
+    if convertisseur is None:
+        if sys.platform == 'win32':
+            convertisseur = ConvertisseurCOM()
+        else:
+            soffice = GetSoffice()
+            if soffice and uno:
+                convertisseur = ConvertisseurUno(soffice)
+            elif soffice:
+                convertisseur = ConvertisseurLigneCommande(soffice)
+    return convertisseur
+
+def ConvertitPDF(documents):
+    # documents : [(filename, pdffilename)], convertis par lots de TAILLE_LOT
+    # renvoie les echecs {filename: exception}
+    convertisseur = GetConvertisseur()
+    if convertisseur is None:
+        return dict((filename, Exception(u"Aucun convertisseur PDF disponible")) for filename, pdffilename in documents)
+    echecs = {}
+    for i in range(0, len(documents), TAILLE_LOT):
+        echecs.update(convertisseur.Convertit(documents[i:i+TAILLE_LOT]))
+    return echecs
+
+def Arrete():
+    if convertisseur:
+        convertisseur.Arrete()
+
+atexit.register(Arrete)
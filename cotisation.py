@@ -75,18 +75,44 @@ class Cotisation(object):
             result = self.montant_heure_garde * heures
             tarifs = [self.montant_heure_garde]
         else:
+            seuils = creche.GetSeuilsTauxHoraire(self.mode_garde, self.inscrit.handicap, self.assiette_annuelle, self.enfants_a_charge, self.jours_semaine, self.heures_semaine, self.inscription.reservataire, self.inscrit.nom.lower(), self.parents, self.chomage, self.conge_parental, self.heures_mois)
+            if seuils is None:
+                return self.CalculeFraisGardeHeureParHeure(heures, heures_mois)
             result = 0.0
             tarifs = set()
-            heure = 0.0
             if heures_mois == 0:
                 multiplier = 1
             else:
                 multiplier = heures/heures_mois
-            while heure < heures_mois:
-                montant_heure_garde = creche.EvalTauxHoraire(self.mode_garde, self.inscrit.handicap, self.assiette_annuelle, self.enfants_a_charge, self.jours_semaine, self.heures_semaine, self.inscription.reservataire, self.inscrit.nom.lower(), self.parents, self.chomage, self.conge_parental, self.heures_mois, heure)
-                result += multiplier * montant_heure_garde * min(1.0, heures_mois-heure)
+            # le tarif est evalue aux heures entieres 0, 1, 2 ... et ne peut changer qu'autour des seuils de la formule
+            fin = max(0, int(math.ceil(heures_mois)))
+            bornes = set([0])
+            for seuil in seuils:
+                for borne in (math.floor(seuil), math.floor(seuil)+1, math.ceil(seuil), math.ceil(seuil)+1):
+                    if 0 < borne < fin:
+                        bornes.add(int(borne))
+            bornes = sorted(bornes) + [fin]
+            if fin == 0:
+                bornes = []
+            for debut, fin_tranche in zip(bornes[:-1], bornes[1:]):
+                montant_heure_garde = creche.EvalTauxHoraire(self.mode_garde, self.inscrit.handicap, self.assiette_annuelle, self.enfants_a_charge, self.jours_semaine, self.heures_semaine, self.inscription.reservataire, self.inscrit.nom.lower(), self.parents, self.chomage, self.conge_parental, self.heures_mois, float(debut))
+                result += multiplier * montant_heure_garde * (min(fin_tranche, heures_mois) - debut)
                 tarifs.add(montant_heure_garde)
-                heure += 1.0
+        return result, tarifs
+
+    def CalculeFraisGardeHeureParHeure(self, heures, heures_mois):
+        result = 0.0
+        tarifs = set()
+        heure = 0.0
+        if heures_mois == 0:
+            multiplier = 1
+        else:
+            multiplier = heures/heures_mois
+        while heure < heures_mois:
+            montant_heure_garde = creche.EvalTauxHoraire(self.mode_garde, self.inscrit.handicap, self.assiette_annuelle, self.enfants_a_charge, self.jours_semaine, self.heures_semaine, self.inscription.reservataire, self.inscrit.nom.lower(), self.parents, self.chomage, self.conge_parental, self.heures_mois, heure)
+            result += multiplier * montant_heure_garde * min(1.0, heures_mois-heure)
+            tarifs.add(montant_heure_garde)
+            heure += 1.0
         return result, tarifs
 
     def __init__(self, inscrit, date, options=0):
@@ -16,14 +16,34 @@
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
 import __builtin__
-import os.path, shutil, time
-import urllib2, mimetypes, uuid
+import os.path, shutil, time, datetime, glob
+import httplib, urlparse, socket, base64, mimetypes, uuid
 import ConfigParser
+import zlib, json, gzip, hashlib
 from sqlinterface import SQLConnection
+from backups import BackupStore
 from functions import *
 
 BACKUPS_DIRECTORY = './backups'
 TOKEN_FILENAME = '.token'
+TRANSFER_CHUNK_SIZE = 256 * 1024
+TRANSFER_RETRIES = 3
+
+def EncodeChangeset(version, changes):
+    # les dates sont envoyees comme sqlite3 les stocke (isoformat)
+    def encode(value):
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return str(value)
+        elif isinstance(value, bool):
+            return int(value)
+        else:
+            return value
+    changes = [(cmd, [encode(value) for value in args]) for cmd, args in changes]
+    return zlib.compress(json.dumps({"version": version, "changes": changes}))
+
+def DecodeChangeset(data):
+    changeset = json.loads(zlib.decompress(data))
+    return int(changeset["version"]), changeset["changes"]
 
 class HttpConnection(object):
     def __init__(self, url, filename, identity, auth_info=None, proxy_info=None):
@@ -32,11 +52,18 @@ class HttpConnection(object):
         self.identity = identity
         self.auth_info = auth_info
         self.proxy_info = proxy_info
+        self.session = None
         if os.path.isfile(TOKEN_FILENAME):
             self.token = file(TOKEN_FILENAME).read()
             self.check_token()
         else:
             self.token = 0
+        # version du serveur a laquelle correspond la base locale (0 si inconnue)
+        self.version_filename = filename + '.version'
+        try:
+            self.version = int(file(self.version_filename).read())
+        except:
+            self.version = 0
         self.progress_handler = default_progress_handler
 
     def get_content_type(self, filename):
@@ -71,44 +98,67 @@ class HttpConnection(object):
         content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
         return content_type, body
 
-    def urlopen(self, action, body=None, headers=None):
-        opener = urllib2.build_opener()
-        if self.auth_info:
-            password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, self.url, self.auth_info[0], self.auth_info[1])
-            opener.add_handler(urllib2.HTTPBasicAuthHandler(password_mgr))
-        if self.proxy_info:
-            if 'user' in self.proxy_info:
-                opener.add_handler(urllib2.ProxyHandler({"http" : "http://%(user)s:%(pass)s@%(host)s:%(port)d" % self.proxy_info}))
+    def get_session(self):
+        # une seule connexion persistante (keep-alive) par objet, les en-tetes
+        # d'authentification et le proxy sont configures une fois pour toutes
+        if self.session is None:
+            scheme, netloc, path = urlparse.urlsplit(self.url)[:3]
+            self.session_path = path or '/'
+            self.session_headers = {"Connection": "keep-alive"}
+            if self.auth_info:
+                self.session_headers["Authorization"] = "Basic " + base64.b64encode("%s:%s" % tuple(self.auth_info))
+            if self.proxy_info and scheme == "http":
+                self.session = httplib.HTTPConnection(self.proxy_info['host'], self.proxy_info['port'])
+                self.session_path = self.url
+                if 'user' in self.proxy_info:
+                    self.session_headers["Proxy-Authorization"] = "Basic " + base64.b64encode("%(user)s:%(pass)s" % self.proxy_info)
+            elif scheme == "https":
+                self.session = httplib.HTTPSConnection(netloc)
             else:
-                opener.add_handler(urllib2.ProxyHandler({"http" : "http://%(host)s:%(port)d" % self.proxy_info}))
-        urllib2.install_opener(opener)
+                self.session = httplib.HTTPConnection(netloc)
+        return self.session
 
-        try:
-            url = '%s?action=%s&identity=%s' % (self.url, action, self.identity)
-            print url
-            if self.token:
-                url += "&token=%s" % self.token
-            # print url
-            if body:
-                req = urllib2.Request(url, body, headers)
-            else:
-                req = urllib2.Request(url)
-            result = urllib2.urlopen(req).read()
-            print '=>', result[:64]
-            if len(result) == 1:
-                return eval(result)
-            else:
-                return result
-        except urllib2.HTTPError, e:
-            if e.code == 404:
-                raise Exception(u"Echec - code 404 (page non trouvée)")
-            else:
-                raise Exception(u"Echec - code %d (%s)" % (e.code, e.msg))
-        except urllib2.URLError, e:
-            raise Exception("Echec - cause:", e.reason)
-        except Exception, e:
-            raise
+    def close(self):
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    def urlopen(self, action, body=None, headers=None, params={}, raw=False):
+        session = self.get_session()
+        url = '%s?action=%s&identity=%s' % (self.session_path, action, self.identity)
+        print url
+        if self.token:
+            url += "&token=%s" % self.token
+        if self.version:
+            url += "&version=%d" % self.version
+        for key in params:
+            url += "&%s=%s" % (key, params[key])
+        headers = dict(self.session_headers, **(headers or {}))
+        for retry in (True, False):
+            try:
+                session.request(body and "POST" or "GET", url, body, headers)
+                response = session.getresponse()
+                result = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                # connexion fermee par le serveur entre deux actions => on en ouvre une nouvelle
+                self.close()
+                if not retry:
+                    raise Exception("Echec - cause:", e)
+                session = self.get_session()
+        print '=>', result[:64]
+        if response.status in (301, 302, 303, 307) and response.getheader("Location"):
+            self.close()
+            self.url = response.getheader("Location").split('?')[0]
+            return self.urlopen(action, body, headers, params, raw)
+        elif response.status == 404:
+            raise Exception(u"Echec - code 404 (page non trouvée)")
+        elif response.status >= 400:
+            raise Exception(u"Echec - code %d (%s)" % (response.status, response.reason))
+        if len(result) == 1 and not raw:
+            return eval(result)
+        else:
+            return result
 
     def has_token(self):
         self.progress_handler.display(u"Vérification du jeton ...")
@@ -150,13 +200,111 @@ class HttpConnection(object):
                 os.remove(TOKEN_FILENAME)
             return 1
 
-    def do_download(self):
+    def set_version(self, version):
+        self.version = version
+        if version:
+            file(self.version_filename, 'w').write(str(version))
+        elif os.path.exists(self.version_filename):
+            os.remove(self.version_filename)
+
+    def do_download_delta(self, data=None):
+        self.progress_handler.display(u"Récupération des modifications depuis la version %d ..." % self.version)
+        try:
+            if data is None:
+                data = self.urlopen('download_delta')
+            if not data:
+                return 0
+            version, changes = DecodeChangeset(data)
+            if changes:
+                SQLConnection(self.filename).ApplyChangeset(changes)
+        except Exception, e:
+            print e
+            return 0
+        self.set_version(version)
+        self.progress_handler.display(u'%d modifications appliquées (%d octets transférés).' % (len(changes), len(data)))
+        return 1
+
+    def set_transfer_progress(self, done, size):
+        if size:
+            self.progress_handler.set(30 + 60 * done / size)
+
+    def do_download_gzip(self):
+        # la base compressee par le serveur est telechargee par morceaux,
+        # un telechargement interrompu reprend la ou il s'etait arrete ;
+        # renvoie (taille, version du serveur), version 0 si le serveur ne la donne pas
+        info = self.urlopen('download_info', raw=True)
+        if not info or info == "0":
+            return None
+        info = info.split()
+        size, md5 = int(info[0]), info[1]
+        if len(info) > 2:
+            version = int(info[2])
+        else:
+            version = 0
+        part = "%s.%s.part" % (self.filename, md5)
+        for filename in glob.glob("%s.*.part" % self.filename):
+            if filename != part:
+                os.remove(filename)
+        f = file(part, 'ab')
+        offset, errors = f.tell(), 0
+        while offset < size:
+            try:
+                chunk = self.urlopen('download_chunk', params={'offset': offset, 'size': TRANSFER_CHUNK_SIZE}, raw=True)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                errors = 0
+            except Exception, e:
+                errors += 1
+                if errors > TRANSFER_RETRIES:
+                    f.close()
+                    raise
+                print e
+                time.sleep(errors)
+            self.set_transfer_progress(offset, size)
+        f.close()
+        if HashFile(part) != md5:
+            self.progress_handler.display(u"Somme de contrôle incorrecte.")
+            os.remove(part)
+            return None
+        source, destination = gzip.open(part, 'rb'), file(self.filename, 'wb')
+        shutil.copyfileobj(source, destination, TRANSFER_CHUNK_SIZE)
+        source.close()
+        destination.close()
+        os.remove(part)
+        return size, version
+
+    def do_download(self, server_version=0, delta=True):
+        # la version de la base vient du serveur avec les donnees elles-memes ; server_version
+        # (obtenue avec le jeton) ne sert que pour les serveurs qui ne la renvoient pas
+        if delta and self.version and os.path.isfile(self.filename) and self.do_download_delta():
+            return 1
         self.progress_handler.display(u"Téléchargement de la base ...")
-        data = self.urlopen('download')
+        try:
+            result = self.do_download_gzip()
+        except Exception, e:
+            print e
+            result = None
+        if result:
+            size, version = result
+            self.set_version(version or server_version)
+            self.progress_handler.display(u'%d octets transférés.' % size)
+            return 1
+        data = self.urlopen('download_version', raw=True)
+        if data == "0":
+            data = None
+        elif data:
+            version, data = data.split("\n", 1)
+            server_version = int(version)
+        else:
+            # ancien serveur
+            data = self.urlopen('download')
         if data:
             f = file(self.filename, 'wb')
             f.write(data)
             f.close()
+            self.set_version(server_version)
             self.progress_handler.display(u'%d octets transférés.' % len(data))
         else:
             self.progress_handler.display(u'Pas de base présente sur le serveur.')
@@ -164,10 +312,45 @@ class HttpConnection(object):
                 self.progress_handler.display("Utilisation de la base locale ...")
         return 1
 
+    def get_token_download(self):
+        # prise du jeton, version du serveur et modifications depuis la version locale
+        # en un seul aller-retour ; None si le serveur ne connait pas cette action
+        self.progress_handler.display(u"Récupération du jeton ...")
+        result = self.urlopen('token_download', params={'force': int(bool(force_token))}, raw=True)
+        if result == "":
+            return None
+        elif result == "0":
+            return 0
+        header, data = result.split("\n", 1)
+        self.token, server_version = header.split()
+        self.check_token()
+        if not self.token:
+            return 0
+        file(TOKEN_FILENAME, 'w').write(self.token)
+        self.progress_handler.set(30)
+        if not (self.version and os.path.isfile(self.filename) and self.do_download_delta(data)):
+            if not self.do_download(int(server_version), delta=False):
+                return 0
+        self.progress_handler.set(90)
+        return 1
+
     def download(self):       
         if self.has_token():
             self.progress_handler.display(u"Jeton déjà pris => pas de download")
             return 1
+        try:
+            result = self.get_token_download()
+        except Exception, e:
+            print e
+            result = None
+        if result is not None:
+            if not result:
+                if self.token:
+                    self.rel_token()
+                    self.progress_handler.display(u"Le download a échoué")
+                else:
+                    self.progress_handler.display("Impossible de prendre le jeton.")
+            return result
         elif self.get_token():
             self.progress_handler.set(30)
             if self.do_download():
@@ -182,18 +365,105 @@ class HttpConnection(object):
             self.progress_handler.display("Impossible de prendre le jeton.")
             return 0
        
+    def do_upload_gzip(self):
+        # la base est compressee sur disque puis envoyee par morceaux ; le serveur renvoie
+        # a chaque morceau la taille deja recue, d'ou la reprise apres une erreur
+        gz = self.filename + '.upload.gz'
+        source, destination = file(self.filename, 'rb'), gzip.open(gz, 'wb', 6)
+        shutil.copyfileobj(source, destination, TRANSFER_CHUNK_SIZE)
+        source.close()
+        destination.close()
+        size, md5 = os.path.getsize(gz), HashFile(gz)
+        try:
+            offset = self.urlopen('upload_status', params={'md5': md5}, raw=True)
+            if offset == "":
+                return None
+            offset, errors = int(offset), 0
+            f = file(gz, 'rb')
+            headers = {"Content-Type": "application/octet-stream"}
+            while offset < size:
+                f.seek(offset)
+                chunk = f.read(TRANSFER_CHUNK_SIZE)
+                try:
+                    received = int(self.urlopen('upload_chunk', chunk, headers, {'md5': md5, 'offset': offset}, raw=True))
+                except Exception, e:
+                    errors += 1
+                    if errors > TRANSFER_RETRIES:
+                        f.close()
+                        raise
+                    print e
+                    time.sleep(errors)
+                    continue
+                if received <= offset:
+                    # jeton perdu (pris de force par un autre poste) ou morceau refuse : renvoyer
+                    # le meme morceau ne servirait a rien
+                    f.close()
+                    self.progress_handler.display(u"Envoi interrompu par le serveur.")
+                    return 0
+                offset, errors = received, 0
+                self.set_transfer_progress(offset, size)
+            f.close()
+            result = self.urlopen('upload_commit', params={'md5': md5})
+        finally:
+            os.remove(gz)
+        if not result:
+            self.progress_handler.display(u"Envoi refusé par le serveur.")
+            return None
+        self.progress_handler.display(u'%d octets transférés.' % size)
+        return result
+
     def do_upload(self):
         self.progress_handler.display("Envoi vers le serveur ...")
-        content_type, body = self.encode_multipart_formdata([], [("database", self.filename)])
-        headers = {"Content-Type": content_type, 'Content-Length': str(len(body))}
-        return self.urlopen('upload', body, headers)
+        result = self.do_upload_gzip()
+        if result is None:
+            content_type, body = self.encode_multipart_formdata([], [("database", self.filename)])
+            headers = {"Content-Type": content_type, 'Content-Length': str(len(body))}
+            result = self.urlopen('upload', body, headers)
+        if result:
+            # le serveur renvoie sa nouvelle version (1 pour les anciens serveurs)
+            try:
+                self.set_version(int(result))
+            except ValueError:
+                self.set_version(0)
+            if sql_connection and sql_connection.journal is not None:
+                del sql_connection.journal[:]
+                sql_connection.converti = False
+        return result
+
+    def do_upload_delta(self):
+        self.progress_handler.display(u"Envoi des modifications vers le serveur ...")
+        body = EncodeChangeset(self.version, sql_connection.journal)
+        headers = {"Content-Type": "application/octet-stream", 'Content-Length': str(len(body))}
+        try:
+            version = int(self.urlopen('upload_delta', body, headers) or 0)
+        except Exception, e:
+            print e
+            return 0
+        if version:
+            self.progress_handler.display(u'%d modifications envoyées (%d octets).' % (len(sql_connection.journal), len(body)))
+            del sql_connection.journal[:]
+            self.set_version(version)
+        return version
 
     def upload(self):
         if not self.has_token():
             self.progress_handler.display(u"Pas de jeton présent => pas d'envoi vers le serveur.")
             return 0
+        if self.version and sql_connection and sql_connection.journal is not None and not sql_connection.converti:
+            if not sql_connection.journal:
+                self.progress_handler.display(u"Pas de modification à envoyer.")
+                return 1
+            elif self.do_upload_delta():
+                return 1
+            self.progress_handler.display(u"Modifications refusées par le serveur, envoi de la base complète ...")
         return self.do_upload()
 
+    def save(self):
+        # la base locale ne correspond plus a la version du serveur tant que les modifications ne sont pas envoyees
+        if sql_connection and (sql_connection.journal or sql_connection.converti) and os.path.exists(self.version_filename):
+            os.remove(self.version_filename)
+        return FileConnection(self.filename).Save()
+
     def Liste(self, progress_handler=default_progress_handler):
         self.progress_handler = progress_handler
         if self.do_download():
@@ -209,25 +479,44 @@ class HttpConnection(object):
             result = FileConnection(self.filename).Load(progress_handler)[0], 1
         else:
             result = None, 0
+        if result[0] is not None:
+            sql_connection.journal = []
         return result
     
-    def LoadJournal(self):
-        return self.urlopen('journal')
+    def LoadJournal(self, offset=None):
+        # sans offset, le journal complet de la tablette ; sinon (debut, lignes) : les lignes
+        # completes ecrites a partir de offset (debut 0 si le journal a ete remis a zero)
+        if offset is None:
+            return self.urlopen('journal')
+        result = self.urlopen('journal_chunk', params={'offset': offset, 'size': TRANSFER_CHUNK_SIZE})
+        if result:
+            start, data = result.split("\n", 1)
+            return int(start), data
+        # ancien serveur : journal complet, decoupe ici
+        journal = self.urlopen('journal')
+        if offset > len(journal):
+            offset = 0
+        data = journal[offset:]
+        return offset, data[:data.rfind("\n")+1]
 
     def Update(self):
         return None, None
     
     def Save(self, progress_handler=default_progress_handler):
         self.progress_handler = progress_handler
-        return FileConnection(self.filename).Save() and self.upload()
+        return self.save() and self.upload()
 
     def Restore(self, progress_handler=default_progress_handler):
         self.progress_handler = progress_handler
+        self.set_version(0)
         return FileConnection(self.filename).Restore()
     
     def Exit(self, progress_handler=default_progress_handler):
         self.progress_handler = progress_handler
-        return FileConnection(self.filename).Save() and self.rel_token()
+        try:
+            return self.save() and self.rel_token()
+        finally:
+            self.close()
 
 class SharedFileConnection(object):
     def __init__(self, url, filename, identity):
@@ -348,20 +637,27 @@ class SharedFileConnection(object):
         return FileConnection(self.filename).Save() and self.rel_token()
 
 class FileConnection(object):
-    def __init__(self, filename):
+    def __init__(self, filename, journal_mode=None):
         self.filename = filename
+        self.journal_mode = journal_mode
         self.backup = None
 
+    def GetBackupStore(self):
+        if not os.path.isdir(BACKUPS_DIRECTORY):
+            os.mkdir(BACKUPS_DIRECTORY)
+        return BackupStore(os.path.join(BACKUPS_DIRECTORY, os.path.basename(self.filename) + '.backups'))
+
     def Backup(self, progress_handler=default_progress_handler):
         progress_handler.display('Sauvegarde ...')
         try:
             if os.path.isfile(self.filename):
-                if not os.path.isdir(BACKUPS_DIRECTORY):
-                    os.mkdir(BACKUPS_DIRECTORY)
-                self.backup = 'backup_%s_%d.db' % (self.filename, time.time())
-                shutil.copyfile(self.filename, BACKUPS_DIRECTORY + '/' + self.backup)
+                store = self.GetBackupStore()
+                backup = store.Backup(self.filename)
+                store.Purge(keep=[self.backup, backup])
+                store.close()
+                self.backup = backup
         except Exception, e:
-            progress_handler.display('Impossible de faire la sauvegarde' + e)
+            progress_handler.display(u'Impossible de faire la sauvegarde (%s)' % e)
     
     def Liste(self, progress_handler=default_progress_handler):
         if not os.path.isfile(self.filename):
@@ -377,17 +673,27 @@ class FileConnection(object):
         try:
             if self.file_mtime < os.stat(self.filename).st_mtime:
                 self.file_mtime = os.stat(self.filename).st_mtime
-                _sql_connection = SQLConnection(self.filename)
-                _creche = _sql_connection.Load(None)
+                _sql_connection, _creche = self.LoadModifications()
         except Exception, e:
             print e
         return _sql_connection, _creche
+
+    def LoadModifications(self):
+        # seules les journees modifiees par un autre poste sont relues, sinon rechargement complet
+        modifications = sql_connection.LoadModifications(creche)
+        if modifications is None:
+            _sql_connection = SQLConnection(self.filename, self.journal_mode)
+            return _sql_connection, _sql_connection.Load(None)
+        elif modifications:
+            return sql_connection, creche
+        else:
+            return None, None
     
     def Load(self, progress_handler=default_progress_handler):
         if os.path.isfile(self.filename):
             self.file_mtime = os.stat(self.filename).st_mtime
             self.Backup(progress_handler)
-        __builtin__.sql_connection = SQLConnection(self.filename)
+        __builtin__.sql_connection = SQLConnection(self.filename, self.journal_mode)
         if not os.path.isfile(self.filename):
             try:
                 sql_connection.Create(progress_handler)
@@ -408,7 +714,9 @@ class FileConnection(object):
         backup = self.backup
         self.Backup(progress_handler)
         if backup:
-            shutil.copyfile(BACKUPS_DIRECTORY + '/' + backup, self.filename)
+            store = self.GetBackupStore()
+            store.Restore(backup, self.filename)
+            store.close()
         return True
 
     def Exit(self, progress_handler=default_progress_handler):
@@ -416,3 +724,38 @@ class FileConnection(object):
         sql_connection.close()
         return True        
 
+class LiveFileConnection(FileConnection):
+    # tous les postes ouvrent directement la base du partage (qui doit gerer les verrous),
+    # sans jeton ni copie : les ecritures sont validees par transactions courtes et
+    # chaque poste recharge les donnees quand un autre a modifie la base
+    def __init__(self, url, filename, identity, journal_mode="WAL"):
+        FileConnection.__init__(self, url, journal_mode)
+        self.data_version = None
+
+    def Load(self, progress_handler=default_progress_handler):
+        result = FileConnection.Load(self, progress_handler)
+        self.data_version = sql_connection.GetDataVersion()
+        return result
+
+    def Update(self):
+        _sql_connection, _creche = None, None
+        try:
+            sql_connection.commit()
+            data_version = sql_connection.GetDataVersion()
+            if data_version != self.data_version:
+                self.data_version = data_version
+                _sql_connection, _creche = self.LoadModifications()
+                if _sql_connection and _sql_connection is not sql_connection:
+                    sql_connection.close()
+                    self.data_version = None
+        except Exception, e:
+            print e
+        return _sql_connection, _creche
+
+    def Restore(self, progress_handler=default_progress_handler):
+        # les autres postes ont la base (et son journal WAL) ouverte : la remplacer perdrait
+        # ou corromprait leurs donnees. Les modifications de ce poste sont deja validees
+        sql_connection.commit()
+        sql_connection.close()
+        progress_handler.display(u"Base partagée : pas de retour à la version précédente.")
+        return False
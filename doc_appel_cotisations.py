@@ -22,6 +22,8 @@ from cotisation import CotisationException
 from ooffice import *
 
 class AppelCotisationsModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, date, options=0):
         self.multi = False
         self.template = 'Appel cotisations.ods'
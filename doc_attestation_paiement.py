@@ -23,6 +23,8 @@ from cotisation import CotisationException
 from ooffice import *
 
 class AttestationModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, who, debut, fin):
         self.template = 'Attestation paiement.odt'
         self.debut, self.fin = debut, fin
@@ -131,6 +133,7 @@ class AttestationModifications(object):
                 fields.append(('ne-e', u"né"))
             else:
                 fields.append(('ne-e', u"née"))
+            fields = Champs(fields)
             
             for template in templates:
                 section = template.cloneNode(1)
@@ -21,6 +21,8 @@ from facture import *
 from ooffice import *
 
 class EtatPresenceMensuelModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, site, date):
         self.multi = False
         self.template = "Etat presence mensuel.ods"
@@ -54,6 +56,7 @@ class EtatPresenceMensuelModifications(object):
         inscrits.sort(cmp=lambda x,y: cmp(GetPrenomNom(x), GetPrenomNom(y)))
         
         template = lignes.item(5)
+        flux = LignesEnFlux(self, template)
         for inscrit in inscrits:           
             cantine, garderie = 0, 0
             date = self.date
@@ -76,7 +79,7 @@ class EtatPresenceMensuelModifications(object):
                            ('garderie', garderie),
                           ])
             ReplaceFields(ligne, fields)
-            table.insertBefore(ligne, template)
+            flux.Ajoute(ligne)
 
         table.removeChild(template)
         
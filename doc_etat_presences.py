@@ -21,6 +21,8 @@ from facture import *
 from ooffice import *
 
 class EtatsPresenceModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, debut, fin, site, professeur, inscrit, selection):
         self.multi = False
         self.template = 'Etats presence.ods'
@@ -71,6 +73,7 @@ class EtatsPresenceModifications(object):
         
         # Les lignes
         template = lignes.item(8)
+        flux = LignesEnFlux(self, template)
         dates = self.selection.keys()
         dates.sort()
         for date in dates:
@@ -88,7 +91,7 @@ class EtatsPresenceModifications(object):
                                ('heures', GetHeureString(heures)),
                                ('commentaire', commentaire)])
                 ReplaceFields(ligne, fields)
-                table.insertBefore(ligne, template)
+                flux.Ajoute(ligne)
 
         table.removeChild(template)
         if self.gauge:
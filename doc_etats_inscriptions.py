@@ -21,6 +21,8 @@ from facture import *
 from ooffice import *
 
 class EtatsInscriptionsModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, site, date):
         self.multi = False
         self.template = 'Etats inscriptions.ods'
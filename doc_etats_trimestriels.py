@@ -71,6 +71,7 @@ class EtatsTrimestrielsModifications(object):
                 last_line = lines[template_total_lines_count]
                 for line in page_template:
                     table.removeChild(line)
+                flux = LignesEnFlux(self, last_line)
     
                 nb_pages = (len(indexes) / template_lines_count) + (len(indexes) % template_lines_count > 0)
                 for page in range(nb_pages):
@@ -78,7 +79,6 @@ class EtatsTrimestrielsModifications(object):
                     for l, line in enumerate(page_template):
                         clone = line.cloneNode(1)
                         lines.append(clone)
-                        table.insertBefore(clone, last_line)
                     
                     # Le titre de la page
                     ReplaceFields(lines[0], [('annee', self.annee),
@@ -131,6 +131,9 @@ class EtatsTrimestrielsModifications(object):
                                     fields.append(('%s(%d)' % (mode, i+1), ''))
     
                         ReplaceFields(line, fields)
+
+                    for line in lines:
+                        flux.Ajoute(line)
     
             # LA SYNTHESE ANNUELLE
             table = tables.item(0)
@@ -179,10 +182,10 @@ class EtatsTrimestrielsModifications(object):
         #print template.toprettyxml()
         total = [0] * 12
         total_previsionnel = [0] * 12
+        flux = LignesEnFlux(self, template)
         for i in range(len(indexes)):
             inscrit = creche.inscrits[indexes[i]]
             ligne = template.cloneNode(1)
-            table.insertBefore(ligne, template)
 
             heures = [0] * 12
             previsionnel = [0] * 12
@@ -224,6 +227,7 @@ class EtatsTrimestrielsModifications(object):
             else:
                 fields.append(('total_enfant', sum(heures)))
             ReplaceFields(ligne, fields)
+            flux.Ajoute(ligne)
         table.removeChild(template)
 
         # Les totaux des mois
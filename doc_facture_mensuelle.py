@@ -39,6 +39,8 @@ couleurs = { SUPPLEMENT: 'A2',
            }
 
 class FactureModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, inscrits, periode):
         self.multi = False
         self.inscrits = inscrits
@@ -109,13 +111,21 @@ class FactureModifications(object):
         if not styleD3:
             couleurs[CONGES_DEPASSEMENT] = 'B3'
         
+        factures = CalculeFactures(self.inscrits, self.periode.year, self.periode.month, options=TRACES)
         for index, inscrit in enumerate(self.inscrits):
-            try:
-                facture = Facture(inscrit, self.periode.year, self.periode.month, options=TRACES)
-            except CotisationException, e:
-                errors["%s %s" % (inscrit.prenom, inscrit.nom)] = e.errors
+            facture = factures[index]
+            if facture.errors:
+                errors["%s %s" % (inscrit.prenom, inscrit.nom)] = facture.errors
                 continue
-           
+
+            # Les champs de la facture, formates une seule fois pour toutes les sections
+            last_inscription = None
+            for tmp in inscrit.inscriptions:
+                if not last_inscription or not last_inscription.fin or (tmp.fin and tmp.fin > last_inscription.fin):
+                    last_inscription = tmp 
+            
+            fields = Champs(GetCrecheFields(creche) + GetInscritFields(inscrit) + GetInscriptionFields(last_inscription) + GetFactureFields(facture))
+
             for template in templates:
                 section = template.cloneNode(1)
                 if section.nodeName in ("draw:frame", "draw:custom-shape"):
@@ -189,13 +199,6 @@ class FactureModifications(object):
                         for i in range(row + 1, len(rows)):
                             table.removeChild(rows[i])
 
-                # Les champs de la facture
-                last_inscription = None
-                for tmp in inscrit.inscriptions:
-                    if not last_inscription or not last_inscription.fin or (tmp.fin and tmp.fin > last_inscription.fin):
-                        last_inscription = tmp 
-                
-                fields = GetCrecheFields(creche) + GetInscritFields(inscrit) + GetInscriptionFields(last_inscription) + GetFactureFields(facture)
                 ReplaceTextFields(section, fields)
 
         for template in templates:
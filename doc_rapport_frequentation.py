@@ -197,12 +197,11 @@ class RapportFrequentationModifications(object):
                                 total_heures_facturees[inscrit] += state.heures_facturees
                             else:
                                 total_heures_facturees[inscrit] = state.heures_facturees
-                            if not state.heures_facturees:
-                                state.heures_facturees = ""
-                            if not state.heures_realisees:
-                                state.heures_realisees = ""
-                            ReplaceFields(cells[colonne_jour+j], [('heures-realisees', state.heures_realisees),
-                                                                  ('heures-facturees', state.heures_facturees)])
+                            # les State sont partages (Inscrit.etats), on ne les modifie pas
+                            heures_facturees_jour = state.heures_facturees or ""
+                            heures_realisees_jour = state.heures_realisees or ""
+                            ReplaceFields(cells[colonne_jour+j], [('heures-realisees', heures_realisees_jour),
+                                                                  ('heures-facturees', heures_facturees_jour)])
                         total_cell = cells[len(jours)+colonne_jour]
                         total_cell.setAttribute("table:formula", "of:=SUM([.%s%d:.%s%d])" % (GetColumnName(colonne_jour), i+2, GetColumnName(colonne_jour-1+len(jours)), i+2))
                         if i == 0:
@@ -35,6 +35,7 @@ class ReleveDetailleModifications(object):
     def GenerateOptimomesTable(self, inscrits, (feuille, lines), agemin=0, agemax=0):
         template_first, template, after = lines[0], lines[1], lines[2]
         feuille.removeChild(template)
+        flux = LignesEnFlux(self, after)
 
         count = 0
         for inscrit in inscrits:
@@ -54,7 +55,6 @@ class ReleveDetailleModifications(object):
                 clone = template_first
             else:
                 clone = template.cloneNode(1)
-                feuille.insertBefore(clone, after)
 
             fields = GetInscritFields(inscrit)
             ReplaceFields(clone, fields)
@@ -75,7 +75,9 @@ class ReleveDetailleModifications(object):
                 else:
                     cells = clone.getElementsByTagName("table:table-cell")[2+mois*3:5+mois*3]
                 ReplaceFields(cells, fields)
-                
+
+            if count > 0:
+                flux.Ajoute(clone)
             count += 1
         
         first_cell = template_first.getElementsByTagName("table:table-cell").item(0)
@@ -118,6 +120,7 @@ class ReleveDetailleModifications(object):
                 after = lines[13]
                 for line in template:
                     feuille.removeChild(line)
+                flux = LignesEnFlux(self, after)
                 for inscrit in GetInscrits(datetime.date(self.annee, 1, 1), datetime.date(self.annee, 12, 31)):
                     for i, line in enumerate(template):
                         try:
@@ -129,5 +132,5 @@ class ReleveDetailleModifications(object):
                         ReplaceTextFields(clone, GetInscritFields(inscrit))
                         if facture:
                             ReplaceTextFields(clone, GetFactureFields(facture))
-                        feuille.insertBefore(clone, after)
+                        flux.Ajoute(clone)
             return self.errors
\ No newline at end of file
@@ -20,6 +20,8 @@ from functions import *
 from ooffice import *
 
 class ReleveSalariesModifications(object):
+    parties = ('content.xml',)
+
     def __init__(self, salaries, periode):
         self.salaries = salaries
         self.periode = periode
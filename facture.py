@@ -15,9 +15,13 @@
 ##    You should have received a copy of the GNU General Public License
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
-import datetime
+import os, sys, datetime, threading
 from constants import *
 from cotisation import *
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 class FactureFinMois(object):
     def CalculeDeduction(self, cotisation, heures):
@@ -50,7 +54,7 @@ class FactureFinMois(object):
             first_numero = int(creche.numeros_facture[self.debut_recap].valeur)
         except:
             first_numero = 0
-        self.numero = first_numero + creche.inscrits.index(inscrit)
+        self.numero = first_numero + creche.inscrits.GetIndex(inscrit)
         self.options = options
         self.cotisation_mensuelle = 0.0
         self.report_cotisation_mensuelle = 0.0
@@ -175,30 +179,13 @@ class FactureFinMois(object):
                             self.jours_maladie.append(date)
                         if state == MALADE and (creche.mode_facturation != FACTURATION_HORAIRES_REELS or inscription.mode == MODE_FORFAIT_HORAIRE):
                             # recherche du premier et du dernier jour
-                            premier_jour_maladie = tmp = date
-                            nombre_jours_ouvres_maladie = 0
-                            while tmp > inscrit.inscriptions[0].debut:
-                                tmp -= datetime.timedelta(1)
-                                state = inscrit.GetState(tmp).state
-                                if state == MALADE:
-                                    premier_jour_maladie = tmp
-                                    if not tmp in creche.jours_fermeture:
-                                        nombre_jours_ouvres_maladie += 1
-                                elif state != ABSENT:
-                                    break
+                            premier_jour_maladie, nombre_jours_ouvres_maladie = inscrit.etats.GetDebutMaladie(date)
                             if creche.traitement_maladie == DEDUCTION_MALADIE_AVEC_CARENCE_JOURS_OUVRES:
                                 nb_jours_maladie = nombre_jours_ouvres_maladie + 1
                             elif creche.traitement_maladie == DEDUCTION_MALADIE_AVEC_CARENCE_JOURS_CALENDAIRES:
                                 nb_jours_maladie = (date - premier_jour_maladie).days + 1
                             else:
-                                dernier_jour_maladie = tmp = date
-                                while not inscrit.inscriptions[-1].fin or tmp < inscrit.inscriptions[-1].fin:
-                                    tmp += datetime.timedelta(1)
-                                    state = inscrit.GetState(tmp).state
-                                    if state == MALADE:
-                                        dernier_jour_maladie = tmp
-                                    else:
-                                        break
+                                dernier_jour_maladie = inscrit.etats.GetFinMaladie(date)
                                 nb_jours_maladie = (dernier_jour_maladie - premier_jour_maladie).days + 1
                             
                             if options & TRACES: print "nombre de jours : %d (minimum=%d)" % (nb_jours_maladie, creche.minimum_maladie)
@@ -435,6 +422,7 @@ class FactureFinMois(object):
                 date = datetime.date(self.annee, self.mois, 1)
             self.cloture = True
             self.inscrit.factures_cloturees[date] = self
+            factures_cache.InvalideInscrit(self.inscrit)
             if sql_connection:
                 sql_connection.execute('INSERT INTO FACTURES (idx, inscrit, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction) VALUES (NULL,?,?,?,?,?,?,?,?,?)', (self.inscrit.idx, date, self.cotisation_mensuelle, self.total_contractualise, self.total_realise, self.total_facture, self.supplement_activites, self.supplement, self.deduction))
                 history.append(None)
@@ -510,6 +498,37 @@ class FactureDebutMoisPrevisionnel(FactureDebutMois):
                 date += datetime.timedelta(1)
             FactureFinMois.Cloture(self)       
 
+class FacturesCache(dict):
+    # factures deja calculees, par inscrit puis par (mois, options)
+    # les objets de sqlobjects invalident les mois concernes a chaque modification
+
+    def Get(self, inscrit, date, options):
+        return self[inscrit][(date, options)]
+
+    def Set(self, inscrit, date, options, facture):
+        if inscrit not in self:
+            self[inscrit] = {}
+        self[inscrit][(date, options)] = facture
+
+    def Invalide(self):
+        self.clear()
+
+    def InvalideInscrit(self, inscrit):
+        if inscrit in self:
+            del self[inscrit]
+
+    def InvalideMois(self, inscrit, date):
+        # le mois suivant est aussi invalide (factures en debut de mois)
+        if inscrit in self:
+            debut = GetMonthStart(date)
+            suivant = GetNextMonthStart(debut)
+            factures = self[inscrit]
+            for key in factures.keys():
+                if key[0] in (debut, suivant):
+                    del factures[key]
+
+factures_cache = FacturesCache()
+
 def CreateFacture(inscrit, annee, mois, options=0):
     if creche.temps_facturation == FACTURATION_FIN_MOIS:
         return FactureFinMois(inscrit, annee, mois, options)
@@ -547,6 +566,7 @@ class FactureCloturee:
     def Decloture(self):
         self.cloture = True
         del self.inscrit.factures_cloturees[self.date]
+        factures_cache.InvalideInscrit(self.inscrit)
         if sql_connection:
             print u'Suppression clôture', self.inscrit.idx, self.date
             sql_connection.execute('DELETE FROM FACTURES where inscrit=? AND date=?', (self.inscrit.idx, self.date))
@@ -558,6 +578,91 @@ def Facture(inscrit, annee, mois, options=0):
     date = datetime.date(annee, mois, 1)
     if date in inscrit.factures_cloturees:
         return inscrit.factures_cloturees[date].Restore()        
-    else:
+    elif options & TRACES:
         return CreateFacture(inscrit, annee, mois, options)
-    
\ No newline at end of file
+    else:
+        try:
+            return factures_cache.Get(inscrit, date, options)
+        except KeyError:
+            facture = CreateFacture(inscrit, annee, mois, options)
+            factures_cache.Set(inscrit, date, options, facture)
+            return facture
+    
+
+def IsValeurSimple(value):
+    if value is None or isinstance(value, (bool, int, long, float, basestring, datetime.date)):
+        return True
+    elif isinstance(value, (list, tuple, set)):
+        return all(IsValeurSimple(item) for item in value)
+    elif isinstance(value, dict):
+        return all(IsValeurSimple(key) and IsValeurSimple(item) for key, item in value.items())
+    else:
+        return False
+
+class ResultatFacture(object):
+    # copie des champs simples d'une facture (totaux, heures, jours_*), transmissible d'un processus a l'autre
+    def __init__(self, inscrit, annee, mois, options=0):
+        self.inscrit = inscrit
+        self.site = None
+        self.site_index = None
+        self.annee = annee
+        self.mois = mois
+        self.errors = []
+        try:
+            facture = Facture(inscrit, annee, mois, options)
+        except CotisationException, e:
+            self.errors = e.errors
+            return
+        except Exception, e:
+            self.errors = [unicode(e)]
+            return
+        for key, value in facture.__dict__.items():
+            if IsValeurSimple(value):
+                self.__dict__[key] = value
+        if facture.site in creche.sites:
+            self.site = facture.site
+            self.site_index = creche.sites.index(facture.site)
+
+    def __getstate__(self):
+        # l'inscrit et le site sont rattaches par le processus principal
+        state = self.__dict__.copy()
+        state["inscrit"] = state["site"] = None
+        return state
+
+def CalculeResultatFacture(tache):
+    index, annee, mois, options = tache
+    return ResultatFacture(creche.inscrits[index], annee, mois, options)
+
+def InitProcessusFactures(filename):
+    # une connexion sqlite ne doit pas etre partagee avec le processus pere : chaque fils ouvre
+    # la sienne pour lire les journees hors de la periode chargee
+    import __builtin__, sqlinterface
+    __builtin__.sql_connection = sqlinterface.SQLConnection(filename) if filename else None
+
+FACTURES_PAR_PROCESSUS = 8
+
+def CalculeFactures(inscrits, annee, mois, options=0, processes=None):
+    # les processus fils travaillent sur une copie (fork) du modele charge. Le fork n'est sur que
+    # sous Linux et depuis le thread principal (pas sous Mac OS ou depuis le thread de generation
+    # des documents) ; sinon, ou pour peu d'inscrits, le calcul reste dans ce processus
+    if multiprocessing is None or not sys.platform.startswith("linux") or not isinstance(threading.current_thread(), threading._MainThread) or len(inscrits) < 2 * FACTURES_PAR_PROCESSUS:
+        return [ResultatFacture(inscrit, annee, mois, options) for inscrit in inscrits]
+    taches = [(creche.inscrits.GetIndex(inscrit), annee, mois, options) for inscrit in inscrits]
+    if sql_connection:
+        # les fils ne doivent pas heriter des UPDATE en attente
+        sql_connection.Flush()
+    try:
+        pool = multiprocessing.Pool(processes, InitProcessusFactures, (sql_connection.filename if sql_connection else None,))
+    except Exception, e:
+        print "Pool de processus indisponible", e
+        return [ResultatFacture(inscrit, annee, mois, options) for inscrit in inscrits]
+    try:
+        result = pool.map(CalculeResultatFacture, taches, FACTURES_PAR_PROCESSUS)
+    finally:
+        pool.close()
+        pool.join()
+    for inscrit, resultat in zip(inscrits, result):
+        resultat.inscrit = inscrit
+        if resultat.site_index is not None:
+            resultat.site = creche.sites[resultat.site_index]
+    return result
@@ -15,10 +15,14 @@
 ##    You should have received a copy of the GNU General Public License
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
-import datetime, os.path
+import datetime, os.path, bisect, hashlib
 from constants import *
 from parameters import *
 import wx
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def GetFirstMonday():
     first_monday = first_date
@@ -129,12 +133,12 @@ def IsPresentDuringTranche(journee, debut, fin):
     return False
 
 def HeuresTranche(journee, debut, fin):
-    result = [0] * (24 * 60 / BASE_GRANULARITY)
-    for start, end, value in journee.activites:
-        if start < fin and end > debut and (not value & PREVISIONNEL or not value & CLOTURE):
-            for i in range(max(start, debut), min(end, fin)):
-                result[i] = 1
-    return float(sum(result) * BASE_GRANULARITY) / 60
+    result, last_end = 0, debut
+    for start, end, value in sorted(journee.activites):
+        if start < fin and end > last_end and (not value & PREVISIONNEL or not value & CLOTURE):
+            result += min(end, fin) - max(start, last_end)
+            last_end = min(end, fin)
+    return float(result * BASE_GRANULARITY) / 60
 
 def GetJoursOuvres(annee, mois):
     jours_ouvres = 0
@@ -149,10 +153,11 @@ def GetHeuresAccueil(annee, mois, site=None):
     if site is not None:
         return GetJoursOuvres(annee, mois) * (creche.fermeture - creche.ouverture) * site.capacite
     result = 0.0
+    heures_accueil = [creche.GetHeuresAccueil(jour) for jour in range(7)]
     date = datetime.date(annee, mois, 1)
     while date.month == mois:
         if not date in creche.jours_fermeture:
-            result += creche.GetHeuresAccueil(date.weekday()) 
+            result += heures_accueil[date.weekday()]
         date += datetime.timedelta(1)
     return result        
     
@@ -492,35 +497,95 @@ def GetActivityColor(value):
     else:
         return 0, 0, 0, 0, 100
 
+class Activites(dict):
+    # tranches horaires d'une journee : dict (debut, fin, valeur) -> idx,
+    # indexe en plus par valeur (debuts tries et fins correspondantes)
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.tranches = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, idx):
+        if key not in self:
+            start, end, value = key
+            if value not in self.tranches:
+                self.tranches[value] = ([], [])
+            debuts, fins = self.tranches[value]
+            i = bisect.bisect_right(debuts, start)
+            debuts.insert(i, start)
+            fins.insert(i, end)
+        dict.__setitem__(self, key, idx)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        start, end, value = key
+        debuts, fins = self.tranches[value]
+        i = bisect.bisect_left(debuts, start)
+        while fins[i] != end:
+            i += 1
+        del debuts[i], fins[i]
+        if not debuts:
+            del self.tranches[value]
+
+    def update(self, *args, **kwargs):
+        for key, idx in dict(*args, **kwargs).items():
+            self[key] = idx
+
+    def setdefault(self, key, idx=None):
+        if key not in self:
+            self[key] = idx
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            idx = self[key]
+            del self[key]
+            return idx
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, idx = dict.popitem(self)
+        dict.__setitem__(self, key, idx)
+        del self[key]
+        return key, idx
+
+    def clear(self):
+        dict.clear(self)
+        self.tranches.clear()
+
+    def GetValeurs(self):
+        # valeurs presentes, les absences (negatives) en premier
+        return sorted(self.tranches.keys())
+
+    def GetTranches(self, value):
+        # tranches (debut, fin) de la valeur, triees par debut
+        if value in self.tranches:
+            return zip(*self.tranches[value])
+        else:
+            return []
+
+    def GetChevauchements(self, start, end, values=None):
+        # cles des tranches telles que debut <= end et fin >= start
+        result = []
+        if values is None:
+            values = self.tranches.keys()
+        for value in values:
+            if value in self.tranches:
+                debuts, fins = self.tranches[value]
+                for i in range(bisect.bisect_right(debuts, end)):
+                    if fins[i] >= start:
+                        result.append((debuts[i], fins[i], value))
+        return result
+
 def GetUnionHeures(journee, reference):
+    tranches = sorted(journee.activites.GetTranches(0) + reference.activites.GetTranches(0))
     result = []
-    for start, end, value in journee.activites:
-        if value == 0:
-            result.append((start, end))
-    for start, end, value in reference.activites:
-        if value == 0:
+    for start, end in tranches:
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
             result.append((start, end))
-    
-    again = True
-    while again:
-        again = False
-        union = result[:]
-        result = []
-        for start, end in union:
-            found = False
-            for i, (s, e) in enumerate(result):
-                if end < s or start > e:
-                    pass
-                elif start >= s and end <= e:
-                    found = True
-                elif start <= s or end >= e:
-                    result[i] = (min(s, start), max(e, end))
-                    found = True
-            if not found:
-                result.append((start, end))
-            else:
-                again = True
-
     return result
 
 def PopulateWeekChoice(combo):
@@ -551,28 +616,84 @@ class Summary(list):
         for i in range(DAY_SIZE):
             self.append([0, 0])
             
-def GetActivitiesSummary(creche, lines):
-    activites = {}
+class Occupation(dict):
+    # nombre de tranches (cle, debut, fin) couvrant chacun des DAY_SIZE creneaux : cle -> liste de DAY_SIZE entiers
+    # le calcul se fait sur une matrice (cles x DAY_SIZE) avec numpy quand il est installe
+    def __init__(self, tranches):
+        dict.__init__(self)
+        self.index = {}
+        cles, debuts, fins = [], [], []
+        for cle, debut, fin in tranches:
+            if debut < fin:
+                if cle not in self.index:
+                    self.index[cle] = len(self.index)
+                cles.append(self.index[cle])
+                debuts.append(debut)
+                fins.append(fin)
+        if numpy is not None:
+            self.matrice = numpy.zeros((len(self.index), DAY_SIZE+1), dtype=numpy.int32)
+            numpy.add.at(self.matrice, (cles, debuts), 1)
+            numpy.add.at(self.matrice, (cles, fins), -1)
+            self.matrice = numpy.cumsum(self.matrice[:, :DAY_SIZE], axis=1)
+            lignes = self.matrice.tolist()
+        else:
+            self.matrice = None
+            lignes = [[0] * (DAY_SIZE+1) for cle in self.index]
+            for cle, debut, fin in zip(cles, debuts, fins):
+                lignes[cle][debut] += 1
+                lignes[cle][fin] -= 1
+            for ligne in lignes:
+                del ligne[DAY_SIZE]
+                for i in range(1, DAY_SIZE):
+                    ligne[i] += ligne[i-1]
+        for cle in self.index:
+            self[cle] = lignes[self.index[cle]]
+
+    def __missing__(self, cle):
+        return [0] * DAY_SIZE
+
+    def GetDepassements(self, cle, capacite):
+        # creneaux ou le nombre de tranches depasse la capacite (nombre ou liste de DAY_SIZE valeurs)
+        if cle not in self.index:
+            return []
+        elif self.matrice is not None:
+            return numpy.flatnonzero(self.matrice[self.index[cle]] > numpy.array(capacite)).tolist()
+        elif isinstance(capacite, list):
+            return [i for i, count in enumerate(self[cle]) if count > capacite[i]]
+        else:
+            return [i for i, count in enumerate(self[cle]) if count > capacite]
+
+def GetOccupationActivites(creche, lines):
+    # occupation des lignes par (activite, colonne du summary) et compteurs des activites sans horaires
+    tranches = []
     activites_sans_horaires = {}
     for key in creche.activites:
         activite = creche.activites[key]
         if activite.mode == MODE_SANS_HORAIRES:
             activites_sans_horaires[key] = 0
-        elif activite.mode != MODE_SYSTEMATIQUE_SANS_HORAIRES:
-            activites[key] = Summary(activite.label)
-        
+
     for line in lines:
         if line is not None and not isinstance(line, basestring):
             for start, end, value in line.activites:
                 if value < PREVISIONNEL+CLOTURE:
                     value &= ~(PREVISIONNEL+CLOTURE)
                     if value in creche.activites:
-                        for i in range(start, end):
-                            if value in activites:
-                                activites[value][i][line.summary-1] += 1
+                        tranches.append(((value, line.summary-1), start, end))
             for key in line.activites_sans_horaires:
                 if key in activites_sans_horaires:
                     activites_sans_horaires[key] += 1
+    return Occupation(tranches), activites_sans_horaires
+
+def GetActivitiesSummary(creche, lines):
+    activites = {}
+    for key in creche.activites:
+        activite = creche.activites[key]
+        if activite.mode not in (MODE_SANS_HORAIRES, MODE_SYSTEMATIQUE_SANS_HORAIRES):
+            activites[key] = Summary(activite.label)
+
+    occupation, activites_sans_horaires = GetOccupationActivites(creche, lines)
+    for key in activites:
+        activites[key][:] = [list(counts) for counts in zip(occupation[(key, 0)], occupation[(key, 1)])]
     return activites, activites_sans_horaires
 
 def GetCrecheFields(creche):
@@ -755,3 +876,11 @@ class ProgressHandler:
         return ProgressHandler(self.display_fn, self.gauge_fn, self.value, self.value + (self.max-self.min)*ratio/100)
 
 default_progress_handler = ProgressHandler()
+
+def HashFile(filename, blocksize=1024*1024):
+    md5 = hashlib.md5()
+    f = file(filename, 'rb')
+    for block in iter(lambda: f.read(blocksize), ''):
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
@@ -2,6 +2,14 @@
 
 $token_filename = "./.token";
 $db_filename = "./gertrude.db";
+$version_filename = "./gertrude.version";
+$changes_prefix = "./changes_";
+$changes_count = 100; // nombre de versions dont les modifications sont conservees
+$gz_filename = "./gertrude.db.gz";
+$chunk_size = 1048576;
+$journal_filename = "./journal.txt"; // evenements de la tablette, une ligne par evenement
+$backups_retention = array(24, 30, 12); // sauvegardes conservees par heure, jour et mois
+$lock_filename = "./gertrude.lock";
 
 if (isset($_GET["token"]))
   $token = $_GET["token"];
@@ -62,6 +70,91 @@ function rel_token() {
   return 1;
 }
 
+function get_db_version() {
+  global $version_filename;
+
+  if (!file_exists($version_filename))
+    return 0;
+
+  return intval(trim(file_get_contents($version_filename)));
+}
+
+function set_db_version($version) {
+  global $version_filename;
+  global $changes_prefix;
+  global $changes_count;
+  global $gz_filename;
+
+  file_put_contents($version_filename, $version);
+  $old_changes = $changes_prefix . ($version - $changes_count) . ".gz";
+  if (file_exists($old_changes))
+    unlink($old_changes);
+  if (file_exists($gz_filename))
+    unlink($gz_filename);
+}
+
+function set_full_version() {
+  global $changes_prefix;
+
+  // pas de modifications pour cette version => les clients plus anciens rechargent la base complete
+  $version = get_db_version() + 1;
+  if (file_exists($changes_prefix . $version . ".gz"))
+    unlink($changes_prefix . $version . ".gz");
+  set_db_version($version);
+  return $version;
+}
+
+function backup_db() {
+  global $db_filename;
+  global $chunk_size;
+
+  if (file_exists($db_filename)) {
+    $fp = fopen($db_filename, "rb");
+    $gz = gzopen("./backup_" . time() . ".db.gz", "wb6");
+    if (!$fp || !$gz)
+      return 0;
+    while (!feof($fp))
+      gzwrite($gz, fread($fp, $chunk_size));
+    fclose($fp);
+    gzclose($gz);
+    purge_backups();
+  }
+  return 1;
+}
+
+function get_backup_time($filename) {
+  return intval(substr(basename($filename), 7));
+}
+
+function compare_backups($a, $b) {
+  return get_backup_time($b) - get_backup_time($a);
+}
+
+function purge_backups() {
+  global $backups_retention;
+
+  // les plus recentes de chaque heure, jour et mois sont conservees
+  $backups = glob("./backup_*.db*");
+  usort($backups, "compare_backups");
+  $kept = array($backups[0] => 1);
+  foreach (array("YmdH", "Ymd", "Ym") as $i => $format) {
+    $periods = array();
+    foreach ($backups as $backup) {
+      $key = date($format, get_backup_time($backup));
+      if (!isset($periods[$key])) {
+        if (count($periods) >= $backups_retention[$i])
+          break;
+        $periods[$key] = 1;
+        $kept[$backup] = 1;
+      }
+    }
+  }
+  foreach ($backups as $backup) {
+    if (!isset($kept[$backup]))
+      unlink($backup);
+  }
+}
+
 function upload() {
   global $db_filename;
 
@@ -72,16 +165,192 @@ function upload() {
   if (!is_uploaded_file($tmp_file))
     return 0;
 
-  if (file_exists($db_filename)) {
-    $backup_filename = "backup_" . time() . ".db";
-    if (!copy($db_filename, $backup_filename))
+  if (!backup_db())
+    return 0;
+
+  if (!move_uploaded_file($tmp_file, $db_filename))
+    return 0;
+
+  return set_full_version();
+}
+
+// transferts compresses par morceaux, avec reprise
+
+function get_part_filename() {
+  if (!isset($_GET["md5"]) || !preg_match('/^[0-9a-f]{32}$/', $_GET["md5"]))
+    return NULL;
+  return "./upload_" . $_GET["md5"] . ".part";
+}
+
+function get_compressed_db() {
+  global $db_filename;
+  global $gz_filename;
+  global $chunk_size;
+
+  if (!file_exists($gz_filename)) {
+    $tmp_filename = $gz_filename . "." . uniqid() . ".tmp";
+    $fp = fopen($db_filename, "rb");
+    $gz = gzopen($tmp_filename, "wb6");
+    while (!feof($fp))
+      gzwrite($gz, fread($fp, $chunk_size));
+    fclose($fp);
+    gzclose($gz);
+    rename($tmp_filename, $gz_filename);
+  }
+  return $gz_filename;
+}
+
+function download_info() {
+  global $db_filename;
+
+  if (!file_exists($db_filename))
+    return 0;
+
+  $filename = get_compressed_db();
+  return filesize($filename) . " " . md5_file($filename) . " " . get_db_version();
+}
+
+function download_chunk() {
+  global $db_filename;
+  global $chunk_size;
+
+  if (!file_exists($db_filename) || !isset($_GET["offset"]))
+    return "";
+
+  $size = isset($_GET["size"]) ? min(intval($_GET["size"]), $chunk_size) : $chunk_size;
+  $fp = fopen(get_compressed_db(), "rb");
+  fseek($fp, intval($_GET["offset"]));
+  $data = fread($fp, $size);
+  fclose($fp);
+  return $data;
+}
+
+function upload_status() {
+  $part_filename = get_part_filename();
+  if (!$part_filename || !file_exists($part_filename))
+    return 0;
+
+  return filesize($part_filename);
+}
+
+function upload_chunk() {
+  if (!check_token() || !($part_filename = get_part_filename()) || !isset($_GET["offset"]))
+    return 0;
+
+  // un morceau deja recu (reponse perdue) ou hors sequence n'est pas ajoute
+  if (intval($_GET["offset"]) == upload_status()) {
+    $fp = fopen($part_filename, "ab");
+    fwrite($fp, file_get_contents("php://input"));
+    fclose($fp);
+    clearstatcache();
+  }
+  return upload_status();
+}
+
+function upload_commit() {
+  global $db_filename;
+  global $chunk_size;
+
+  if (!check_token() || !($part_filename = get_part_filename()) || !file_exists($part_filename))
+    return 0;
+
+  if (md5_file($part_filename) != $_GET["md5"]) {
+    unlink($part_filename);
+    return 0;
+  }
+
+  if (!backup_db())
+    return 0;
+
+  $tmp_filename = $db_filename . "." . uniqid() . ".tmp";
+  $gz = gzopen($part_filename, "rb");
+  $fp = fopen($tmp_filename, "wb");
+  while (!gzeof($gz))
+    fwrite($fp, gzread($gz, $chunk_size));
+  gzclose($gz);
+  fclose($fp);
+  unlink($part_filename);
+  if (!rename($tmp_filename, $db_filename))
+    return 0;
+
+  return set_full_version();
+}
+
+function upload_delta() {
+  global $db_filename;
+  global $changes_prefix;
+
+  if (!check_token() || !file_exists($db_filename))
+    return 0;
+
+  $data = file_get_contents("php://input");
+  $changeset = json_decode(gzuncompress($data), true);
+  if (!is_array($changeset) || intval($changeset["version"]) != get_db_version())
+    return 0;
+
+  try {
+    $db = new PDO("sqlite:" . $db_filename);
+    $db->setAttribute(PDO::ATTR_ERRMODE, PDO::ERRMODE_EXCEPTION);
+    $db->beginTransaction();
+    try {
+      foreach ($changeset["changes"] as $change) {
+        if (!preg_match('/^\s*(INSERT|UPDATE|DELETE)\s/i', $change[0]))
+          throw new Exception("requete refusee");
+        $statement = $db->prepare($change[0]);
+        foreach ($change[1] as $i => $value) {
+          if (is_null($value))
+            $statement->bindValue($i+1, $value, PDO::PARAM_NULL);
+          else if (is_int($value) || is_bool($value))
+            $statement->bindValue($i+1, $value, PDO::PARAM_INT);
+          else
+            $statement->bindValue($i+1, $value, PDO::PARAM_STR);
+        }
+        $statement->execute();
+      }
+      $db->commit();
+    }
+    catch (Exception $e) {
+      $db->rollBack();
       return 0;
+    }
+  }
+  catch (Exception $e) {
+    return 0;
   }
 
-  if (!move_uploaded_file($tmp_file, $db_filename))
+  $version = get_db_version() + 1;
+  file_put_contents($changes_prefix . $version . ".gz", $data);
+  set_db_version($version);
+  return $version;
+}
+
+function download_delta() {
+  global $changes_prefix;
+
+  $version = get_db_version();
+  if (!isset($_GET["version"]) || intval($_GET["version"]) <= 0 || intval($_GET["version"]) > $version)
     return 0;
 
-  return 1;
+  $changes = array();
+  for ($i = intval($_GET["version"]) + 1; $i <= $version; $i++) {
+    $filename = $changes_prefix . $i . ".gz";
+    if (!file_exists($filename))
+      return 0;
+    $changeset = json_decode(gzuncompress(file_get_contents($filename)), true);
+    $changes = array_merge($changes, $changeset["changes"]);
+  }
+
+  return gzcompress(json_encode(array("version" => $version, "changes" => $changes)));
+}
+
+// prise du jeton et modifications depuis la version du client en un seul aller-retour
+function token_download() {
+  $token = get_token(isset($_GET["force"]) ? intval($_GET["force"]) : 0);
+  if (!$token)
+    return 0;
+
+  $delta = download_delta();
+  return $token . " " . get_db_version() . "\n" . ($delta ? $delta : "");
 }
 
 function download() {
@@ -95,6 +364,46 @@ function download() {
   return $data;
 }
 
+// la version precede la base : demandee a part, elle pourrait deja correspondre
+// a l'envoi d'un autre poste
+function download_version() {
+  global $db_filename;
+
+  if (!file_exists($db_filename))
+    return 0;
+
+  return get_db_version() . "\n" . file_get_contents($db_filename);
+}
+
+function journal() {
+  global $journal_filename;
+
+  if (!file_exists($journal_filename))
+    return "";
+
+  return file_get_contents($journal_filename);
+}
+
+// lignes completes a partir de offset, precedees de l'offset effectif
+function journal_chunk() {
+  global $journal_filename;
+  global $chunk_size;
+
+  if (!file_exists($journal_filename))
+    return "0\n";
+
+  $offset = isset($_GET["offset"]) ? intval($_GET["offset"]) : 0;
+  if ($offset > filesize($journal_filename))
+    $offset = 0;
+  $size = isset($_GET["size"]) ? min(intval($_GET["size"]), $chunk_size) : $chunk_size;
+  $fp = fopen($journal_filename, "rb");
+  fseek($fp, $offset);
+  $data = fread($fp, $size);
+  fclose($fp);
+  $end = strrpos($data, "\n");
+  return $offset . "\n" . ($end === false ? "" : substr($data, 0, $end + 1));
+}
+
 function get_version($prefix, $suffix) {
    $dh = opendir(".");
    while (false !== ($file = readdir($dh))) {
@@ -119,6 +428,30 @@ function execute($action) {
       return upload();
     case "download":
       return download();
+    case "download_version":
+      return download_version();
+    case "version":
+      return get_db_version();
+    case "upload_delta":
+      return upload_delta();
+    case "download_delta":
+      return download_delta();
+    case "token_download":
+      return token_download();
+    case "download_info":
+      return download_info();
+    case "download_chunk":
+      return download_chunk();
+    case "upload_status":
+      return upload_status();
+    case "upload_chunk":
+      return upload_chunk();
+    case "upload_commit":
+      return upload_commit();
+    case "journal":
+      return journal();
+    case "journal_chunk":
+      return journal_chunk();
     case "get_exe_version":
       return get_version("gertrude_", ".exe");
     case "get_templates_version":
@@ -126,7 +459,15 @@ function execute($action) {
   }
 }
 
-if (isset($_GET["action"]))
-  echo execute($_GET["action"]);
+// une action a la fois, comme gertrude_server.py : la base, sa version et l'archive
+// compressee restent coherentes entre elles
+if (isset($_GET["action"])) {
+  $lock = fopen($lock_filename, "c");
+  wa_flock($lock, LOCK_EX);
+  $result = execute($_GET["action"]);
+  wa_flock($lock, LOCK_UN);
+  fclose($lock);
+  echo $result;
+}
 
 ?>
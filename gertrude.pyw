@@ -23,6 +23,7 @@ import wx, wx.lib.wordwrap
 from wx.lib import masked
 from startdialog import StartDialog
 from config import Liste, Load, Update, Save, Restore, Exit, ProgressHandler
+from data import LiveFileConnection
 from constants import *
 from functions import today, GetBitmapFile, GetPrenomNom
 from alertes import CheckAlertes
@@ -197,12 +198,17 @@ class GertrudeFrame(wx.Frame):
         self.Bind(wx.EVT_TIMER, self.onUpdateTimer, self.timer)  # call the on_timer function
     
     def onUpdateTimer(self, event):
-        if readonly:
+        if ooffice.travaux_en_cours:
+            # un thread de generation de documents utilise la connexion et les objets du modele
+            return
+        if readonly or isinstance(config.connection, LiveFileConnection):
             _sql_connection, _creche = Update()
             if _sql_connection and _creche:
                 __builtin__.sql_connection = _sql_connection
                 __builtin__.creche = _creche
                 self.listbook.UpdateContents()
+        elif sql_connection:
+            sql_connection.Flush()
         
     def AutoActions(self):
         if creche.changement_groupe_auto:
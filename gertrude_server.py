@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+##    This file is part of Gertrude.
+##
+##    Gertrude is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation; either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    Gertrude is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
+
+# Equivalent local de gertrude.php, pour les tests ou un reseau sans serveur web
+# usage : python gertrude_server.py [port] [repertoire]
+
+import sys, os, time, re, uuid, cgi, urlparse, shutil, zlib, json, gzip, hashlib, glob
+import BaseHTTPServer, SocketServer, threading
+try:
+    import sqlite3
+except:
+    from pysqlite2 import dbapi2 as sqlite3
+
+TOKEN_FILENAME = ".token"
+DB_FILENAME = "gertrude.db"
+VERSION_FILENAME = "gertrude.version"
+CHANGES_PREFIX = "changes_"
+CHANGES_COUNT = 100 # nombre de versions dont les modifications sont conservees
+GZ_FILENAME = "gertrude.db.gz"
+BACKUPS_RETENTION = (24, 30, 12) # sauvegardes conservees par heure, jour et mois
+CHUNK_SIZE = 1024 * 1024
+JOURNAL_FILENAME = "journal.txt" # evenements de la tablette, une ligne par evenement
+
+class GertrudeServer(object):
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def read(self, filename):
+        f = file(self.path(filename), "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def write(self, filename, data):
+        f = file(self.path(filename), "wb")
+        f.write(data)
+        f.close()
+
+    def check_token(self, token):
+        if not os.path.exists(self.path(TOKEN_FILENAME)):
+            return 0
+        return int(token == self.read(TOKEN_FILENAME).strip())
+
+    def get_token(self, force=0):
+        if not force and os.path.exists(self.path(TOKEN_FILENAME)):
+            return 0
+        token = uuid.uuid4().hex
+        self.write(TOKEN_FILENAME, token)
+        return token
+
+    def rel_token(self, token):
+        if not self.check_token(token):
+            return 0
+        os.remove(self.path(TOKEN_FILENAME))
+        return 1
+
+    def get_db_version(self):
+        if not os.path.exists(self.path(VERSION_FILENAME)):
+            return 0
+        return int(self.read(VERSION_FILENAME).strip())
+
+    def set_db_version(self, version):
+        self.write(VERSION_FILENAME, str(version))
+        old_changes = self.path("%s%d.gz" % (CHANGES_PREFIX, version - CHANGES_COUNT))
+        if os.path.exists(old_changes):
+            os.remove(old_changes)
+        if os.path.exists(self.path(GZ_FILENAME)):
+            os.remove(self.path(GZ_FILENAME))
+
+    def set_full_version(self):
+        version = self.get_db_version() + 1
+        if os.path.exists(self.path("%s%d.gz" % (CHANGES_PREFIX, version))):
+            os.remove(self.path("%s%d.gz" % (CHANGES_PREFIX, version)))
+        self.set_db_version(version)
+        return version
+
+    def backup_db(self):
+        if os.path.exists(self.path(DB_FILENAME)):
+            src = file(self.path(DB_FILENAME), "rb")
+            dst = gzip.open(self.path("backup_%d.db.gz" % time.time()), "wb", 6)
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            src.close()
+            dst.close()
+            self.purge_backups()
+
+    def purge_backups(self):
+        backup_time = lambda filename: int(os.path.basename(filename)[7:].split(".")[0])
+        backups = sorted(glob.glob(self.path("backup_*.db*")), key=backup_time, reverse=True)
+        kept = set(backups[:1])
+        for count, period in zip(BACKUPS_RETENTION, ("%Y%m%d%H", "%Y%m%d", "%Y%m")):
+            periods = set()
+            for backup in backups:
+                key = time.strftime(period, time.localtime(backup_time(backup)))
+                if key not in periods:
+                    if len(periods) >= count:
+                        break
+                    periods.add(key)
+                    kept.add(backup)
+        for backup in backups:
+            if backup not in kept:
+                os.remove(backup)
+
+    def upload(self, token, data):
+        if not self.check_token(token) or data is None:
+            return 0
+        self.backup_db()
+        self.write(DB_FILENAME, data)
+        return self.set_full_version()
+
+    def download(self):
+        if not os.path.exists(self.path(DB_FILENAME)):
+            return 0
+        return self.read(DB_FILENAME)
+
+    def download_version(self):
+        # la version precede la base : demandee a part, elle pourrait deja correspondre
+        # a l'envoi d'un autre poste
+        if not os.path.exists(self.path(DB_FILENAME)):
+            return 0
+        return "%d\n%s" % (self.get_db_version(), self.read(DB_FILENAME))
+
+    def upload_delta(self, token, data):
+        if not self.check_token(token) or not os.path.exists(self.path(DB_FILENAME)):
+            return 0
+        try:
+            changeset = json.loads(zlib.decompress(data))
+        except Exception:
+            return 0
+        if int(changeset["version"]) != self.get_db_version():
+            return 0
+        connection = sqlite3.connect(self.path(DB_FILENAME))
+        try:
+            for cmd, args in changeset["changes"]:
+                if not re.match(r"\s*(INSERT|UPDATE|DELETE)\s", cmd, re.IGNORECASE):
+                    raise Exception("requete refusee")
+                connection.execute(cmd, args)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            return 0
+        finally:
+            connection.close()
+        version = self.get_db_version() + 1
+        self.write("%s%d.gz" % (CHANGES_PREFIX, version), data)
+        self.set_db_version(version)
+        return version
+
+    def download_delta(self, client_version):
+        version = self.get_db_version()
+        if client_version <= 0 or client_version > version:
+            return 0
+        changes = []
+        for i in range(client_version + 1, version + 1):
+            filename = "%s%d.gz" % (CHANGES_PREFIX, i)
+            if not os.path.exists(self.path(filename)):
+                return 0
+            changes.extend(json.loads(zlib.decompress(self.read(filename)))["changes"])
+        return zlib.compress(json.dumps({"version": version, "changes": changes}))
+
+    def md5(self, filename):
+        md5 = hashlib.md5()
+        f = file(self.path(filename), "rb")
+        for block in iter(lambda: f.read(CHUNK_SIZE), ""):
+            md5.update(block)
+        f.close()
+        return md5.hexdigest()
+
+    def get_compressed_db(self):
+        if not os.path.exists(self.path(GZ_FILENAME)):
+            tmp_filename = self.path("%s.%s.tmp" % (GZ_FILENAME, uuid.uuid4().hex))
+            src = file(self.path(DB_FILENAME), "rb")
+            dst = gzip.open(tmp_filename, "wb", 6)
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            src.close()
+            dst.close()
+            os.rename(tmp_filename, self.path(GZ_FILENAME))
+        return GZ_FILENAME
+
+    def download_info(self):
+        if not os.path.exists(self.path(DB_FILENAME)):
+            return 0
+        filename = self.get_compressed_db()
+        return "%d %s %d" % (os.path.getsize(self.path(filename)), self.md5(filename), self.get_db_version())
+
+    def download_chunk(self, offset, size):
+        if not os.path.exists(self.path(DB_FILENAME)):
+            return ""
+        f = file(self.path(self.get_compressed_db()), "rb")
+        f.seek(offset)
+        data = f.read(min(size, CHUNK_SIZE))
+        f.close()
+        return data
+
+    def get_part_filename(self, md5):
+        if not md5 or not re.match(r"^[0-9a-f]{32}$", md5):
+            return None
+        return "upload_%s.part" % md5
+
+    def upload_status(self, md5):
+        part_filename = self.get_part_filename(md5)
+        if not part_filename or not os.path.exists(self.path(part_filename)):
+            return 0
+        return os.path.getsize(self.path(part_filename))
+
+    def upload_chunk(self, token, md5, offset, data):
+        part_filename = self.get_part_filename(md5)
+        if not self.check_token(token) or not part_filename:
+            return 0
+        # un morceau deja recu (reponse perdue) ou hors sequence n'est pas ajoute
+        if data and offset == self.upload_status(md5):
+            f = file(self.path(part_filename), "ab")
+            f.write(data)
+            f.close()
+        return self.upload_status(md5)
+
+    def upload_commit(self, token, md5):
+        part_filename = self.get_part_filename(md5)
+        if not self.check_token(token) or not part_filename or not os.path.exists(self.path(part_filename)):
+            return 0
+        if self.md5(part_filename) != md5:
+            os.remove(self.path(part_filename))
+            return 0
+        self.backup_db()
+        tmp_filename = self.path("%s.%s.tmp" % (DB_FILENAME, uuid.uuid4().hex))
+        src = gzip.open(self.path(part_filename), "rb")
+        dst = file(tmp_filename, "wb")
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        src.close()
+        dst.close()
+        os.remove(self.path(part_filename))
+        if os.path.exists(self.path(DB_FILENAME)):
+            os.remove(self.path(DB_FILENAME))
+        os.rename(tmp_filename, self.path(DB_FILENAME))
+        return self.set_full_version()
+
+    def token_download(self, force, client_version):
+        token = self.get_token(force)
+        if not token:
+            return 0
+        return "%s %d\n%s" % (token, self.get_db_version(), self.download_delta(client_version) or "")
+
+    def journal(self):
+        if not os.path.exists(self.path(JOURNAL_FILENAME)):
+            return ""
+        return self.read(JOURNAL_FILENAME)
+
+    def journal_chunk(self, offset, size):
+        # lignes completes a partir de offset, precedees de l'offset effectif
+        if not os.path.exists(self.path(JOURNAL_FILENAME)):
+            return "0\n"
+        if offset > os.path.getsize(self.path(JOURNAL_FILENAME)):
+            offset = 0
+        f = file(self.path(JOURNAL_FILENAME), "rb")
+        f.seek(offset)
+        data = f.read(min(size, CHUNK_SIZE))
+        f.close()
+        return "%d\n%s" % (offset, data[:data.rfind("\n")+1])
+
+    def journal_append(self, data):
+        # ce qu'ecrit la tablette, pour les tests
+        if data:
+            f = file(self.path(JOURNAL_FILENAME), "ab")
+            f.write(data)
+            f.close()
+        return 1
+
+    def get_version(self, prefix, suffix):
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith(suffix):
+                return filename[len(prefix):len(filename)-len(suffix)]
+        return ""
+
+    def execute(self, action, args, data=None, files={}):
+        token = args.get("token")
+        with self.lock:
+            if action == "has_token":
+                return self.check_token(token)
+            elif action == "get_token":
+                return self.get_token(0)
+            elif action == "force_token":
+                return self.get_token(1)
+            elif action == "rel_token":
+                return self.rel_token(token)
+            elif action == "upload":
+                return self.upload(token, files.get("database"))
+            elif action == "download":
+                return self.download()
+            elif action == "download_version":
+                return self.download_version()
+            elif action == "version":
+                return self.get_db_version()
+            elif action == "upload_delta":
+                return self.upload_delta(token, data)
+            elif action == "download_delta":
+                return self.download_delta(int(args.get("version", 0)))
+            elif action == "token_download":
+                return self.token_download(int(args.get("force", 0)), int(args.get("version", 0)))
+            elif action == "download_info":
+                return self.download_info()
+            elif action == "download_chunk":
+                return self.download_chunk(int(args.get("offset", 0)), int(args.get("size", CHUNK_SIZE)))
+            elif action == "upload_status":
+                return self.upload_status(args.get("md5"))
+            elif action == "upload_chunk":
+                return self.upload_chunk(token, args.get("md5"), int(args.get("offset", 0)), data)
+            elif action == "upload_commit":
+                return self.upload_commit(token, args.get("md5"))
+            elif action == "journal":
+                return self.journal()
+            elif action == "journal_chunk":
+                return self.journal_chunk(int(args.get("offset", 0)), int(args.get("size", CHUNK_SIZE)))
+            elif action == "journal_append":
+                return self.journal_append(data)
+            elif action == "get_exe_version":
+                return self.get_version("gertrude_", ".exe")
+            elif action == "get_templates_version":
+                return self.get_version("templates_", ".zip")
+            return ""
+
+class GertrudeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # connexions persistantes, comme un serveur web classique
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self, data=None, files={}):
+        args = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        result = self.server.gertrude.execute(args.get("action"), args, data, files)
+        if result is True or result is False:
+            result = int(result)
+        result = str(result)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def do_POST(self):
+        if self.headers.getheader("Content-Type", "").startswith("multipart/form-data"):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={"REQUEST_METHOD": "POST"})
+            files = dict((key, form[key].value) for key in form.keys() if form[key].filename)
+            self.do_GET(files=files)
+        else:
+            self.do_GET(data=self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+
+    def log_message(self, format, *args):
+        pass
+
+class GertrudeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def CreateServer(port=0, directory="."):
+    server = GertrudeHTTPServer(("localhost", port), GertrudeRequestHandler)
+    server.gertrude = GertrudeServer(directory)
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    directory = sys.argv[2] if len(sys.argv) > 2 else "."
+    server = CreateServer(port, directory)
+    print "Serveur Gertrude sur http://localhost:%d/gertrude.php (repertoire %s)" % (server.server_port, directory)
+    server.serve_forever()
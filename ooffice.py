@@ -16,18 +16,20 @@
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
 import datetime, time, locale
-import sys, os, shutil, types, zipfile
+import sys, os, shutil, types, zipfile, tempfile, codecs
 import xml.dom.minidom
-import re, urllib
+import re, ast, urllib
 import smtplib, poplib
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import wx, wx.lib.filebrowsebutton
-import traceback
+import wx, wx.lib.filebrowsebutton, wx.lib.newevent
+import traceback, thread
 import unicodedata
 from functions import *
+import conversion
+from conversion import GetConvertisseur, ConvertitPDF
 import subprocess
 
 NumberTypes = (types.IntType, types.LongType, types.FloatType, types.ComplexType)
@@ -52,20 +54,57 @@ def GetColumnIndex(name):
     elif len(name) == 2:
         return (ord(name[0]) - 64) * 26 + (ord(name[1]) - 65)    
                     
-def evalFields(fields):
-    for i, field in enumerate(fields[:]):
-        if len(field) == 2 or field[2] & FIELD_EUROS:
+CHAMP = re.compile(r"<([^<>]+)>")
+
+class Champs(dict):
+    # champs d'un enregistrement, formates une seule fois : nom => (valeur, texte, texte en euros)
+    # avec NOM pour le texte en majuscules ; a nom egal, le premier champ de la liste l'emporte
+    def __init__(self, fields):
+        dict.__init__(self)
+        majuscules = []
+        for field in fields:
             param, value = field[0:2]
+            if len(field) == 3 and not field[2] & FIELD_EUROS:
+                continue
             if isinstance(value, list):
                 text = [GetText(v) for v in value]
-                fields.append((param.upper(), value, [t.upper() for t in text]))
+                upper = [t.upper() for t in text]
             else:
-                text = GetText(value) 
-                fields.append((param.upper(), value, text.upper()))
-            fields[i] = (param, value, text)
-        else:    
-            fields.append((param.upper(), value, text.upper()))
-    return fields
+                text = GetText(value)
+                upper = text.upper()
+            euros, euros_upper = text, upper
+            if len(field) == 3 and value is not None:
+                if field[2] & FIELD_SIGN:
+                    euros = locale.format("%+.2f", value)
+                else:
+                    euros = locale.format("%.2f", value)
+                euros_upper = euros.upper()
+            self.setdefault(param, (value, text, euros))
+            majuscules.append((param.upper(), value, upper, euros_upper))
+        for param, value, text, euros in majuscules:
+            self.setdefault(param, (value, text, euros))
+
+    def GetTexte(self, tag):
+        # texte d'un champ <nom> ou <nom(parametres)> (champ appelable), None s'il est inconnu
+        if tag in self:
+            value, text, euros = self[tag]
+            if not callable(value):
+                return euros
+        index = tag.find("(")
+        if index > 0 and tag.endswith(")") and tag[:index] in self:
+            value, text, euros = self[tag[:index]]
+            if callable(value):
+                parameters = tag[index+1:-1]
+                try:
+                    if parameters.strip():
+                        result = value(*ast.literal_eval("(%s,)" % parameters))
+                    else:
+                        result = value()
+                    if result is not None:
+                        return GetText(result)
+                except Exception, e:
+                    print 'erreur :', tag, parameters
+        return None
 
 def GetValue(node):
     result = ""
@@ -144,19 +183,10 @@ def RemoveColumn(rows, index):
                     cell.setAttribute("table:number-columns-repeated", str(repeat-1))
                 break    
             
-def ReplaceTextFields(dom, _fields):
-    fields = _fields[:]
-    for i, field in enumerate(fields):
-        if len(field) == 3 and (field[2] & FIELD_EUROS) and field[1] is not None:
-            if field[2] & FIELD_SIGN:
-                fields[i] = (field[0], locale.format("%+.2f", field[1]))
-            else:
-                fields[i] = (field[0], locale.format("%.2f", field[1]))
+def ReplaceTextFields(dom, fields):
+    if not isinstance(fields, Champs):
+        fields = Champs(fields)
 
-    evalFields(fields)
-    # print dom.toprettyxml()
-    # print fields
-    
     if dom.__class__ == xml.dom.minidom.Element and dom.nodeName in ["text:p", "text:span"]:
         nodes = [dom] + dom.getElementsByTagName("text:span")
     else:
@@ -166,48 +196,37 @@ def ReplaceTextFields(dom, _fields):
             if child.nodeType == child.TEXT_NODE:
                 try:
                     nodeText = child.wholeText
-                    replace = False
-                    for field, value, text in fields:
-                        if isinstance(text, basestring) and callable(value):
-                            start_tag, end_tag = '<%s(' % field, ')>'
-                            if start_tag in nodeText and end_tag in nodeText:
-                                if isinstance(text, list):
-                                    print child.toprettyxml()
-                                else:
-                                    tag = nodeText[nodeText.find(start_tag):nodeText.find(end_tag)+2]
-                                    parameters = tag[len(field)+2:-2]
-                                    try:
-                                        replace = True
-                                        nodeText = nodeText.replace(tag, eval("value(%s)" % parameters))
-                                    except:
-                                        print 'erreur :', tag, parameters
-                        else:
-                            tag = '<%s>' % field
-                            if tag in nodeText:
-                                if isinstance(text, list):
-                                    for t in text:
-                                        duplicate = node.cloneNode(1)
-                                        node.parentNode.insertBefore(duplicate, node)
-                                        for c in duplicate.childNodes:
-                                            if c.nodeType == child.TEXT_NODE:
-                                                nt = c.wholeText.replace(tag, t)
-                                                c.replaceWholeText(nt)
-                                    node.parentNode.removeChild(node)
-                                else:
-                                    replace = True
-                                    if not isinstance(text, basestring):
-                                        text = str(text)
-                                    nodeText = nodeText.replace(tag, text)
-                        
-                    if replace:
-                        child.replaceWholeText(nodeText)
+                    if '<' not in nodeText:
+                        continue
+                    # un champ liste duplique le paragraphe pour chacune de ses valeurs
+                    for mo in CHAMP.finditer(nodeText):
+                        if mo.group(1) in fields and isinstance(fields[mo.group(1)][2], list):
+                            for t in fields[mo.group(1)][2]:
+                                duplicate = node.cloneNode(1)
+                                node.parentNode.insertBefore(duplicate, node)
+                                for c in duplicate.childNodes:
+                                    if c.nodeType == child.TEXT_NODE:
+                                        c.replaceWholeText(c.wholeText.replace(mo.group(0), t))
+                            node.parentNode.removeChild(node)
+                            break
+                    else:
+                        replacements = []
+                        def Remplace(mo):
+                            text = fields.GetTexte(mo.group(1))
+                            if text is None or isinstance(text, list):
+                                return mo.group(0)
+                            replacements.append(mo)
+                            return text
+                        nodeText = CHAMP.sub(Remplace, nodeText)
+                        if replacements:
+                            child.replaceWholeText(nodeText)
                 except Exception, e:
                     print e
 
-def ReplaceFields(cellules, _fields):
-    fields = _fields[:]        
-    evalFields(fields)
-    
+def ReplaceFields(cellules, fields):
+    if not isinstance(fields, Champs):
+        fields = Champs(fields)
+
     # Si l'argument est une ligne ...
     if cellules.__class__ in (xml.dom.minidom.Element, xml.dom.minidom.Document):
         if cellules.nodeName == "table:table-cell":
@@ -221,46 +240,47 @@ def ReplaceFields(cellules, _fields):
             cellules.extend(node.getElementsByTagName("table:table-cell"))
 
     result = False
-    
+
+    def Texte(mo):
+        if mo.group(1) in fields:
+            return fields[mo.group(1)][1]
+        return mo.group(0)
+
+    def Valeur(mo):
+        if mo.group(1) not in fields:
+            return mo.group(0)
+        value, text, euros = fields[mo.group(1)]
+        if value is None:
+            return ''
+        return text
+
     # Remplacement ...
     for cellule in cellules:
         formula = cellule.getAttribute("table:formula")
         if formula:
-            for param, value, text in fields:
-                tag = '<%s>' % param
-                if tag in formula:
-                    formula = formula.replace(tag, text)
-            cellule.setAttribute("table:formula", formula)
+            cellule.setAttribute("table:formula", CHAMP.sub(Texte, formula))
         nodes = cellule.getElementsByTagName("text:p")
         for node in nodes:
             for child in node.childNodes:
                 if child.nodeType == node.TEXT_NODE:
                     nodeText = child.wholeText
                     if '<' in nodeText and '>' in nodeText:
-                        for param, value, text in fields:
-                            tag = '<%s>' % param
-                            if tag in nodeText:
+                        mo = CHAMP.match(nodeText)
+                        if len(nodes) == 1 and mo and mo.end() == len(nodeText) and mo.group(1) in fields:
+                            # la cellule ne contient que le champ : elle prend le type de la valeur
+                            value = fields[mo.group(1)][0]
+                            if isinstance(value, int) or isinstance(value, float):
+                                cellule.setAttribute("office:value-type", 'float')
+                                cellule.setAttribute("office:value", str(value))
+                            elif isinstance(value, datetime.date):
+                                cellule.setAttribute("office:value-type", 'date')
+                                cellule.setAttribute("office:date-value", '%04d-%02d-%02d' % (value.year, value.month, value.day))
+                        for mo in CHAMP.finditer(nodeText):
+                            if mo.group(1) in fields:
                                 result = True
-                                if value is None:
-                                    nodeText = nodeText.replace(tag, '')
-                                elif isinstance(value, int) or isinstance(value, float):
-                                    if len(nodes) == 1 and nodeText == tag:
-                                        cellule.setAttribute("office:value-type", 'float')
-                                        cellule.setAttribute("office:value", str(value))
-                                    nodeText = nodeText.replace(tag, text)
-                                elif isinstance(value, datetime.date):
-                                    if len(nodes) == 1 and nodeText == tag:
-                                        cellule.setAttribute("office:value-type", 'date')
-                                        cellule.setAttribute("office:date-value", '%04d-%02d-%02d' % (value.year, value.month, value.day))
-                                    nodeText = nodeText.replace(tag, text)
-                                else:
-                                    nodeText = nodeText.replace(tag, text)
-    
-                            if '<' not in nodeText or '>' not in nodeText:
                                 break
-    
                         # print child.wholeText, '=>', text
-                        child.replaceWholeText(nodeText)
+                        child.replaceWholeText(CHAMP.sub(Valeur, nodeText))
                         
     return result
 
@@ -274,24 +294,63 @@ def ReplaceFormulas(cellules, old, new):
             cellule.setAttribute("table:formula", formula)
 
 FLAG_SUM_MAX = 1
+REFERENCE = re.compile(r"\.([A-Z]+)([0-9]+)")
+REFERENCE_SUM_MAX = re.compile(r":\.([A-Z]+)([0-9]+)")
+
 def IncrementFormulas(cellules, row=0, column=0, flags=0):
+    # chaque reference est decalee en une seule passe sur la formule
     if flags & FLAG_SUM_MAX:
-        prefix = ":"
+        prefix, reference = ":", REFERENCE_SUM_MAX
     else:
-        prefix = ""
-    formula_gure = re.compile("%s\.([A-Z]+)([0-9]+)" % prefix)
+        prefix, reference = "", REFERENCE
+    def Decale(mo):
+        return "%s.%s%d" % (prefix, GetColumnName(GetColumnIndex(mo.group(1))+column), int(mo.group(2))+row)
     if cellules.__class__ == xml.dom.minidom.Element:
         cellules = cellules.getElementsByTagName("table:table-cell")
     for cellule in cellules:
         if cellule.hasAttribute("table:formula"):
             formula = cellule.getAttribute("table:formula")
-            mo = True
-            while mo is not None:
-                mo = formula_gure.search(formula)
-                if mo:
-                    formula = formula.replace(mo.group(0), "%s.___%s%d" % (prefix, GetColumnName(GetColumnIndex(mo.group(1))+column), int(mo.group(2))+row))
-            formula = formula.replace('.___', '.')
-            cellule.setAttribute("table:formula", formula)
+            cellule.setAttribute("table:formula", reference.sub(Decale, formula))
+
+class LignesEnFlux(object):
+    # lignes d'un tableur ecrites dans un fichier temporaire des qu'elles sont remplies, au lieu
+    # d'etre inserees dans l'arbre DOM : seul un marqueur est laisse a leur place, remplace par
+    # le contenu du fichier a l'ecriture du zip (voir GenerateOODocument)
+    def __init__(self, modifications, suivant):
+        self.marqueur = suivant.ownerDocument.createComment("gertrude-flux-%d" % id(self))
+        suivant.parentNode.insertBefore(self.marqueur, suivant)
+        self.fichier = tempfile.TemporaryFile()
+        self.writer = codecs.getwriter("utf-8")(self.fichier)
+        if not getattr(modifications, "flux", None):
+            modifications.flux = []
+        modifications.flux.append(self)
+
+    def Ajoute(self, ligne):
+        ligne.writexml(self.writer)
+
+    def GetMarqueur(self):
+        return self.marqueur.toxml("UTF-8")
+
+    def Copie(self, sortie):
+        self.fichier.seek(0)
+        shutil.copyfileobj(self.fichier, sortie)
+        self.fichier.close()
+
+def EcritPartieEnFlux(data, flux):
+    # data est la partie XML serialisee avec ses marqueurs, le resultat est le chemin
+    # d'un fichier temporaire a ajouter au zip
+    fd, chemin = tempfile.mkstemp(suffix=".xml")
+    sortie = os.fdopen(fd, "wb")
+    position = 0
+    marqueurs = [(data.find(lignes.GetMarqueur()), lignes) for lignes in flux]
+    for index, lignes in sorted(marqueurs):
+        if index >= 0:
+            sortie.write(data[position:index])
+            lignes.Copie(sortie)
+            position = index + len(lignes.GetMarqueur())
+    sortie.write(data[position:])
+    sortie.close()
+    return chemin
             
 def getNamedShapes(dom):
     shapes = {}
@@ -315,6 +374,39 @@ def GetTables(filename):
     spreadsheet = dom.getElementsByTagName('office:spreadsheet').item(0)
     return spreadsheet.getElementsByTagName("table:table")
 
+XML_FILES = ('meta.xml', 'styles.xml', 'content.xml')
+
+class ModeleODF(object):
+    # modele lu une seule fois : contenu de l'archive, et pour chaque partie XML la serialisation
+    # du modele non modifie, reprise telle quelle pour les parties qu'un document ne modifie pas
+    def __init__(self, filename):
+        zip = zipfile.ZipFile(filename, 'r')
+        self.files = [(f, zip.read(f)) for f in zip.namelist()]
+        zip.close()
+        self.data = dict(self.files)
+        self.serialisations = {}
+
+    def GetDom(self, part):
+        return xml.dom.minidom.parseString(self.data[part])
+
+    def GetXml(self, part):
+        if part not in self.serialisations:
+            self.serialisations[part] = self.GetDom(part).toxml('UTF-8')
+        return self.serialisations[part]
+
+modeles = {}
+
+def GetModele(filename):
+    # un modele modifie sur le disque est relu
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError, e:
+        # comme a l'ouverture de l'archive : IOError si le modele est absent
+        raise IOError(e.errno, e.strerror, filename)
+    if filename not in modeles or modeles[filename][0] != mtime:
+        modeles[filename] = mtime, ModeleODF(filename)
+    return modeles[filename][1]
+
 def GenerateOODocument(modifications, filename=None, gauge=None):
     if gauge:
         gauge.SetValue(0)
@@ -322,33 +414,43 @@ def GenerateOODocument(modifications, filename=None, gauge=None):
         filename = unicodedata.normalize("NFKD", modifications.default_output).encode('ascii', 'ignore')
     template = GetTemplateFile(modifications.template, modifications.site)
     errors = {}
-    zip = zipfile.ZipFile(template, 'r')
+    modele = GetModele(template)
     files = []
+    chemins = {}
     if gauge:
         modifications.gauge = gauge
         gauge.SetValue(5)
-        
-    XML_FILES = ('meta.xml', 'styles.xml', 'content.xml')
+
+    # modifications.parties : les parties XML que execute() modifie (toutes par defaut)
+    parties = getattr(modifications, "parties", XML_FILES)
     for f in XML_FILES:
-        data = zip.read(f)
-        dom = xml.dom.minidom.parseString(data)
-        new_errors = modifications.execute(f, dom)
-        if new_errors:
-            errors.update(new_errors)
-        data = dom.toxml('UTF-8')
-        files.append((f, data))  
+        if f in parties:
+            dom = modele.GetDom(f)
+            new_errors = modifications.execute(f, dom)
+            if new_errors:
+                errors.update(new_errors)
+            data = dom.toxml('UTF-8')
+            if getattr(modifications, "flux", None):
+                chemins[f] = EcritPartieEnFlux(data, modifications.flux)
+                modifications.flux = []
+                data = None
+        else:
+            data = modele.GetXml(f)
+        files.append((f, data))
     
-    for f in zip.namelist():
+    for f, data in modele.files:
         if not f in XML_FILES:
-            data = zip.read(f)
             files.append((f, data))
             
-    zip.close()
     zip = zipfile.ZipFile(filename, 'w')
     if gauge:
         gauge.SetValue(95)
     for f, data in files:
-        zip.writestr(f, data)
+        if f in chemins:
+            zip.write(chemins[f], f)
+            os.remove(chemins[f])
+        else:
+            zip.writestr(f, data)
     zip.close()
     if gauge:
         gauge.SetValue(100)
@@ -419,26 +521,9 @@ def save_current_document(filename):
     return 1
     
 def convert_to_pdf(filename, pdffilename):
-    # print filename, pdffilename
-    if filename.endswith("ods"):
-        filtername = "calc_pdf_Export"
-    else:
-        filtername = "writer_pdf_Export"
-    if sys.platform == 'win32':
-        filename = ''.join(["file:", urllib.pathname2url(unicode(os.path.abspath(filename)).encode("utf8"))])
-        pdffilename = ''.join(["file:", urllib.pathname2url(unicode(os.path.abspath(pdffilename)).encode("utf8"))])
-        StarDesktop, objServiceManager, corereflection = getOOoContext()
-        document = StarDesktop.LoadComponentFromURL(filename, "_blank", 0,
-            MakePropertyValues(objServiceManager,
-                        [["ReadOnly", True],
-                        ["Hidden", True]]))
-        document.storeToUrl( pdffilename,
-            MakePropertyValues(objServiceManager,
-                        [["CompressMode", 1],
-                        ["FilterName", filtername]]))
-        document.close(False)
-    else:
-        shutil.copy(filename, pdffilename)
+    echecs = ConvertitPDF([(filename, pdffilename)])
+    if echecs:
+        raise echecs[filename]
 
 DDE_ACROBAT_STRINGS = ["AcroviewR11", "AcroviewR10", "acroview"]
 dde_server = None
@@ -476,11 +561,139 @@ def GenerateDocument(modifications, filename, gauge=None):
         return GenerateOODocument(modifications, filename, gauge)
     else:
         return GenerateTextDocument(modifications, filename, gauge)
+
+# travaux de generation en cours : le timer de la fenetre principale ne touche pas a la base
+# (Flush, Update) tant que cet ensemble n'est pas vide
+travaux_en_cours = set()
+
+class TravailDocuments(object):
+    # generation d'une serie de documents (conversion PDF et envoi par email compris) hors du thread
+    # de l'interface : la progression et les erreurs de chaque document sont transmises par callback,
+    # une annulation est prise en compte entre deux documents et une reprise saute les documents
+    # deja termines
+    def __init__(self, documents, pdf=False, envoi=None, callback=None):
+        self.documents = documents
+        self.pdf = pdf
+        self.envoi = envoi
+        self.callback = callback
+        self.termines = set()
+        self.erreurs = {}
+        self.annule = False
+        self.en_cours = False
+
+    def GetFilename(self, filename):
+        if self.pdf:
+            return os.path.splitext(filename)[0] + ".pdf"
+        else:
+            return filename
+
+    def GetErrors(self):
+        errors = {}
+        for index in sorted(self.erreurs):
+            errors.update(self.erreurs[index])
+        return errors
+
+    def IsTermine(self):
+        return len(self.termines) == len(self.documents)
+
+    def Notifie(self, valeur, message=None, errors=None, fin=False):
+        if self.callback:
+            self.callback(valeur, message, errors, fin)
+
+    def SetValue(self, valeur):
+        # jauge de GenerateDocument quand la serie ne compte qu'un document
+        self.Notifie(valeur)
+
+    def Annule(self):
+        self.annule = True
+
+    def Demarre(self):
+        self.en_cours = True
+        travaux_en_cours.add(self)
+        try:
+            thread.start_new_thread(self.Thread, ())
+        except:
+            travaux_en_cours.discard(self)
+            raise
+
+    def Thread(self):
+        if sys.platform == 'win32':
+            # convert_to_pdf passe par COM
+            import pythoncom
+            pythoncom.CoInitialize()
+        try:
+            self.Execute()
+        finally:
+            self.en_cours = False
+            travaux_en_cours.discard(self)
+
+    def Execute(self):
+        self.annule = False
+        self.en_cours = True
+        count = len(self.documents)
+        restants = [i for i in range(count) if i not in self.termines]
+        # les documents sont generes par lots, chaque lot est converti en PDF en une fois
+        for debut in range(0, len(restants), conversion.TAILLE_LOT):
+            lot = []
+            for i in restants[debut:debut+conversion.TAILLE_LOT]:
+                if self.annule:
+                    break
+                filename, modifications = self.documents[i]
+                self.Notifie((100 * i) / count, u"Document %d/%d : %s" % (i+1, count, os.path.basename(self.GetFilename(filename))))
+                self.erreurs[i] = errors = {}
+                try:
+                    if count == 1:
+                        gauge = self
+                    else:
+                        gauge = None
+                    new_errors = GenerateDocument(modifications, filename=filename, gauge=gauge)
+                    if new_errors:
+                        errors.update(new_errors)
+                    lot.append(i)
+                except IOError:
+                    errors[self.GetFilename(filename)] = [u"Impossible de sauver le document. Peut-être est-il déjà ouvert ?"]
+                    self.Notifie((100 * (i+1)) / count, errors=errors)
+                except Exception:
+                    info = sys.exc_info()
+                    errors[self.GetFilename(filename)] = [' [type: %s value: %s traceback: %s]' % (info[0], info[1], traceback.extract_tb(info[2]))]
+                    self.Notifie((100 * (i+1)) / count, errors=errors)
+
+            if self.pdf and lot:
+                echecs = ConvertitPDF([(self.documents[i][0], self.GetFilename(self.documents[i][0])) for i in lot])
+                for i in lot[:]:
+                    filename = self.documents[i][0]
+                    if filename in echecs:
+                        self.erreurs[i][self.GetFilename(filename)] = [u"Conversion en PDF impossible\n%r" % echecs[filename]]
+                        lot.remove(i)
+                        self.Notifie((100 * (i+1)) / count, errors=self.erreurs[i])
+                    else:
+                        # le document ODF reste disponible quand sa conversion a echoue
+                        os.remove(filename)
+
+            for i in lot:
+                filename, modifications = self.documents[i]
+                try:
+                    if self.envoi:
+                        self.envoi(self.GetFilename(filename), modifications)
+                    self.termines.add(i)
+                except Exception, e:
+                    self.erreurs[i][self.GetFilename(filename)] = [u"Impossible d'envoyer le document\n%r" % e]
+                self.Notifie((100 * (i+1)) / count, errors=self.erreurs[i])
+
+            if self.annule:
+                break
+
+        self.en_cours = False
+        if count:
+            self.Notifie((100 * len(self.termines)) / count, fin=True)
+        else:
+            self.Notifie(100, fin=True)
                            
 class DocumentDialog(wx.Dialog):
     def __init__(self, parent, modifications):
         self.modifications = modifications
         self.document_generated = False
+        self.travail = None
 
         # Instead of calling wx.Dialog.__init__ we precreate the dialog
         # so we can set an extra style that must be set before
@@ -501,7 +714,7 @@ class DocumentDialog(wx.Dialog):
         sizer.Add(wx.StaticText(self, -1, "Format :"), 0, wx.ALIGN_CENTER_VERTICAL|wx.RIGHT, 5)
         if not IsOODocument(modifications.template):
             self.format = wx.Choice(self, -1, choices=["Texte"])
-        elif sys.platform == 'win32':
+        elif GetConvertisseur():
             self.format = wx.Choice(self, -1, choices=["OpenOffice", "PDF"])
         else:
             self.format = wx.Choice(self, -1, choices=["OpenOffice"])
@@ -522,30 +735,38 @@ class DocumentDialog(wx.Dialog):
         sizer.Add(self.fbb, 0, wx.GROW|wx.ALIGN_CENTER_VERTICAL|wx.LEFT, 5)
         self.sizer.Add(sizer, 0, wx.GROW|wx.ALIGN_CENTER_VERTICAL|wx.ALL, 5)
         
+        self.etat = wx.StaticText(self, -1, "")
+        self.sizer.Add(self.etat, 0, wx.GROW|wx.ALIGN_CENTER_VERTICAL|wx.RIGHT|wx.LEFT|wx.TOP, 5)
         self.gauge = wx.Gauge(self, -1, size=(-1,10))
         self.gauge.SetRange(100)
         self.sizer.Add(self.gauge, 0, wx.GROW|wx.ALIGN_CENTER_VERTICAL|wx.RIGHT|wx.LEFT|wx.TOP, 5)
+        self.ProgressionEvent, EVT_PROGRESSION_EVENT = wx.lib.newevent.NewEvent()
+        self.Bind(EVT_PROGRESSION_EVENT, self.onProgression)
         
         line = wx.StaticLine(self, -1, size=(20,-1), style=wx.LI_HORIZONTAL)
         self.sizer.Add(line, 0, wx.GROW|wx.ALIGN_CENTER_VERTICAL|wx.TOP|wx.BOTTOM, 5)
         
         sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.boutons = []
         if modifications.multi is not True:
             self.sauver_ouvrir = wx.Button(self, -1, u"Sauver et ouvrir")
             self.sauver_ouvrir.SetDefault()
             self.Bind(wx.EVT_BUTTON, self.onSauverOuvrir, self.sauver_ouvrir)
             sizer.Add(self.sauver_ouvrir, 0, wx.LEFT|wx.RIGHT, 5)
+            self.boutons.append(self.sauver_ouvrir)
         else:
             self.sauver_ouvrir = None
 
         self.sauver = wx.Button(self, -1, u"Sauver")
         self.Bind(wx.EVT_BUTTON, self.onSauver, self.sauver)
         sizer.Add(self.sauver, 0, wx.RIGHT, 5)
+        self.boutons.append(self.sauver)
         
         if modifications.email:
             self.sauver_envoyer = wx.Button(self, -1, u"Sauver et envoyer par email")
             self.Bind(wx.EVT_BUTTON, self.onSauverEnvoyer, self.sauver_envoyer)
             sizer.Add(self.sauver_envoyer, 0, wx.LEFT|wx.RIGHT, 5)
+            self.boutons.append(self.sauver_envoyer)
             if modifications.multi is False and not modifications.email_to:
                 self.sauver_envoyer.Disable()
                 
@@ -553,9 +774,11 @@ class DocumentDialog(wx.Dialog):
                 self.sauver_envoyer = wx.Button(self, -1, u"Sauver et envoyer par email à la CAF")
                 self.Bind(wx.EVT_BUTTON, self.onSauverEnvoyerCAF, self.sauver_envoyer)
                 sizer.Add(self.sauver_envoyer, 0, wx.LEFT|wx.RIGHT, 5)
+                self.boutons.append(self.sauver_envoyer)
 
         #btnsizer.Add(self.ok)
         btn = wx.Button(self, wx.ID_CANCEL)
+        self.Bind(wx.EVT_BUTTON, self.onAnnuler, btn)
         sizer.Add(btn, 0, wx.RIGHT, 5)
         self.sizer.Add(sizer, 0, wx.ALIGN_CENTER_VERTICAL|wx.ALL, 5)
 
@@ -570,119 +793,108 @@ class DocumentDialog(wx.Dialog):
         else:
             self.fbb.SetValue(filename+".pdf", None)
             
-    def onSauver(self, event):
+    def onSauver(self, event, envoi=None, suite=None):
+        for bouton in self.boutons:
+            bouton.Disable()
         self.fbb.Disable()
-        self.sauver.Disable()
-        if self.sauver_ouvrir:
-            self.sauver_ouvrir.Disable()
-        self.filename = self.fbb.GetValue()
-        f, e = os.path.splitext(self.filename)
-        if e == ".pdf":
-            self.pdf = True
-            self.oo_filename = f + self.extension
-        else:
-            self.pdf = False
-            self.oo_filename = self.filename
-            
-        config.documents_directory = os.path.dirname(self.filename)
-        dlg = None
-        try:
+        if self.travail is None:
+            self.filename = self.fbb.GetValue()
+            f, e = os.path.splitext(self.filename)
+            if e == ".pdf":
+                self.pdf = True
+                self.oo_filename = f + self.extension
+            else:
+                self.pdf = False
+                self.oo_filename = self.filename
+
+            config.documents_directory = os.path.dirname(self.filename)
             if self.modifications.multi is not False:
-                errors = { }
-                simple_modifications = self.modifications.GetSimpleModifications(self.oo_filename)
-                for i, (filename, modifs) in enumerate(simple_modifications):
-                    self.gauge.SetValue((100 * i) / len(simple_modifications))
-                    errors.update(GenerateDocument(modifs, filename=filename))
-                    if self.pdf:
-                        f, e = os.path.splitext(filename)
-                        convert_to_pdf(filename, f+".pdf")
-                        os.remove(filename)
+                documents = self.modifications.GetSimpleModifications(self.oo_filename)
             else:
                 self.filename = self.filename.replace(" <prenom> <nom>", "")
                 self.oo_filename = self.oo_filename.replace(" <prenom> <nom>", "")
-                errors = GenerateDocument(self.modifications, filename=self.oo_filename, gauge=self.gauge)
-                if self.pdf:
-                    convert_to_pdf(self.oo_filename, self.filename)
-                    os.remove(self.oo_filename)
-            self.document_generated = True
-            if errors:
-                message = u"Document %s généré avec des erreurs :\n" % self.filename
-                for label in errors.keys():
-                    message += '\n' + label + ' :\n  '
-                    message += '\n  '.join(errors[label])
-                dlg = wx.MessageDialog(self, message, 'Message', wx.OK|wx.ICON_WARNING)
-        except IOError:
-            print sys.exc_info()
-            dlg = wx.MessageDialog(self, u"Impossible de sauver le document. Peut-être est-il déjà ouvert ?", 'Erreur', wx.OK|wx.ICON_WARNING)
-            dlg.ShowModal()
-            dlg.Destroy()
+                documents = [(self.oo_filename, self.modifications)]
+            self.travail = TravailDocuments(documents, self.pdf, envoi, self.PostProgression)
+            self.suite = suite
+        self.travail.Demarre()
+
+    def PostProgression(self, valeur, message, errors, fin):
+        # appele depuis le thread de generation
+        wx.PostEvent(self, self.ProgressionEvent(valeur=valeur, message=message, errors=errors, fin=fin))
+
+    def onProgression(self, event):
+        self.gauge.SetValue(event.valeur)
+        if event.message:
+            self.etat.SetLabel(event.message)
+        if not event.fin:
             return
-        except Exception, e:
-            info = sys.exc_info()
-            message = ' [type: %s value: %s traceback: %s]' % (info[0], info[1], traceback.extract_tb(info[2]))
-            dlg = wx.MessageDialog(self, message, 'Erreur', wx.OK|wx.ICON_WARNING)
-        if dlg:
+
+        errors = self.travail.GetErrors()
+        if errors:
+            message = u"Document %s généré avec des erreurs :\n" % self.filename
+            for label in errors.keys():
+                message += '\n' + label + ' :\n  '
+                message += '\n  '.join(errors[label])
+            dlg = wx.MessageDialog(self, message, 'Message', wx.OK|wx.ICON_WARNING)
             dlg.ShowModal()
             dlg.Destroy()
+
+        if not self.travail.IsTermine():
+            # annulation ou echec d'une partie des documents : la serie peut etre reprise
+            self.etat.SetLabel(u"%d document(s) sur %d générés" % (len(self.travail.termines), len(self.travail.documents)))
+            self.sauver.SetLabel(u"Reprendre")
+            self.sauver.Enable()
+            self.sizer.Layout()
+            return
+
+        self.document_generated = True
+        if self.suite:
+            self.suite()
         self.EndModal(wx.ID_OK)
-        
+
+    def onAnnuler(self, event):
+        if self.travail and self.travail.en_cours:
+            self.travail.Annule()
+            self.etat.SetLabel(u"Annulation ...")
+        else:
+            event.Skip()
+
     def onSauverOuvrir(self, event):
         self.modifications.multi = False
-        self.onSauver(event)
-        if self.document_generated:
-            if self.filename.endswith("pdf"):
-                result = pdf_open(self.filename)
-            else:
-                result = oo_open(self.filename)
-            if not result:
-                dlg = wx.MessageDialog(self, "Impossible d'ouvrir le document", 'Erreur', wx.OK|wx.ICON_WARNING)
-                dlg.ShowModal()
-                dlg.Destroy()
+        self.onSauver(event, suite=self.Ouvre)
+
+    def Ouvre(self):
+        if self.filename.endswith("pdf"):
+            result = pdf_open(self.filename)
+        else:
+            result = oo_open(self.filename)
+        if not result:
+            dlg = wx.MessageDialog(self, "Impossible d'ouvrir le document", 'Erreur', wx.OK|wx.ICON_WARNING)
+            dlg.ShowModal()
+            dlg.Destroy()
                 
     def onSauverEnvoyer(self, event):
-        self.onSauver(event)
-        if self.document_generated:
-            if self.modifications.multi is not False:
-                simple_modifications = self.modifications.GetSimpleModifications(self.oo_filename)
-                emails = '\n'.join([" - %s (%s)" % (modifs.email_subject, ", ".join(modifs.email_to)) for filename, modifs in simple_modifications])
-                if len(emails) > 1000:
-                    emails = emails[:1000] + "\n..."
-                dlg = wx.MessageDialog(self, u"Ces emails seront envoyés :\n" + emails, 'Confirmation', wx.OK|wx.CANCEL|wx.ICON_WARNING)
-                response = dlg.ShowModal()
-                dlg.Destroy()
-                if response != wx.ID_OK:
-                    return
-                
-                for filename, modifs in simple_modifications:
-                    if self.pdf:
-                        oo_filename = filename
-                        filename, e = os.path.splitext(oo_filename)
-                        filename += ".pdf"
-                    try:
-                        self.send_document(filename, GetTemplateFile(modifs.email_text), modifs.email_subject, modifs.email_to)
-                    except Exception, e:
-                        dlg = wx.MessageDialog(self, u"Impossible d'envoyer le document %s\n%r" % (filename, e), 'Erreur', wx.OK|wx.ICON_WARNING)
-                        dlg.ShowModal()
-                        dlg.Destroy()
-            else:
-                try:
-                    self.send_document(self.filename, GetTemplateFile(self.modifications.email_text), self.modifications.email_subject, self.modifications.email_to)
-                except Exception, e:
-                    dlg = wx.MessageDialog(self, u"Impossible d'envoyer le document %s\n%r" % (self.filename, e), 'Erreur', wx.OK|wx.ICON_WARNING)
-                    dlg.ShowModal()
-                    dlg.Destroy()
-                    
+        if self.modifications.multi is not False:
+            simple_modifications = self.modifications.GetSimpleModifications(self.fbb.GetValue())
+            emails = '\n'.join([" - %s (%s)" % (modifs.email_subject, ", ".join(modifs.email_to)) for filename, modifs in simple_modifications])
+            if len(emails) > 1000:
+                emails = emails[:1000] + "\n..."
+            dlg = wx.MessageDialog(self, u"Ces emails seront envoyés :\n" + emails, 'Confirmation', wx.OK|wx.CANCEL|wx.ICON_WARNING)
+            response = dlg.ShowModal()
+            dlg.Destroy()
+            if response != wx.ID_OK:
+                return
+        self.onSauver(event, envoi=self.Envoie)
+
+    def Envoie(self, filename, modifications):
+        self.send_document(filename, GetTemplateFile(modifications.email_text), modifications.email_subject, modifications.email_to)
         
     def onSauverEnvoyerCAF(self, event):
         self.modifications.multi = False
-        self.onSauver(event)
-        if self.document_generated:
-            try:
-                self.send_document(self.filename, GetTemplateFile(self.modifications.email_text[:-4]+" CAF"+self.modifications.email_text[-4:]), self.modifications.email_subject, [creche.caf_email])
-            except Exception, e:
-                dlg = wx.MessageDialog(self, u"Impossible d'envoyer le document %s\n%r" % (self.filename, e), 'Erreur', wx.OK|wx.ICON_WARNING)
-                dlg.ShowModal()
-                dlg.Destroy()
+        self.onSauver(event, envoi=self.EnvoieCAF)
+
+    def EnvoieCAF(self, filename, modifications):
+        self.send_document(filename, GetTemplateFile(modifications.email_text[:-4]+" CAF"+modifications.email_text[-4:]), modifications.email_subject, [creche.caf_email])
 
     def send_document(self, filename, text, subject, to):
         COMMASPACE = ', '
@@ -662,10 +662,11 @@ class ReferencePlanningPanel(PlanningWidget):
     def CheckDate(self, date, plages):
         capacite = creche.GetCapacite(date.weekday())
         lines = GetLines(date, creche.inscrits)
-        activites, activites_sans_horaires = GetActivitiesSummary(creche, lines)
+        occupation, activites_sans_horaires = GetOccupationActivites(creche, lines)
+        depassements = occupation.GetDepassements((0, 0), capacite)
         for start, end in plages:                        
-            for i in range(start, end):
-                if activites[0][i][0] > capacite:
+            for i in depassements:
+                if i >= start and i < end:
                     return False
         return True
    
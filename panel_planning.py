@@ -24,6 +24,7 @@ from controls import *
 from planning import PlanningWidget, LigneConge, COMMENTS, ACTIVITES, TWO_PARTS, DEPASSEMENT_CAPACITE, SUMMARY_NUM, SUMMARY_DEN
 from ooffice import *
 from doc_planning_detaille import PlanningDetailleModifications
+from tablette import SynchroniseTablette
 
 class DayPlanningPanel(PlanningWidget):
     def __init__(self, parent, activity_combobox):
@@ -31,10 +32,11 @@ class DayPlanningPanel(PlanningWidget):
     
     def CheckLine(self, line, plages_selectionnees):
         lines = self.GetSummaryLines()
-        activites, activites_sans_horaires = GetActivitiesSummary(creche, lines)
+        occupation, activites_sans_horaires = GetOccupationActivites(creche, lines)
+        depassements = occupation.GetDepassements((0, 0), creche.GetCapacite(line.day))
         for start, end in plages_selectionnees:                        
-            for i in range(start, end):
-                if activites[0][i][0] > creche.GetCapacite(line.day):
+            for i in depassements:
+                if i >= start and i < end:
                     dlg = wx.MessageDialog(None, u"Dépassement de la capacité sur ce créneau horaire !", "Attention", wx.OK|wx.ICON_WARNING)
                     dlg.ShowModal()
                     dlg.Destroy()
@@ -318,99 +320,8 @@ class PlanningPanel(GPanel):
         self.OnChangementSemaine()
 
     def onTabletteSynchro(self, evt):
-        journal = config.connection.LoadJournal()
-        
-        class PeriodePresence(object):
-            def __init__(self, date, arrivee=None, depart=None, absent=False, malade=False):
-                self.date = date
-                self.arrivee = arrivee
-                self.depart = depart
-                self.absent = absent
-                self.malade = malade
-        
-        array = {}
-        lines = journal.split("\n")
-        
-        index = -1
-        if len(creche.last_tablette_synchro) > 20:
-            try:
-                index = lines.index(creche.last_tablette_synchro)
-            except:
-                pass
-
-        for line in lines[index+1:]:
-            try:
-                label, idx, date = line.split()
-                idx = int(idx)
-                tm = time.strptime(date, "%Y-%m-%d@%H:%M")
-                date = datetime.date(tm.tm_year, tm.tm_mon, tm.tm_mday)
-                if idx not in array:
-                    array[idx] = []
-                if label == "arrivee":
-                    arrivee = tm.tm_hour * 12 + tm.tm_min / creche.granularite * (creche.granularite/BASE_GRANULARITY)
-                    array[idx].append(PeriodePresence(date, arrivee))
-                elif label == "depart":
-                    depart = tm.tm_hour * 12 + (tm.tm_min+creche.granularite-1) / creche.granularite * (creche.granularite/BASE_GRANULARITY)
-                    if len(array[idx]):
-                        last = array[idx][-1]
-                        if last.date == date and last.arrivee:
-                            last.depart = depart
-                        else:
-                            array[idx].append(PeriodePresence(date, None, depart))
-                    else:
-                        array[idx].append(PeriodePresence(date, None, depart))
-                elif label == "absent":
-                    array[idx].append(PeriodePresence(date, absent=True))
-                elif label == "malade":
-                    array[idx].append(PeriodePresence(date, malade=True))
-                    
-                creche.last_tablette_synchro = line
-            except Exception, e:
-                pass
-        
-        errors = []            
-        for key in array:
-            inscrit = creche.GetInscrit(key)
-            if inscrit:
-                for periode in array[key]:
-                    value = 0
-                    if periode.absent:
-                        value = VACANCES
-                    elif periode.malade:
-                        value = MALADE
-                    elif not periode.arrivee:
-                        if not date in inscrit.journees:
-                            errors.append(u"%s : Pas d'arrivée enregistrée le %s" % (GetPrenomNom(inscrit), periode.date))
-                        reference = inscrit.GetJournee(periode.date)
-                        if reference:
-                            periode.arrivee = reference.GetPlageHoraire()[0]
-                            if periode.arrivee is None:
-                                periode.arrivee = int(creche.ouverture*(60 / BASE_GRANULARITY))
-                        else:
-                            continue
-                    elif not periode.depart:
-                        if periode.date != today:
-                            errors.append(u"%s : Pas de départ enregistré le %s" % (GetPrenomNom(inscrit), periode.date))
-                        reference = inscrit.GetJournee(date)
-                        if reference:
-                            periode.depart = reference.GetPlageHoraire()[-1]
-                            if periode.depart is None:
-                                periode.depart = int(creche.fermeture*(60 / BASE_GRANULARITY))
-                        else:
-                            continue
-                    
-                    if periode.date in inscrit.journees:
-                        inscrit.journees[periode.date].RemoveActivities(0)
-                        inscrit.journees[periode.date].RemoveActivities(0|PREVISIONNEL)
-                    else:
-                        inscrit.journees[periode.date] = Journee(inscrit, periode.date)
-                    if value < 0:
-                        inscrit.journees[periode.date].SetState(value)
-                    else:
-                        inscrit.journees[periode.date].SetActivity(periode.arrivee, periode.depart, value)
-                    history.Append(None)
-            else:
-                errors.append(u"Inscrit %d: Inconnu!" % key)
+        errors = SynchroniseTablette(config.connection)
+        history.Append(None)
         if errors:
             dlg = wx.MessageDialog(None, u"\n".join(errors), u'Erreurs de saisie tablette', wx.OK|wx.ICON_WARNING)
             dlg.ShowModal()
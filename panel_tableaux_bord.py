@@ -39,7 +39,7 @@ from doc_synthese_financiere import SyntheseFinanciereModifications
 from doc_releve_salaries import ReleveSalariesModifications
 from doc_etat_presence_mensuel import EtatPresenceMensuelModifications
 from doc_commande_repas import CommandeRepasModifications
-from facture import Facture
+from facture import Facture, CalculeFactures
 from planning import *
 from sqlobjects import Day
 
@@ -68,8 +68,10 @@ class SitesPlanningPanel(PlanningWidget):
                 for start, end, value in creche.tranches_capacite[week_day].activites:
                     for i in range(start, end):
                         site_line[i][0] = value
+                day_lines[None] = site_line
                 lines.append(site_line)
             
+            tranches = []
             for inscrit in creche.inscrits:
                 if date not in inscrit.jours_conges:
                     inscription = inscrit.GetInscription(date)
@@ -80,13 +82,20 @@ class SitesPlanningPanel(PlanningWidget):
                             line = inscrit.GetJourneeReference(date)
                         if len(creche.sites) > 1:
                             if inscription.site and inscription.site in day_lines:
-                                site_line = day_lines[inscription.site]
+                                site = inscription.site
                             else:
                                 continue
+                        else:
+                            site = None
                         for start, end, value in line.activites:
                             if value in (0, PREVISIONNEL):
-                                for i in range(start, end):
-                                    site_line[i][0] -= 1
+                                tranches.append((site, start, end))
+
+            presences = Occupation(tranches)
+            for site in day_lines:
+                site_line = day_lines[site]
+                for i, count in enumerate(presences[site]):
+                    site_line[i][0] -= count
 
         self.SetLines(lines)
 
@@ -123,21 +132,23 @@ class ReservatairesPlanningPanel(PlanningWidget):
             day_lines[None] = line
             lines.append(line)
             
+            tranches = []
             for inscrit in creche.inscrits:
                 if date not in inscrit.jours_conges:
                     inscription = inscrit.GetInscription(date)
                     if inscription is not None:
                         line = inscrit.GetJournee(date)
-                        if inscription.reservataire and inscription.reservataire in day_lines:
-                            reservataire_line = day_lines[inscription.reservataire]
-                        else:
-                            reservataire_line = None
                         for start, end, value in line.activites:
                             if value in (0, PREVISIONNEL):
-                                for i in range(start, end):
-                                    day_lines[None][i][0] -= 1
-                                    if reservataire_line is not None:
-                                        reservataire_line[i][0] -= 1
+                                tranches.append((None, start, end))
+                                if inscription.reservataire and inscription.reservataire in day_lines:
+                                    tranches.append((inscription.reservataire, start, end))
+
+            presences = Occupation(tranches)
+            for reservataire in day_lines:
+                line = day_lines[reservataire]
+                for i, count in enumerate(presences[reservataire]):
+                    line[i][0] -= count
 
         self.SetLines(lines)
 
@@ -597,30 +608,35 @@ class StatistiquesFrequentationTab(AutoTab):
             fin = GetMonthEnd(debut)
             heures_accueil += GetHeuresAccueil(annee, mois+1, site)
             print "Statistiques %s %d" % (months[mois], annee)
+            inscrits = []
             for inscrit in creche.inscrits:
                 try:
                     inscriptions = inscrit.GetInscriptions(debut, fin)
                     if inscriptions and (site is None or inscriptions[0].site == site):
-                        facture = Facture(inscrit, annee, mois+1)
-                        heures_contrat += facture.heures_contrat
-                        heures_facture += facture.heures_facture
-                        heures_contractualisees += facture.heures_contractualisees
-                        heures_realisees += facture.heures_realisees
-                        heures_facturees += facture.heures_facturees
-                        cotisations_contractualisees += facture.total_contractualise
-                        cotisations_realisees += facture.total_realise
-                        cotisations_facturees += facture.total_facture
-                        total += facture.total
-                        print inscrit.prenom, inscrit.nom, facture.date
-                        print ' ', u"heures contractualisées :", facture.heures_contractualisees, facture.heures_contrat
-                        print ' ', u"heures réalisées :", facture.heures_realisees
-                        print ' ', u"heures facturées :", facture.heures_facturees, facture.heures_facture
-                        print ' ', u"total contractualisé", facture.total_contractualise
-                        print ' ', u"total réalisé :", facture.total_realise
-                        print ' ', u"total facturé :", facture.total_facture
-                        
+                        inscrits.append(inscrit)
                 except Exception, e:
                     erreurs.append((inscrit, e))
+            for facture in CalculeFactures(inscrits, annee, mois+1):
+                inscrit = facture.inscrit
+                if facture.errors:
+                    erreurs.append((inscrit, u"\n".join(facture.errors)))
+                else:
+                    heures_contrat += facture.heures_contrat
+                    heures_facture += facture.heures_facture
+                    heures_contractualisees += facture.heures_contractualisees
+                    heures_realisees += facture.heures_realisees
+                    heures_facturees += facture.heures_facturees
+                    cotisations_contractualisees += facture.total_contractualise
+                    cotisations_realisees += facture.total_realise
+                    cotisations_facturees += facture.total_facture
+                    total += facture.total
+                    print inscrit.prenom, inscrit.nom, facture.date
+                    print ' ', u"heures contractualisées :", facture.heures_contractualisees, facture.heures_contrat
+                    print ' ', u"heures réalisées :", facture.heures_realisees
+                    print ' ', u"heures facturées :", facture.heures_facturees, facture.heures_facture
+                    print ' ', u"total contractualisé", facture.total_contractualise
+                    print ' ', u"total réalisé :", facture.total_realise
+                    print ' ', u"total facturé :", facture.total_facture
                               
         if erreurs:
             msg = u"\n\n".join([u"%s %s:\n%s" % (inscrit.prenom, inscrit.nom, unicode(erreur)) for inscrit, erreur in erreurs])
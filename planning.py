@@ -821,6 +821,7 @@ class PlanningSummaryPanel(BufferedWindow):
 
         debut = int(creche.affichage_min * (60 / BASE_GRANULARITY))
         fin = int(creche.affichage_max * (60 / BASE_GRANULARITY))
+        capacite = creche.GetCapacite()
         x = debut
         v, w = 0, 0
         a = 0
@@ -830,7 +831,7 @@ class PlanningSummaryPanel(BufferedWindow):
             else:
                 nv, nw = line[x]
 
-            if (self.options & TWO_PARTS) and activity == 0 and (nw == 0 or nv > creche.GetCapacite() or float(nv)/nw > 6.5):
+            if (self.options & TWO_PARTS) and activity == 0 and (nw == 0 or nv > capacite or float(nv)/nw > 6.5):
                 nw = activity|SUPPLEMENT
             else:
                 nw = activity
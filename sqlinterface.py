@@ -15,7 +15,7 @@
 ##    You should have received a copy of the GNU General Public License
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
-import os, datetime, __builtin__
+import os, datetime, time, __builtin__
 try:
     import sqlite3
 except:
@@ -25,7 +25,40 @@ from sqlobjects import *
 from facture import FactureCloturee
 import wx
 
-VERSION = 87
+VERSION = 90
+
+# les UPDATE des objets sont regroupes et ecrits au prochain Flush (option "ecriture-immediate" pour desactiver)
+ECRITURE_DIFFEREE = True
+
+# seules les journees a partir de first_date sont chargees au demarrage, les plus anciennes sont
+# lues mois par mois a la demande (option "chargement-complet" pour tout charger)
+CHARGEMENT_PARTIEL = True
+
+# attente maximale (en secondes) d'un verrou pose par un autre poste sur une base partagee
+BUSY_TIMEOUT = 30
+
+# nombre de revisions conservees dans la table REVISIONS (rechargement incremental)
+REVISIONS_CONSERVEES = 10000
+
+# tables dont les modifications sont rechargees en place, avec la colonne de la personne concernee
+TABLES_JOURNEES = {"ACTIVITES": "inscrit", "COMMENTAIRES": "inscrit", "ACTIVITES_SALARIES": "salarie"}
+
+INDEXES = [("IDX_ACTIVITES_INSCRIT_DATE", "ACTIVITES", "inscrit, date"),
+           ("IDX_ACTIVITES_SALARIES_SALARIE_DATE", "ACTIVITES_SALARIES", "salarie, date"),
+           ("IDX_COMMENTAIRES_INSCRIT_DATE", "COMMENTAIRES", "inscrit, date"),
+           ("IDX_FACTURES_INSCRIT_DATE", "FACTURES", "inscrit, date"),
+           ("IDX_CORRECTIONS_INSCRIT_DATE", "CORRECTIONS", "inscrit, date"),
+           ("IDX_REF_ACTIVITIES_REFERENCE", "REF_ACTIVITIES", "reference"),
+           ("IDX_REF_JOURNEES_SALARIES_REFERENCE", "REF_JOURNEES_SALARIES", "reference"),
+           ("IDX_INSCRIPTIONS_INSCRIT", "INSCRIPTIONS", "inscrit"),
+           ("IDX_PARENTS_INSCRIT", "PARENTS", "inscrit"),
+           ("IDX_REVENUS_PARENT", "REVENUS", "parent"),
+           ("IDX_FRATRIES_INSCRIT", "FRATRIES", "inscrit"),
+           ("IDX_REFERENTS_INSCRIT", "REFERENTS", "inscrit"),
+           ("IDX_CONGES_INSCRITS_INSCRIT", "CONGES_INSCRITS", "inscrit"),
+           ("IDX_CONTRATS_EMPLOYE", "CONTRATS", "employe"),
+           ("IDX_CONGES_SALARIES_SALARIE", "CONGES_SALARIES", "salarie"),
+          ]
 
 def getdate(s):
     if s is None:
@@ -34,19 +67,42 @@ def getdate(s):
     return datetime.date(annee, mois, jour)
 
 class SQLConnection(object):
-    def __init__(self, filename):
+    def __init__(self, filename, journal_mode=None):
         self.filename = filename
+        # journal_mode ("WAL", "DELETE") pour une base ouverte en direct par plusieurs postes
+        self.journal_mode = journal_mode
         self.con = None
+        self.ecriture_differee = ECRITURE_DIFFEREE
+        self.modifications = {}
+        # journal des requetes de modification (cmd, args), pour la synchronisation par differences
+        self.journal = None
+        self.converti = False
+        # derniere revision de la base chargee en memoire
+        self.revision = 0
 
     def open(self):
-        self.con = sqlite3.connect(self.filename)
+        # les documents sont generes dans un thread de travail (voir ooffice.TravailDocuments) ;
+        # le timer de la fenetre principale suspend Flush/Update tant qu'un travail est en cours
+        if self.journal_mode:
+            self.con = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            self.con.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+        else:
+            self.con = sqlite3.connect(self.filename, check_same_thread=False)
+
+    def GetDataVersion(self):
+        # change a chaque modification de la base validee par une autre connexion
+        if self.con is None:
+            self.open()
+        return self.con.execute("PRAGMA data_version").fetchone()[0]
 
     def commit(self):
         if self.con:
+            self.Flush()
             self.con.commit()
 
     def close(self):
         if self.con:
+            self.Flush()
             self.con.commit()
             self.con.close()
             self.con = None
@@ -54,10 +110,68 @@ class SQLConnection(object):
     def cursor(self):
         if self.con is None:
             self.open()
+        self.Flush()
         return self.con.cursor()
 
     def execute(self, cmd, *args):
-        return self.con.execute(cmd, *args)
+        self.Flush()
+        result = self.con.execute(cmd, *args)
+        if self.journal is not None and cmd.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self.journal.append((cmd, args[0] if args else ()))
+        return result
+
+    def UpdateField(self, table, name, value, idx=None):
+        # idx None pour les tables a un seul enregistrement (CRECHE)
+        if self.ecriture_differee:
+            self.modifications.setdefault((table, idx), {})[name] = value
+        elif idx is None:
+            self.execute('UPDATE %s SET %s=?' % (table, name), (value,))
+        else:
+            self.execute('UPDATE %s SET %s=? WHERE idx=?' % (table, name), (value, idx))
+
+    def Flush(self):
+        # une requete par table et jeu de champs modifies, toutes dans la transaction en cours
+        if self.con is None or not self.modifications:
+            return
+        requetes = {}
+        for (table, idx), champs in self.modifications.items():
+            names = sorted(champs.keys())
+            values = [champs[name] for name in names]
+            requete = 'UPDATE %s SET %s' % (table, ', '.join(['%s=?' % name for name in names]))
+            if idx is not None:
+                requete += ' WHERE idx=?'
+                values.append(idx)
+            requetes.setdefault(requete, []).append(values)
+        print 'update', sum(len(champs) for champs in self.modifications.values()), 'champs'
+        # en cas d'erreur (base verrouillee par un autre poste...), les modifications restent en attente
+        for requete in requetes:
+            self.con.executemany(requete, requetes[requete])
+        self.modifications = {}
+        if self.journal is not None:
+            for requete in requetes:
+                self.journal.extend([(requete, values) for values in requetes[requete]])
+
+    def ApplyChangeset(self, changes):
+        # rejoue les modifications d'une autre base, sans les journaliser
+        if self.con is None:
+            self.open()
+        self.Flush()
+        for cmd, args in changes:
+            self.con.execute(cmd, args)
+        self.con.commit()
+
+    def SelectGroupBy(self, cur, table, key, fields, progress_handler=None, where="", args=()):
+        # une seule requete par table, les lignes sont regroupees par cle etrangere
+        start = time.time()
+        cur.execute('SELECT %s, %s FROM %s %s' % (key, fields, table, where), args)
+        result = {}
+        count = 0
+        for entry in cur.fetchall():
+            result.setdefault(entry[0], []).append(entry[1:])
+            count += 1
+        if progress_handler:
+            progress_handler.display(u"Table %s : %d enregistrements (%.3fs)" % (table, count, time.time() - start))
+        return result
 
     def Create(self, progress_handler=default_progress_handler):
         if not self.con:
@@ -115,6 +229,7 @@ class SQLConnection(object):
             gestion_depart_anticipe BOOLEAN,
             alerte_depassement_planning BOOLEAN,
             last_tablette_synchro VARCHAR,
+            last_tablette_offset INTEGER,
             changement_groupe_auto BOOLEAN,
             allergies VARCHAR,
             regularisation_fin_contrat BOOLEAN
@@ -493,8 +608,8 @@ class SQLConnection(object):
         for label in ("Week-end", "1er janvier", "1er mai", "8 mai", "14 juillet", u"15 août", "1er novembre", "11 novembre", u"25 décembre", u"Lundi de Pâques", "Jeudi de l'Ascension"):
             cur.execute("INSERT INTO CONGES (idx, debut) VALUES (NULL, ?)", (label, ))
         cur.execute("INSERT INTO DATA (key, value) VALUES (?, ?)", ("VERSION", VERSION))
-        cur.execute('INSERT INTO CRECHE(idx, nom, adresse, code_postal, ville, telephone, ouverture, fermeture, affichage_min, affichage_max, granularite, preinscriptions, presences_previsionnelles, presences_supplementaires, modes_inscription, minimum_maladie, email, type, periode_revenus, mode_facturation, temps_facturation, repartition, conges_inscription, tarification_activites, traitement_maladie, facturation_jours_feries, facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, gestion_alertes, age_maximum, seuil_alerte_inscription, cloture_factures, arrondi_heures, arrondi_facturation, arrondi_heures_salaries, gestion_maladie_hospitalisation, tri_planning, smtp_server, caf_email, mode_accueil_defaut, gestion_absences_non_prevenues, gestion_maladie_sans_justificatif, gestion_preavis_conges, gestion_depart_anticipe, alerte_depassement_planning, last_tablette_synchro, changement_groupe_auto, allergies, regularisation_fin_contrat) VALUES (NULL,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
-                     ("","","","","",7.75,18.5,7.75,19.0,15,False,False,True,MODE_HALTE_GARDERIE + MODE_4_5 + MODE_3_5,3,"",TYPE_PARENTAL,REVENUS_YM2,FACTURATION_PSU,FACTURATION_FIN_MOIS,REPARTITION_MENSUALISATION_12MOIS,0,0,DEDUCTION_MALADIE_AVEC_CARENCE_JOURS_OUVRES,JOURS_FERIES_NON_DEDUITS,PERIODE_ADAPTATION_FACTUREE_NORMALEMENT,"None","None",False,3,3,False,SANS_ARRONDI,SANS_ARRONDI,SANS_ARRONDI,False,0,"","",0,False,False,False,False,False,"",False,"",True))
+        cur.execute('INSERT INTO CRECHE(idx, nom, adresse, code_postal, ville, telephone, ouverture, fermeture, affichage_min, affichage_max, granularite, preinscriptions, presences_previsionnelles, presences_supplementaires, modes_inscription, minimum_maladie, email, type, periode_revenus, mode_facturation, temps_facturation, repartition, conges_inscription, tarification_activites, traitement_maladie, facturation_jours_feries, facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, gestion_alertes, age_maximum, seuil_alerte_inscription, cloture_factures, arrondi_heures, arrondi_facturation, arrondi_heures_salaries, gestion_maladie_hospitalisation, tri_planning, smtp_server, caf_email, mode_accueil_defaut, gestion_absences_non_prevenues, gestion_maladie_sans_justificatif, gestion_preavis_conges, gestion_depart_anticipe, alerte_depassement_planning, last_tablette_synchro, last_tablette_offset, changement_groupe_auto, allergies, regularisation_fin_contrat) VALUES (NULL,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                     ("","","","","",7.75,18.5,7.75,19.0,15,False,False,True,MODE_HALTE_GARDERIE + MODE_4_5 + MODE_3_5,3,"",TYPE_PARENTAL,REVENUS_YM2,FACTURATION_PSU,FACTURATION_FIN_MOIS,REPARTITION_MENSUALISATION_12MOIS,0,0,DEDUCTION_MALADIE_AVEC_CARENCE_JOURS_OUVRES,JOURS_FERIES_NON_DEDUITS,PERIODE_ADAPTATION_FACTUREE_NORMALEMENT,"None","None",False,3,3,False,SANS_ARRONDI,SANS_ARRONDI,SANS_ARRONDI,False,0,"","",0,False,False,False,False,False,"",0,False,"",True))
         cur.execute('INSERT INTO BAREMESCAF (idx, debut, fin, plancher, plafond) VALUES (NULL,?,?,?,?)', (datetime.date(2006, 9, 1), datetime.date(2007, 8, 31),  6547.92, 51723.60))
         cur.execute('INSERT INTO BAREMESCAF (idx, debut, fin, plancher, plafond) VALUES (NULL,?,?,?,?)', (datetime.date(2007, 9, 1), datetime.date(2008, 12, 31), 6660.00, 52608.00))
         cur.execute('INSERT INTO BAREMESCAF (idx, debut, fin, plancher, plafond) VALUES (NULL,?,?,?,?)', (datetime.date(2009, 1, 1), datetime.date(2009, 12, 31), 6876.00, 53400.00))
@@ -512,8 +627,126 @@ class SQLConnection(object):
         cur.execute('INSERT INTO ACTIVITIES (idx, label, value, mode, couleur, couleur_supplement, couleur_previsionnel, tarif) VALUES(NULL,?,?,?,?,?,?,?)', (u"Vacances", -1, 0, str(vacances), str(vacances), str(vacances), .0))
         cur.execute('INSERT INTO ACTIVITIES (idx, label, value, mode, couleur, couleur_supplement, couleur_previsionnel, tarif) VALUES(NULL,?,?,?,?,?,?,?)', (u"Malade", -2, 0, str(malade), str(malade), str(malade), .0))
 
+        self.CreateIndexes(cur)
+        self.CreateTriggers(cur)
         self.con.commit()
 
+    def CreateIndexes(self, cur):
+        for name, table, columns in INDEXES:
+            cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" % (name, table, columns))
+        cur.execute("ANALYZE")
+
+    def CreateTriggers(self, cur):
+        # chaque ligne modifiee, quel que soit le chemin d'ecriture, est numerotee dans REVISIONS
+        cur.execute("""
+          CREATE TABLE IF NOT EXISTS REVISIONS (
+            revision INTEGER PRIMARY KEY AUTOINCREMENT,
+            tableau VARCHAR,
+            reference INTEGER,
+            date DATE
+          );""")
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT IN ('DATA', 'REVISIONS')")
+        for table, in cur.fetchall():
+            for operation, rows in (("INSERT", ["NEW"]), ("UPDATE", ["OLD", "NEW"]), ("DELETE", ["OLD"])):
+                if table in TABLES_JOURNEES:
+                    values = ["('%s', %s.%s, %s.date)" % (table, row, TABLES_JOURNEES[table], row) for row in rows]
+                else:
+                    values = ["('%s', NULL, NULL)" % table]
+                cur.execute("CREATE TRIGGER IF NOT EXISTS REVISIONS_%s_%s AFTER %s ON %s BEGIN %s END" % (table, operation, operation, table, " ".join(["INSERT INTO REVISIONS (tableau, reference, date) VALUES %s;" % value for value in values])))
+
+    def LoadModifications(self, creche):
+        # applique en place les modifications des autres connexions depuis la derniere revision lue
+        # retourne les objets modifies, ou None si un rechargement complet est necessaire
+        # les deux lectures ne sont pas dans la meme transaction : les entrees sont bornees par le
+        # maximum lu d'abord, une revision validee entre les deux sera lue la fois suivante
+        cur = self.cursor()
+        cur.execute('SELECT MIN(revision), MAX(revision) FROM REVISIONS')
+        minimum, maximum = cur.fetchone()
+        if maximum is None:
+            return []
+        if minimum > self.revision + 1 and self.revision < maximum:
+            # revisions deja purgees
+            return None
+        cur.execute('SELECT revision, tableau, reference, date FROM REVISIONS WHERE revision>? AND revision<=? AND revision NOT IN (SELECT revision FROM REVISIONS_LOCALES) ORDER BY revision', (self.revision, maximum))
+        entries = cur.fetchall()
+        journees = set()
+        for revision, tableau, reference, date in entries:
+            if tableau not in TABLES_JOURNEES:
+                return None
+            journees.add((TABLES_JOURNEES[tableau], reference, date))
+        result = []
+        for colonne, reference, date in journees:
+            if colonne == "inscrit":
+                personne = creche.GetInscrit(reference)
+            else:
+                personne = creche.GetSalarie(reference)
+            if personne is None:
+                return None
+            self.LoadJournee(personne, date)
+            result.append(personne)
+        self.revision = maximum
+        cur.execute('DELETE FROM REVISIONS_LOCALES WHERE revision<=?', (maximum,))
+        return result
+
+    def LoadJournee(self, personne, date):
+        key = getdate(date)
+        journee = self.LoadJournees(personne, key, key + datetime.timedelta(1)).get(key)
+        if journee:
+            personne.journees[key] = journee
+        elif key in personne.journees:
+            del personne.journees[key]
+        if isinstance(personne, Inscrit):
+            InvalideCalculs(personne, key, True)
+
+    def LoadJournees(self, personne, debut, fin):
+        # journees d'un inscrit ou d'un salarie de debut (None pour toutes) a fin (exclue)
+        cur = self.cursor()
+        where, args = "date<?", [fin]
+        if debut:
+            where, args = "date>=? AND date<?", [debut, fin]
+        if isinstance(personne, Inscrit):
+            cur.execute('SELECT date, value, debut, fin, idx FROM ACTIVITES WHERE inscrit=? AND %s' % where, [personne.idx] + args)
+            activites = cur.fetchall()
+            cur.execute('SELECT date, commentaire, idx FROM COMMENTAIRES WHERE inscrit=? AND %s' % where, [personne.idx] + args)
+            commentaires = cur.fetchall()
+        else:
+            cur.execute('SELECT date, value, debut, fin, idx FROM ACTIVITES_SALARIES WHERE salarie=? AND %s' % where, [personne.idx] + args)
+            activites, commentaires = cur.fetchall(), []
+        result = {}
+        for date, value, start, end, idx in activites:
+            key = getdate(date)
+            if key not in result:
+                if isinstance(personne, Inscrit):
+                    result[key] = Journee(personne, key)
+                else:
+                    result[key] = JourneeSalarie(personne, key)
+            result[key].AddActivity(start, end, value, idx)
+        for date, commentaire, idx in commentaires:
+            key = getdate(date)
+            if key not in result:
+                result[key] = Journee(personne, key)
+            result[key].commentaire, result[key].commentaire_idx = commentaire, idx
+        return result
+
+    def CheckIndexes(self, progress_handler=default_progress_handler):
+        # une base mise a jour a la main peut ne pas avoir les index de la version 88
+        cur = self.cursor()
+        missing = []
+        for name, table, columns in INDEXES:
+            columns = [column.strip() for column in columns.split(",")]
+            found = False
+            cur.execute("PRAGMA index_list(%s)" % table)
+            for index in cur.fetchall():
+                cur.execute("PRAGMA index_info(%s)" % index[1])
+                if [info[2] for info in cur.fetchall()][:len(columns)] == columns:
+                    found = True
+                    break
+            if not found:
+                missing.append(name)
+        if missing and progress_handler:
+            progress_handler.display(u"Attention, index manquants dans la base (%s) : les performances seront dégradées" % ", ".join(missing))
+        return missing
+
     def Liste(self):
         con = sqlite3.connect(self.filename)
         cur = con.cursor()
@@ -527,16 +760,32 @@ class SQLConnection(object):
         if not self.translate(progress_handler):
             return None
 
+        self.CheckIndexes(progress_handler)
+
         if progress_handler:
             progress_handler.display(u"Chargement en mémoire de la base ...")
 
         cur = self.cursor()
+
+        if CHARGEMENT_PARTIEL:
+            debut_journees = first_date
+            where_journees, args_journees = "WHERE date>=?", (first_date,)
+        else:
+            debut_journees, where_journees, args_journees = None, "", ()
+
+        # les revisions ecrites par cette connexion ne sont pas rechargees par LoadModifications
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS REVISIONS_LOCALES (revision INTEGER PRIMARY KEY)")
+        cur.execute("CREATE TEMP TRIGGER IF NOT EXISTS REVISIONS_LOCALES_INSERT AFTER INSERT ON main.REVISIONS BEGIN INSERT INTO REVISIONS_LOCALES VALUES (NEW.revision); END")
+        cur.execute('SELECT MAX(revision) FROM REVISIONS')
+        self.revision = cur.fetchone()[0] or 0
+        cur.execute('DELETE FROM REVISIONS WHERE revision<=?', (self.revision - REVISIONS_CONSERVEES,))
+        self.con.commit()
             
-        cur.execute('SELECT nom, adresse, code_postal, ville, telephone, ouverture, fermeture, affichage_min, affichage_max, granularite, preinscriptions, presences_previsionnelles, presences_supplementaires, modes_inscription, minimum_maladie, email, type, periode_revenus, mode_facturation, repartition, temps_facturation, conges_inscription, tarification_activites, traitement_maladie, facturation_jours_feries, facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, gestion_alertes, age_maximum, seuil_alerte_inscription, cloture_factures, arrondi_heures, arrondi_facturation, arrondi_heures_salaries, gestion_maladie_hospitalisation, tri_planning, smtp_server, caf_email, mode_accueil_defaut, gestion_absences_non_prevenues, gestion_maladie_sans_justificatif, gestion_preavis_conges, gestion_depart_anticipe, alerte_depassement_planning, last_tablette_synchro, changement_groupe_auto, allergies, regularisation_fin_contrat, idx FROM CRECHE')
+        cur.execute('SELECT nom, adresse, code_postal, ville, telephone, ouverture, fermeture, affichage_min, affichage_max, granularite, preinscriptions, presences_previsionnelles, presences_supplementaires, modes_inscription, minimum_maladie, email, type, periode_revenus, mode_facturation, repartition, temps_facturation, conges_inscription, tarification_activites, traitement_maladie, facturation_jours_feries, facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, gestion_alertes, age_maximum, seuil_alerte_inscription, cloture_factures, arrondi_heures, arrondi_facturation, arrondi_heures_salaries, gestion_maladie_hospitalisation, tri_planning, smtp_server, caf_email, mode_accueil_defaut, gestion_absences_non_prevenues, gestion_maladie_sans_justificatif, gestion_preavis_conges, gestion_depart_anticipe, alerte_depassement_planning, last_tablette_synchro, last_tablette_offset, changement_groupe_auto, allergies, regularisation_fin_contrat, idx FROM CRECHE')
         creche_entry = cur.fetchall()
         if len(creche_entry) > 0:
             creche = Creche()
-            creche.nom, creche.adresse, creche.code_postal, creche.ville, creche.telephone, creche.ouverture, creche.fermeture, creche.affichage_min, creche.affichage_max, creche.granularite, creche.preinscriptions, creche.presences_previsionnelles, creche.presences_supplementaires, creche.modes_inscription, creche.minimum_maladie, creche.email, creche.type, creche.periode_revenus, creche.mode_facturation, creche.repartition, creche.temps_facturation, creche.conges_inscription, creche.tarification_activites, creche.traitement_maladie, creche.facturation_jours_feries, creche.facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, creche.gestion_alertes, creche.age_maximum, creche.seuil_alerte_inscription, creche.cloture_factures, creche.arrondi_heures, creche.arrondi_facturation, creche.arrondi_heures_salaries, creche.gestion_maladie_hospitalisation, creche.tri_planning, creche.smtp_server, creche.caf_email, creche.mode_accueil_defaut, creche.gestion_absences_non_prevenues, creche.gestion_maladie_sans_justificatif, creche.gestion_preavis_conges, creche.gestion_depart_anticipe, creche.alerte_depassement_planning, creche.last_tablette_synchro, creche.changement_groupe_auto, creche.allergies, creche.regularisation_fin_contrat, idx = creche_entry[0]
+            creche.nom, creche.adresse, creche.code_postal, creche.ville, creche.telephone, creche.ouverture, creche.fermeture, creche.affichage_min, creche.affichage_max, creche.granularite, creche.preinscriptions, creche.presences_previsionnelles, creche.presences_supplementaires, creche.modes_inscription, creche.minimum_maladie, creche.email, creche.type, creche.periode_revenus, creche.mode_facturation, creche.repartition, creche.temps_facturation, creche.conges_inscription, creche.tarification_activites, creche.traitement_maladie, creche.facturation_jours_feries, creche.facturation_periode_adaptation, formule_taux_horaire, formule_taux_effort, creche.gestion_alertes, creche.age_maximum, creche.seuil_alerte_inscription, creche.cloture_factures, creche.arrondi_heures, creche.arrondi_facturation, creche.arrondi_heures_salaries, creche.gestion_maladie_hospitalisation, creche.tri_planning, creche.smtp_server, creche.caf_email, creche.mode_accueil_defaut, creche.gestion_absences_non_prevenues, creche.gestion_maladie_sans_justificatif, creche.gestion_preavis_conges, creche.gestion_depart_anticipe, creche.alerte_depassement_planning, creche.last_tablette_synchro, creche.last_tablette_offset, creche.changement_groupe_auto, creche.allergies, creche.regularisation_fin_contrat, idx = creche_entry[0]
             creche.formule_taux_horaire, creche.formule_taux_effort, creche.idx = eval(formule_taux_horaire), eval(formule_taux_effort), idx
         else:
             creche = Creche()
@@ -625,32 +874,29 @@ class SQLConnection(object):
             else:
                 creche.activites[activity.value] = activity
                 
+        contrats = self.SelectGroupBy(cur, 'CONTRATS', 'employe', 'debut, fin, site, fonction, duree_reference, idx', progress_handler)
+        references_salaries = self.SelectGroupBy(cur, 'REF_JOURNEES_SALARIES', 'reference', 'day, value, debut, fin, idx', progress_handler)
+        activites_salaries = self.SelectGroupBy(cur, 'ACTIVITES_SALARIES', 'salarie', 'date, value, debut, fin, idx', progress_handler, where_journees, args_journees)
+        conges_salaries = self.SelectGroupBy(cur, 'CONGES_SALARIES', 'salarie', 'debut, fin, label, idx', progress_handler)
         cur.execute('SELECT prenom, nom, telephone_domicile, telephone_domicile_notes, telephone_portable, telephone_portable_notes, email, diplomes, idx FROM EMPLOYES')
         for salarie_entry in cur.fetchall():
             salarie = Salarie(creation=False)
             salarie.prenom, salarie.nom, salarie.telephone_domicile, salarie.telephone_domicile_notes, salarie.telephone_portable, salarie.telephone_portable_notes, salarie.email, salarie.diplomes, salarie.idx = salarie_entry
+            salarie.journees.debut = debut_journees
             creche.salaries.append(salarie)
-            cur.execute('SELECT debut, fin, site, fonction, duree_reference, idx FROM CONTRATS WHERE employe=?', (salarie.idx,))
-            for debut, fin, site_idx, fonction, duree_reference, idx in cur.fetchall():
+            for debut, fin, site_idx, fonction, duree_reference, idx in contrats.get(salarie.idx, []):
                 contrat = Contrat(salarie, duree_reference, creation=False)
-                site = None
-                for s in creche.sites:
-                    if s.idx == site_idx:
-                        site = s
-                        break
-                contrat.debut, contrat.fin, contrat.site, contrat.fonction, contrat.idx = getdate(debut), getdate(fin), site, fonction, idx
+                contrat.debut, contrat.fin, contrat.site, contrat.fonction, contrat.idx = getdate(debut), getdate(fin), creche.sites.Get(site_idx), fonction, idx
                 salarie.contrats.append(contrat)
                 
             for contrat in salarie.contrats:
-                cur.execute('SELECT day, value, debut, fin, idx FROM REF_JOURNEES_SALARIES WHERE reference=?', (contrat.idx,))
-                for day, value, debut, fin, idx in cur.fetchall():
+                for day, value, debut, fin, idx in references_salaries.get(contrat.idx, []):
                     if day < len(contrat.reference):
                         reference_day = contrat.reference[day]
                         reference_day.AddActivity(debut, fin, value, idx)
                         # print inscrit.prenom, inscrit.prenom, day, debut, fin, value
                     
-            cur.execute('SELECT date, value, debut, fin, idx FROM ACTIVITES_SALARIES WHERE salarie=?', (salarie.idx,))
-            for date, value, debut, fin, idx in cur.fetchall():
+            for date, value, debut, fin, idx in activites_salaries.get(salarie.idx, []):
                 key = getdate(date)
                 if key in salarie.journees:
                     journee = salarie.journees[key]
@@ -660,8 +906,7 @@ class SQLConnection(object):
                 # print salarie.prenom, salarie.nom, key, debut, fin, value
                 journee.AddActivity(debut, fin, value, idx)
                     
-            cur.execute('SELECT debut, fin, label, idx FROM CONGES_SALARIES WHERE salarie=?', (salarie.idx,))
-            for conges_entry in cur.fetchall():
+            for conges_entry in conges_salaries.get(salarie.idx, []):
                 conge = CongeSalarie(salarie, creation=False)
                 conge.debut, conge.fin, conge.label, conge.idx = conges_entry
                 salarie.conges.append(conge)
@@ -676,73 +921,66 @@ class SQLConnection(object):
             professeur.idx = idx
             creche.professeurs.append(professeur)
 
-        cur.execute('SELECT idx, prenom, nom, sexe, naissance, adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, marche, notes, photo, combinaison, categorie, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies FROM INSCRITS')
-        for idx, prenom, nom, sexe, naissance, adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, marche, notes, photo, combinaison, categorie, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies in cur.fetchall():
-            if photo:
-                photo = binascii.a2b_base64(photo)
+        fratries = self.SelectGroupBy(cur, 'FRATRIES', 'inscrit', 'prenom, naissance, entree, sortie, idx', progress_handler)
+        referents = self.SelectGroupBy(cur, 'REFERENTS', 'inscrit', 'prenom, nom, telephone, idx', progress_handler)
+        inscriptions = self.SelectGroupBy(cur, 'INSCRIPTIONS', 'inscrit', 'idx, debut, fin, depart, mode, reservataire, groupe, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, fin_periode_adaptation, duree_reference, forfait_heures_presence, semaines_conges, preinscription, site, sites_preinscription, professeur', progress_handler)
+        references = self.SelectGroupBy(cur, 'REF_ACTIVITIES', 'reference', 'day, value, debut, fin, idx', progress_handler)
+        conges_inscrits = self.SelectGroupBy(cur, 'CONGES_INSCRITS', 'inscrit', 'debut, fin, label, idx', progress_handler)
+        parents = self.SelectGroupBy(cur, 'PARENTS', 'inscrit', 'relation, prenom, nom, telephone_domicile, telephone_domicile_notes, telephone_portable, telephone_portable_notes, telephone_travail, telephone_travail_notes, email, idx', progress_handler)
+        revenus = self.SelectGroupBy(cur, 'REVENUS', 'parent', 'debut, fin, revenu, chomage, conge_parental, regime, idx', progress_handler)
+        activites = self.SelectGroupBy(cur, 'ACTIVITES', 'inscrit', 'date, value, debut, fin, idx', progress_handler, where_journees, args_journees)
+        commentaires = self.SelectGroupBy(cur, 'COMMENTAIRES', 'inscrit', 'date, commentaire, idx', progress_handler, where_journees, args_journees)
+        factures = self.SelectGroupBy(cur, 'FACTURES', 'inscrit', 'idx, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction', progress_handler)
+        corrections = self.SelectGroupBy(cur, 'CORRECTIONS', 'inscrit', 'idx, date, valeur, libelle', progress_handler)
+        cur.execute('SELECT idx, prenom, nom, sexe, naissance, adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, marche, notes, combinaison, categorie, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies FROM INSCRITS')
+        for idx, prenom, nom, sexe, naissance, adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, marche, notes, combinaison, categorie, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies in cur.fetchall():
+            # la photo est lue a la demande (Inscrit.__getattr__)
             inscrit = Inscrit(creation=False)
+            inscrit.journees.debut = debut_journees
             creche.inscrits.append(inscrit)
-            for tmp in creche.categories:
-                if categorie == tmp.idx:
-                    inscrit.categorie = tmp
-            inscrit.prenom, inscrit.nom, inscrit.sexe, inscrit.naissance, inscrit.adresse, inscrit.code_postal, inscrit.ville, inscrit.numero_securite_sociale, inscrit.numero_allocataire_caf, inscrit.handicap, inscrit.tarifs, inscrit.marche, inscrit.notes, inscrit.photo, inscrit.combinaison, inscrit.medecin_traitant, inscrit.telephone_medecin_traitant, inscrit.assureur, inscrit.numero_police_assurance, inscrit.allergies, inscrit.idx = prenom, nom, sexe, getdate(naissance), adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, getdate(marche), notes, photo, combinaison, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies, idx
-            cur.execute('SELECT prenom, naissance, entree, sortie, idx FROM FRATRIES WHERE inscrit=?', (inscrit.idx,))
-            for frere_entry in cur.fetchall():
+            inscrit.categorie = creche.categories.Get(categorie)
+            inscrit.prenom, inscrit.nom, inscrit.sexe, inscrit.naissance, inscrit.adresse, inscrit.code_postal, inscrit.ville, inscrit.numero_securite_sociale, inscrit.numero_allocataire_caf, inscrit.handicap, inscrit.tarifs, inscrit.marche, inscrit.notes, inscrit.combinaison, inscrit.medecin_traitant, inscrit.telephone_medecin_traitant, inscrit.assureur, inscrit.numero_police_assurance, inscrit.allergies, inscrit.idx = prenom, nom, sexe, getdate(naissance), adresse, code_postal, ville, numero_securite_sociale, numero_allocataire_caf, handicap, tarifs, getdate(marche), notes, combinaison, medecin_traitant, telephone_medecin_traitant, assureur, numero_police_assurance, allergies, idx
+            for frere_entry in fratries.get(inscrit.idx, []):
                 frere = Frere_Soeur(inscrit, creation=False)
                 frere.prenom, frere.naissance, frere.entree, frere.sortie, idx = frere_entry
                 frere.naissance, frere.entree, frere.sortie, frere.idx = getdate(frere.naissance), getdate(frere.entree), getdate(frere.sortie), idx
                 inscrit.freres_soeurs.append(frere)
-            cur.execute('SELECT prenom, nom, telephone, idx FROM REFERENTS WHERE inscrit=?', (inscrit.idx,))
-            for referent_entry in cur.fetchall():
+            for referent_entry in referents.get(inscrit.idx, []):
                 referent = Referent(inscrit, creation=False)
                 referent.prenom, referent.nom, referent.telephone, referent.idx = referent_entry
                 inscrit.referents.append(referent)
-            cur.execute('SELECT idx, debut, fin, depart, mode, reservataire, groupe, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, fin_periode_adaptation, duree_reference, forfait_heures_presence, semaines_conges, preinscription, site, sites_preinscription, professeur FROM INSCRIPTIONS WHERE inscrit=?', (inscrit.idx,))
-            for idx, debut, fin, depart, mode, reservataire, groupe, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, fin_periode_adaptation, duree_reference, forfait_heures_presence, semaines_conges, preinscription, site, sites_preinscription, professeur in cur.fetchall():
+            for idx, debut, fin, depart, mode, reservataire, groupe, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, fin_periode_adaptation, duree_reference, forfait_heures_presence, semaines_conges, preinscription, site, sites_preinscription, professeur in inscriptions.get(inscrit.idx, []):
                 inscription = Inscription(inscrit, duree_reference, creation=False)
-                for tmp in creche.sites:
-                    if site == tmp.idx:
-                        inscription.site = tmp
-                for tmp in creche.groupes:
-                    if groupe == tmp.idx:
-                        inscription.groupe = tmp
-                for tmp in creche.reservataires:
-                    if reservataire == tmp.idx:
-                        inscription.reservataire = tmp
+                inscription.site = creche.sites.Get(site)
+                inscription.groupe = creche.groupes.Get(groupe)
+                inscription.reservataire = creche.reservataires.Get(reservataire)
                 if sites_preinscription:
                     for site_preinscription in sites_preinscription.split():
-                        site_preinscription = int(site_preinscription)
-                        for tmp in creche.sites:
-                            if site_preinscription == tmp.idx:
-                                inscription.sites_preinscription.append(tmp)
-                for tmp in creche.professeurs:
-                    if professeur == tmp.idx:
-                        inscription.professeur = tmp
+                        tmp = creche.sites.Get(int(site_preinscription))
+                        if tmp:
+                            inscription.sites_preinscription.append(tmp)
+                inscription.professeur = creche.professeurs.Get(professeur)
                 inscription.debut, inscription.fin, inscription.depart, inscription.mode, inscription.preinscription, inscription.forfait_heures_presence, inscription.forfait_mensuel, inscription.frais_inscription, inscription.allocation_mensuelle_caf, inscription.fin_periode_adaptation, inscription.semaines_conges, inscription.idx = getdate(debut), getdate(fin), getdate(depart), mode, preinscription, forfait_heures_presence, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, getdate(fin_periode_adaptation), semaines_conges, idx
                 inscrit.inscriptions.append(inscription)
             for inscription in inscrit.inscriptions:
-                cur.execute('SELECT day, value, debut, fin, idx FROM REF_ACTIVITIES WHERE reference=?', (inscription.idx,))
-                for day, value, debut, fin, idx in cur.fetchall():
+                for day, value, debut, fin, idx in references.get(inscription.idx, []):
                     try:
                         reference_day = inscription.reference[day]
                         reference_day.AddActivity(debut, fin, value, idx)
                     except Exception, e:
                         print inscrit.prenom, inscrit.nom, day, debut, fin, value, e
                     # print inscrit.prenom, day, debut, fin, value
-            cur.execute('SELECT debut, fin, label, idx FROM CONGES_INSCRITS WHERE inscrit=?', (inscrit.idx,))
-            for conges_entry in cur.fetchall():
+            for conges_entry in conges_inscrits.get(inscrit.idx, []):
                 conge = CongeInscrit(inscrit, creation=False)
                 conge.debut, conge.fin, conge.label, conge.idx = conges_entry
                 inscrit.conges.append(conge)
             inscrit.CalculeJoursConges(creche)
             
-            cur.execute('SELECT relation, prenom, nom, telephone_domicile, telephone_domicile_notes, telephone_portable, telephone_portable_notes, telephone_travail, telephone_travail_notes, email, idx FROM PARENTS WHERE inscrit=?', (inscrit.idx,))
-            for parent_entry in cur.fetchall():
+            for parent_entry in parents.get(inscrit.idx, []):
                 parent = Parent(inscrit, creation=False)
                 parent.relation, parent.prenom, parent.nom, parent.telephone_domicile, parent.telephone_domicile_notes, parent.telephone_portable, parent.telephone_portable_notes, parent.telephone_travail, parent.telephone_travail_notes, parent.email, parent.idx = parent_entry
                 inscrit.parents[parent.relation] = parent
-                cur.execute('SELECT debut, fin, revenu, chomage, conge_parental, regime, idx FROM REVENUS WHERE parent=?', (parent.idx,))
-                for revenu_entry in cur.fetchall():
+                for revenu_entry in revenus.get(parent.idx, []):
                     revenu = Revenu(parent, creation=False)
                     revenu.debut, revenu.fin, revenu.revenu, revenu.chomage, revenu.conge_parental, revenu.regime, idx = revenu_entry
                     revenu.debut, revenu.fin, revenu.idx = getdate(revenu.debut), getdate(revenu.fin), idx
@@ -753,8 +991,7 @@ class SQLConnection(object):
                         if revenu.fin:
                             revenu.fin = datetime.date(revenu.fin.year+2, revenu.fin.month, revenu.fin.day)
                     parent.revenus.append(revenu)
-            cur.execute('SELECT date, value, debut, fin, idx FROM ACTIVITES WHERE inscrit=?', (inscrit.idx,))
-            for date, value, debut, fin, idx in cur.fetchall():
+            for date, value, debut, fin, idx in activites.get(inscrit.idx, []):
                 key = getdate(date)
                 if key in inscrit.journees:
                     journee = inscrit.journees[key]
@@ -763,8 +1000,7 @@ class SQLConnection(object):
                     inscrit.journees[key] = journee
                 # print inscrit.prenom, key, debut, fin, value
                 journee.AddActivity(debut, fin, value, idx)
-            cur.execute('SELECT date, commentaire, idx FROM COMMENTAIRES WHERE inscrit=?', (inscrit.idx,))
-            for date, commentaire, idx in cur.fetchall():
+            for date, commentaire, idx in commentaires.get(inscrit.idx, []):
                 key = getdate(date)
                 if key in inscrit.journees:
                     journee = inscrit.journees[key]
@@ -773,13 +1009,11 @@ class SQLConnection(object):
                     inscrit.journees[key] = journee
                 journee.commentaire, journee.commentaire_idx = commentaire, idx
 
-            cur.execute('SELECT idx, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction FROM FACTURES where inscrit=?', (inscrit.idx,))
-            for idx, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction in cur.fetchall():
+            for idx, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction in factures.get(inscrit.idx, []):
                 date = getdate(date)
                 inscrit.factures_cloturees[date] = FactureCloturee(inscrit, date, cotisation_mensuelle, total_contractualise, total_realise, total_facture, supplement_activites, supplement, deduction)
             
-            cur.execute('SELECT idx, date, valeur, libelle FROM CORRECTIONS where inscrit=?', (inscrit.idx,))
-            for idx, date, valeur, libelle in cur.fetchall():
+            for idx, date, valeur, libelle in corrections.get(inscrit.idx, []):
                 date = getdate(date)
                 inscrit.corrections[date] = Correction(inscrit, date, valeur, libelle, idx)
 
@@ -820,6 +1054,7 @@ class SQLConnection(object):
 
         if progress_handler:
             progress_handler.display(u"Conversion de la base de données (version %d => version %d) ..." % (version, VERSION))
+        self.converti = True
 
 
         #pour decloturer une facture dans une base plus ancienne
@@ -1624,6 +1859,16 @@ class SQLConnection(object):
             cur.execute("ALTER TABLE CRECHE ADD regularisation_fin_contrat BOOLEAN;")
             cur.execute("UPDATE CRECHE SET regularisation_fin_contrat=?", (True,))      
 
+        if version < 88:
+            self.CreateIndexes(cur)
+
+        if version < 90:
+            cur.execute("ALTER TABLE CRECHE ADD last_tablette_offset INTEGER;")
+            cur.execute("UPDATE CRECHE SET last_tablette_offset=?", (0,))
+
+        # apres toutes les migrations (depuis la version 89) : les tables ajoutees ont aussi leurs triggers
+        self.CreateTriggers(cur)
+
         if version < VERSION:
             try:
                 cur.execute("DELETE FROM DATA WHERE key=?", ("VERSION", ))
@@ -15,11 +15,177 @@
 ##    You should have received a copy of the GNU General Public License
 ##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
 
-import datetime, binascii
+import datetime, binascii, ast
 from constants import *
 from parameters import *
 from functions import *
 from cotisation import GetDateRevenus
+from facture import factures_cache
+
+class Journees(dict):
+    # journees d'un inscrit ou d'un salarie ; celles d'avant debut (periode chargee au demarrage)
+    # sont lues dans la base mois par mois au premier acces, et toutes d'un coup pour un parcours
+    def __init__(self, personne):
+        dict.__init__(self)
+        self.personne = personne
+        self.debut = None
+        self.mois_charges = set()
+
+    def ChargeMois(self, date):
+        if self.debut and isinstance(date, datetime.date) and date < self.debut:
+            mois = (date.year, date.month)
+            if mois not in self.mois_charges:
+                self.mois_charges.add(mois)
+                if sql_connection:
+                    for key, journee in sql_connection.LoadJournees(self.personne, GetMonthStart(date), min(GetNextMonthStart(date), self.debut)).items():
+                        dict.setdefault(self, key, journee)
+
+    def ChargeTout(self):
+        if self.debut:
+            debut, self.debut = self.debut, None
+            if sql_connection:
+                for key, journee in sql_connection.LoadJournees(self.personne, None, debut).items():
+                    if (key.year, key.month) not in self.mois_charges:
+                        dict.setdefault(self, key, journee)
+
+    def __contains__(self, date):
+        self.ChargeMois(date)
+        return dict.__contains__(self, date)
+
+    has_key = __contains__
+
+    def __getitem__(self, date):
+        self.ChargeMois(date)
+        return dict.__getitem__(self, date)
+
+    def __delitem__(self, date):
+        self.ChargeMois(date)
+        dict.__delitem__(self, date)
+
+    def get(self, date, default=None):
+        self.ChargeMois(date)
+        return dict.get(self, date, default)
+
+    def pop(self, date, *args):
+        self.ChargeMois(date)
+        return dict.pop(self, date, *args)
+
+    def setdefault(self, date, default=None):
+        self.ChargeMois(date)
+        return dict.setdefault(self, date, default)
+
+    def __len__(self):
+        self.ChargeTout()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        self.ChargeTout()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.ChargeTout()
+        return dict.keys(self)
+
+    def values(self):
+        self.ChargeTout()
+        return dict.values(self)
+
+    def items(self):
+        self.ChargeTout()
+        return dict.items(self)
+
+class ListeIndexee(list):
+    # liste d'objets de la base avec des index par idx et par position, reconstruits a la demande
+    # apres une modification de la liste (ou un idx attribue apres l'ajout)
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.Invalide()
+
+    def Invalide(self):
+        self.par_idx = None
+        self.positions = None
+
+    def Get(self, idx):
+        if idx is None:
+            return None
+        if self.par_idx is not None:
+            result = self.par_idx.get(idx)
+            if result is not None and result.idx == idx:
+                return result
+        self.par_idx = dict((item.idx, item) for item in self)
+        return self.par_idx.get(idx)
+
+    def GetIndex(self, item):
+        # par identite, Inscrit.__cmp__ comparant les noms
+        if self.positions is None or id(item) not in self.positions:
+            self.positions = dict((id(tmp), i) for i, tmp in enumerate(self))
+        if id(item) not in self.positions:
+            raise ValueError("%r n'est pas dans la liste" % item)
+        return self.positions[id(item)]
+
+    def append(self, item):
+        list.append(self, item)
+        self.Invalide()
+
+    def extend(self, items):
+        list.extend(self, items)
+        self.Invalide()
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.Invalide()
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.Invalide()
+
+    def pop(self, *args):
+        self.Invalide()
+        return list.pop(self, *args)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.Invalide()
+
+    def reverse(self):
+        list.reverse(self)
+        self.Invalide()
+
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self.Invalide()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.Invalide()
+
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, items)
+        self.Invalide()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.Invalide()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+def InvalideCalculs(inscrit=None, date=None, absence=False):
+    # factures et calendriers d'etats a recalculer apres une modification du modele
+    if inscrit is None:
+        factures_cache.Invalide()
+        CalendrierEtats.generation += 1
+    elif date is None:
+        factures_cache.InvalideInscrit(inscrit)
+        inscrit.etats.Invalide()
+    else:
+        inscrit.etats.Invalide(date)
+        if absence:
+            # une absence peut prolonger une periode de maladie sur les mois voisins
+            factures_cache.InvalideInscrit(inscrit)
+        else:
+            factures_cache.InvalideMois(inscrit, date)
 
 class SQLObject(object):
     def delete(self):
@@ -35,7 +201,7 @@ class Day(object):
     GetDynamicText = None
     
     def __init__(self):
-        self.activites = {}
+        self.activites = Activites()
         self.activites_sans_horaires = {}
         self.last_heures = None
         self.readonly = False
@@ -51,36 +217,35 @@ class Day(object):
                 self.commentaire_idx = result.lastrowid
             else:
                 print 'update commentaire'
-                result = sql_connection.execute('UPDATE COMMENTAIRES SET commentaire=? WHERE idx=?', (commentaire, self.commentaire_idx))
+                sql_connection.UpdateField('COMMENTAIRES', 'commentaire', commentaire, self.commentaire_idx)
+
+    def FusionneActivity(self, start, end, value):
+        # retire les tranches de meme valeur qui touchent [start, end] et renvoie leur union avec [start, end]
+        tranches = self.activites.GetChevauchements(start-1, end+1, [value])
+        while tranches:
+            for a, b, v in tranches:
+                start, end = min(a, start), max(b, end)
+                self.RemoveActivity(a, b, v)
+            tranches = self.activites.GetChevauchements(start-1, end+1, [value])
+        return start, end
 
     def SetActivity(self, start, end, value):
         self.last_heures = None
         if self.exclusive:
-            for a, b, v in self.activites.keys():
-                if v == value:
-                    if start <= b+1 and end >= a-1:
-                        start, end = min(a, start), max(b, end)
-                        self.RemoveActivity(a, b, v)
+            start, end = self.FusionneActivity(start, end, value)
             self.InsertActivity(start, end, value)            
         else:
             activity_value = value & ~PREVISIONNEL
             if value == activity_value:
                 self.Confirm()
             activity = creche.activites[activity_value]
-            for a, b, v in self.activites.keys():
+            for v in self.activites.GetValeurs():
                 if v < 0:
-                    self.RemoveActivity(a, b, v)
-                elif value == v:
-                    if start <= b+1 and end >= a-1:
-                        start, end = min(a, start), max(b, end)
+                    for a, b in self.activites.GetTranches(v):
                         self.RemoveActivity(a, b, v)
-                elif activity.mode == MODE_LIBERE_PLACE and start < b and end > a:
-                    self.RemoveActivity(a, b, v)
-                    if a < start:
-                        self.InsertActivity(a, start, v)
-                    if b > end:
-                        self.InsertActivity(end, b, v)
-                elif creche.activites[v & ~(PREVISIONNEL+CLOTURE)].mode == MODE_LIBERE_PLACE and start < b and end > a:
+            start, end = self.FusionneActivity(start, end, value)
+            for a, b, v in self.activites.GetChevauchements(start+1, end-1):
+                if v != value and (activity.mode == MODE_LIBERE_PLACE or creche.activites[v & ~(PREVISIONNEL+CLOTURE)].mode == MODE_LIBERE_PLACE):
                     self.RemoveActivity(a, b, v)
                     if a < start:
                         self.InsertActivity(a, start, v)
@@ -93,26 +258,24 @@ class Day(object):
     def ClearActivity(self, start, end, value):
         self.last_heures = None
         if self.exclusive:
-            for a, b, v in self.activites.keys():
-                if start <= b+1 and end >= a-1:
-                    self.RemoveActivity(a, b, v)
-                    if start > a:
-                        self.InsertActivity(a, start, v)
-                    if end < b:
-                        self.InsertActivity(end, b, v)
+            for a, b, v in self.activites.GetChevauchements(start-1, end+1):
+                self.RemoveActivity(a, b, v)
+                if start > a:
+                    self.InsertActivity(a, start, v)
+                if end < b:
+                    self.InsertActivity(end, b, v)
         else:
             activity_value = value & ~PREVISIONNEL
             if value == activity_value:
                 self.Confirm()
             activity = creche.activites[activity_value]
-            for a, b, v in self.activites.keys():
+            for a, b, v in self.activites.GetChevauchements(start-1, end+1):
                 if value == v:
-                    if start <= b+1 and end >= a-1:
-                        self.RemoveActivity(a, b, v)
-                        if start > a:
-                            self.InsertActivity(a, start, v)
-                        if end < b:
-                            self.InsertActivity(end, b, v)
+                    self.RemoveActivity(a, b, v)
+                    if start > a:
+                        self.InsertActivity(a, start, v)
+                    if end < b:
+                        self.InsertActivity(end, b, v)
                 elif activity_value == 0 and (not v&CLOTURE) and creche.activites[v & ~PREVISIONNEL].mode == MODE_NORMAL and start < b and end > a:
                     self.RemoveActivity(a, b, v)
                     if a < start:
@@ -123,7 +286,11 @@ class Day(object):
     def InsertActivity(self, start, end, value):
         self.AddActivity(start, end, value, None)
 
+    def InvalideCalculs(self, value):
+        pass
+
     def AddActivity(self, start, end, value, idx):
+        self.InvalideCalculs(value)
         if start is None and end is None:
             self.activites_sans_horaires[value] = idx
         else:
@@ -212,7 +379,7 @@ class Day(object):
         
     def GetState(self):
         state = ABSENT
-        for start, end, value in self.activites:
+        for value in self.activites.GetValeurs():
             if value < 0:
                 return value
             elif value == 0:
@@ -225,16 +392,15 @@ class Day(object):
 #        if self.last_heures is not None:
 #            return self.last_heures
         self.last_heures = 0.0
-        for start, end, value in self.activites:
+        for value in self.activites.GetValeurs():
             if value < 0:
-                self.last_heures = 0.0
                 return self.last_heures
-            elif value == 0:
-                if facturation:
-                    mode_arrondi = creche.arrondi_facturation
-                else:
-                    mode_arrondi = eval('creche.'+self.mode_arrondi)
-                self.last_heures += 5.0 * GetDureeArrondie(mode_arrondi, start, end)
+        if facturation:
+            mode_arrondi = creche.arrondi_facturation
+        else:
+            mode_arrondi = eval('creche.'+self.mode_arrondi)
+        for start, end in self.activites.GetTranches(0):
+            self.last_heures += 5.0 * GetDureeArrondie(mode_arrondi, start, end)
         if creche.mode_facturation == FACTURATION_FORFAIT_10H:
             self.last_heures = 10.0 * (self.last_heures > 0)
         else:
@@ -313,6 +479,7 @@ class Day(object):
             self.RemoveActivity(None, None, value)
             
     def RemoveActivity(self, start, end, value):
+        self.InvalideCalculs(value)
         if start is None and end is None:
             if self.activites_sans_horaires[value] is not None:
                 print 'suppression %s %d' % (self.nom, self.activites_sans_horaires[value])
@@ -327,11 +494,13 @@ class Day(object):
     def GetActivity(self, heure):
         if not isinstance(heure, int):
             heure = int(round(heure * 12))
-        for start, end, value in self.activites:
-            if start <= heure and heure < end:
-                return self.activites[(start, end, value)]
-        else:
-            return None
+        for value in self.activites.GetValeurs():
+            for start, end in self.activites.GetTranches(value):
+                if start > heure:
+                    break
+                elif heure < end:
+                    return self.activites[(start, end, value)]
+        return None
 
 class JourneeCapacite(Day):
     table = "CAPACITE"
@@ -363,7 +532,12 @@ class JourneeReferenceInscription(Day):
         self.day = day
         self.mode_arrondi = 'arrondi_heures'
 
+    def InvalideCalculs(self, value):
+        if self.inscription:
+            InvalideCalculs(self.inscription.inscrit)
+
     def InsertActivity(self, start, end, value):
+        self.InvalideCalculs(value)
         print 'nouvelle activite de reference (%r, %r %d)' % (start, end, value), 
         result = sql_connection.execute('INSERT INTO REF_ACTIVITIES (idx, reference, day, value, debut, fin) VALUES (NULL,?,?,?,?,?)', (self.inscription.idx, self.day, value, start, end))
         idx = result.lastrowid
@@ -399,14 +573,20 @@ class Journee(Day):
     
     def __init__(self, inscrit, date, reference=None):
         Day.__init__(self)
+        self.inscrit = inscrit
         self.inscrit_idx = inscrit.idx
         self.date = date
         self.previsionnel = 0
         self.mode_arrondi = 'arrondi_heures'
         if reference:
             self.Copy(reference, creche.presences_previsionnelles)
+        self.InvalideCalculs(0)
+
+    def InvalideCalculs(self, value):
+        InvalideCalculs(self.inscrit, self.date, value < 0)
 
     def InsertActivity(self, start, end, value): 
+        self.InvalideCalculs(value)
         if sql_connection:
             print 'nouvelle activite (%r, %r, %d)' % (start, end, value),
             result = sql_connection.execute('INSERT INTO ACTIVITES (idx, inscrit, date, value, debut, fin) VALUES (NULL,?,?,?,?,?)', (self.inscrit_idx, self.date, value, start, end))
@@ -470,12 +650,14 @@ class Bureau(SQLObject):
         print 'nouveau bureau'
         result = sql_connection.execute('INSERT INTO BUREAUX (idx, debut, fin, president, vice_president, tresorier, secretaire, directeur) VALUES (NULL,?,?,?,?,?,?,?)', (self.debut, self.fin, self.president, self.vice_president, self.tresorier, self.secretaire, self.directeur))
         self.idx = result.lastrowid
+        factures_cache.Invalide()
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['debut', 'fin']:
+            factures_cache.Invalide()
         if name in ['debut', 'fin', 'president', 'vice_president', 'tresorier', 'secretaire', 'directeur', 'gerant', 'directeur_adjoint', 'comptable'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE BUREAUX SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('BUREAUX', name, value, self.idx)
 
 class BaremeCAF(object):
     def __init__(self, creation=True):
@@ -492,16 +674,19 @@ class BaremeCAF(object):
         print 'nouveau bareme caf'
         result = sql_connection.execute('INSERT INTO BAREMESCAF (idx, debut, fin, plancher, plafond) VALUES (NULL,?,?,?,?)', (self.debut, self.fin, self.plancher, self.plafond))
         self.idx = result.lastrowid
+        factures_cache.Invalide()
 
     def delete(self):
         print 'suppression bareme caf'
         sql_connection.execute('DELETE FROM BAREMESCAF WHERE idx=?', (self.idx,))
+        factures_cache.Invalide()
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['debut', 'fin', 'plancher', 'plafond']:
+            factures_cache.Invalide()
         if name in ['debut', 'fin', 'plancher', 'plafond'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE BAREMESCAF SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('BAREMESCAF', name, value, self.idx)
 
 class Charges(object):
     def __init__(self, date=None, creation=True):
@@ -520,8 +705,7 @@ class Charges(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['date', 'charges'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE CHARGES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('CHARGES', name, value, self.idx)
 
 class User(object):
     def __init__(self, creation=True):
@@ -545,8 +729,7 @@ class User(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['login', 'password', 'profile'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE USERS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('USERS', name, value, self.idx)
 
 class Reservataire(SQLObject):
     table = "RESERVATAIRES"
@@ -577,8 +760,7 @@ class Reservataire(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['debut', 'fin', 'nom', 'places', 'heures_jour', 'heures_semaine', 'options'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE RESERVATAIRES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('RESERVATAIRES', name, value, self.idx)
 
 class Conge(object):
     __table__ = "CONGES"
@@ -606,8 +788,7 @@ class Conge(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['debut', 'fin', 'label', 'options'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE %s SET %s=? WHERE idx=?' % (self.__table__, name), (value, self.idx))
+            sql_connection.UpdateField(self.__table__, name, value, self.idx)
             self.parent.CalculeJoursConges()
                 
 class CongeInscrit(Conge):
@@ -652,21 +833,24 @@ class Activite(object):
         print self.value
         result = sql_connection.execute('INSERT INTO ACTIVITIES (idx, label, value, mode, couleur, couleur_supplement, couleur_previsionnel, tarif, owner) VALUES(NULL,?,?,?,?,?,?,?,?)', (self.label, self.value, self.mode, str(self.couleur), str(self.couleur_supplement), str(self.couleur_previsionnel), self.tarif, self.owner))
         self.idx = result.lastrowid
+        InvalideCalculs()
 
     def delete(self):
         print 'suppression activite'
         sql_connection.execute('DELETE FROM ACTIVITIES WHERE idx=?', (self.idx,))
+        InvalideCalculs()
 
     def __setattr__(self, name, value):
         if name in ("couleur", "couleur_supplement", "couleur_previsionnel") and isinstance(value, basestring):
             self.__dict__[name] = eval(value)
         else:
             self.__dict__[name] = value
+        if name in ['value', 'mode', 'tarif']:
+            InvalideCalculs()
         if name in ['label', 'value', 'mode', 'couleur', "couleur_supplement", "couleur_previsionnel", "tarif", "owner"] and self.idx:
-            print 'update', name, value
             if name in ("couleur", "couleur_supplement", "couleur_previsionnel") and not isinstance(value, basestring):
                 value = str(value)
-            sql_connection.execute('UPDATE ACTIVITIES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('ACTIVITIES', name, value, self.idx)
 
 class PeriodeReference(SQLObject):
     def __init__(self, type, duree_reference=7):
@@ -753,8 +937,7 @@ class Contrat(PeriodeReference):
         if name in ['debut', 'fin', 'site', 'fonction', 'duree_reference'] and self.idx:
             if name == 'site':
                 value = value.idx
-            print 'update', name
-            sql_connection.execute('UPDATE CONTRATS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('CONTRATS', name, value, self.idx)
 
 class Salarie(object):
     def __init__(self, creation=True):
@@ -769,7 +952,7 @@ class Salarie(object):
         self.diplomes = ''
         self.contrats = []
         self.conges = []
-        self.journees = {}
+        self.journees = Journees(self)
         self.jours_conges = {}
         if creation:
             self.create()
@@ -836,8 +1019,7 @@ class Salarie(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['prenom', 'nom', 'telephone_domicile', 'telephone_domicile_notes', 'telephone_portable', 'telephone_portable_notes', 'email', 'diplomes'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE EMPLOYES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('EMPLOYES', name, value, self.idx)
 
 class Professeur(SQLObject):
     table = "PROFESSEURS"
@@ -860,8 +1042,7 @@ class Professeur(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['prenom', 'nom', 'entree', 'sortie'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE PROFESSEURS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('PROFESSEURS', name, value, self.idx)
 
 class Site(object):
     def __init__(self, creation=True):
@@ -887,8 +1068,44 @@ class Site(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['nom', 'adresse', 'code_postal', 'ville', 'telephone', 'capacite'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE SITES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('SITES', name, value, self.idx)
+
+class FormuleConversion(list):
+    # conditions compilees une seule fois, resultats memorises par jeu de parametres
+    cache_size = 50000
+
+    def __init__(self):
+        list.__init__(self)
+        self.cache = {}
+        # expressions comparees a heure_mois (None si heure_mois est utilise autrement)
+        self.seuils = []
+        self.cache_seuils = {}
+
+def GetSeuilsHeureMois(condition):
+    # renvoie les expressions auxquelles heure_mois est compare dans la condition,
+    # ou None si heure_mois y apparait ailleurs que dans une simple comparaison
+    try:
+        tree = ast.parse(condition, mode="eval")
+    except:
+        return None
+    occurences = [node for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id == "heure_mois"]
+    traitees = set()
+    result = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Compare):
+            operandes = [node.left] + node.comparators
+            for i, op in enumerate(node.ops):
+                if not isinstance(op, (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)):
+                    continue
+                for operande, autre in ((operandes[i], operandes[i+1]), (operandes[i+1], operandes[i])):
+                    if isinstance(operande, ast.Name) and operande.id == "heure_mois":
+                        if [n for n in ast.walk(autre) if isinstance(n, ast.Name) and n.id == "heure_mois"]:
+                            return None
+                        traitees.add(id(operande))
+                        result.append(compile(ast.Expression(body=autre), "<seuil>", "eval"))
+    if len(traitees) != len(occurences):
+        return None
+    return result
 
 class Creche(object): 
     def __init__(self):
@@ -898,24 +1115,24 @@ class Creche(object):
         self.code_postal = ''
         self.ville = ''
         self.telephone = ''
-        self.sites = []
-        self.reservataires = []
-        self.users = []
-        self.tarifs_speciaux = []
-        self.plages_horaires = []
-        self.groupes = []
-        self.categories = []
+        self.sites = ListeIndexee()
+        self.reservataires = ListeIndexee()
+        self.users = ListeIndexee()
+        self.tarifs_speciaux = ListeIndexee()
+        self.plages_horaires = ListeIndexee()
+        self.groupes = ListeIndexee()
+        self.categories = ListeIndexee()
         self.couleurs = { ABSENCE_NON_PREVENUE: Activite(creation=False, value=ABSENCE_NON_PREVENUE, couleur=[0, 0, 255, 150, wx.SOLID]) }
         self.activites = {}
-        self.salaries = []
-        self.professeurs = []
+        self.salaries = ListeIndexee()
+        self.professeurs = ListeIndexee()
         self.feries = {}
-        self.conges = []
-        self.bureaux = []
-        self.baremes_caf = []
+        self.conges = ListeIndexee()
+        self.bureaux = ListeIndexee()
+        self.baremes_caf = ListeIndexee()
         self.charges = {}
         self.numeros_facture = {}
-        self.inscrits = []
+        self.inscrits = ListeIndexee()
         self.ouverture = 7.75
         self.fermeture = 18.5
         self.affichage_min = 7.75
@@ -960,6 +1177,7 @@ class Creche(object):
         self.alerte_depassement_planning = False
         self.tri_planning = TRI_PRENOM
         self.last_tablette_synchro = ""
+        self.last_tablette_offset = 0
         self.changement_groupe_auto = False
         self.allergies = ""
         self.regularisation_fin_contrat = True
@@ -1070,7 +1288,7 @@ class Creche(object):
     def UpdateFormuleTauxHoraire(self, changed=True):
         if changed:
             print 'update formule_taux_horaire', self.formule_taux_horaire
-            sql_connection.execute('UPDATE CRECHE SET formule_taux_horaire=?', (str(self.formule_taux_horaire),))
+            sql_connection.UpdateField('CRECHE', 'formule_taux_horaire', str(self.formule_taux_horaire))
         self.conversion_formule_taux_horaire = self.GetFormuleConversion(self.formule_taux_horaire)
     
     def EvalTauxHoraire(self, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois):
@@ -1094,35 +1312,96 @@ class Creche(object):
     
     def GetFormuleConversion(self, formule):
         if formule:
-            result = []
+            result = FormuleConversion()
             for cas in formule:
                 condition = cas[0].strip()
                 if condition == "":
                     condition = "True"
                 else:
                     condition = condition.lower().replace(" et ", " and ").replace(" ou ", " or ").replace("!=", "__<>").replace("<=", "__<eq").replace(">=", "__>eq").replace("=", "==").replace("__<>", "!=").replace("__<eq", "<=").replace("__>eq", ">=")
-                result.append([condition, cas[1], cas[0]])
+                try:
+                    code = compile(condition, "<formule>", "eval")
+                except:
+                    code = None
+                result.append([condition, cas[1], cas[0], code])
+                if result.seuils is not None:
+                    seuils = GetSeuilsHeureMois(condition)
+                    if code is None or seuils is None:
+                        result.seuils = None
+                    else:
+                        result.seuils.extend(seuils)
             return result
         else:
             return None
         
     def EvalFormule(self, formule, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois):
         # print 'EvalFormule', 'mode=%d' % mode, handicap, 'revenus=%f' % revenus, 'enfants=%d' % enfants, 'jours=%d' % jours, 'heures=%f' % heures, reservataire, nom, 'parents=%d' % parents, chomage, conge_parental, 'heures_mois=%f' % heures_mois, heure_mois
-        hg = MODE_HALTE_GARDERIE
-        creche = MODE_CRECHE
-        forfait = MODE_FORFAIT_HORAIRE
-        urgence = MODE_ACCUEIL_URGENCE
+        key = (mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois)
         try:
-            for cas in formule:
-                if heure_mois is None and "heure_mois" in cas[0]:
-                    return None
-                elif eval(cas[0]):
-                    # print cas[0], cas[1]
-                    return cas[1]
+            return formule.cache[key]
+        except:
+            pass
+        variables = self.GetVariablesFormule(mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois)
+        try:
+            for condition, taux, texte, code in formule:
+                if heure_mois is None and "heure_mois" in condition:
+                    result = None
+                    break
+                elif eval(code, globals(), variables):
+                    # print condition, taux
+                    result = taux
+                    break
             else:
                 raise "Aucune condition ne matche"
         except:
             raise "Erreur dans la formule"
+        if len(formule.cache) >= FormuleConversion.cache_size:
+            formule.cache.clear()
+        formule.cache[key] = result
+        return result
+
+    def GetSeuilsTauxHoraire(self, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois):
+        return self.GetSeuilsFormule(self.conversion_formule_taux_horaire, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois)
+
+    def GetSeuilsFormule(self, formule, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois):
+        # valeurs de heure_mois auxquelles le resultat de la formule peut changer, pour un jeu de parametres donne
+        # None si la formule ne peut pas etre decoupee en tranches
+        if formule is None or formule.seuils is None:
+            return None
+        key = (mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois)
+        try:
+            return formule.cache_seuils[key]
+        except:
+            pass
+        variables = self.GetVariablesFormule(mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, None)
+        try:
+            result = [float(eval(code, globals(), variables)) for code in formule.seuils]
+            result.sort()
+        except:
+            result = None
+        if len(formule.cache_seuils) >= FormuleConversion.cache_size:
+            formule.cache_seuils.clear()
+        formule.cache_seuils[key] = result
+        return result
+
+    def GetVariablesFormule(self, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois):
+        return { "hg": MODE_HALTE_GARDERIE,
+                 "creche": MODE_CRECHE,
+                 "forfait": MODE_FORFAIT_HORAIRE,
+                 "urgence": MODE_ACCUEIL_URGENCE,
+                 "mode": mode,
+                 "handicap": handicap,
+                 "revenus": revenus,
+                 "enfants": enfants,
+                 "jours": jours,
+                 "heures": heures,
+                 "reservataire": reservataire,
+                 "nom": nom,
+                 "parents": parents,
+                 "chomage": chomage,
+                 "conge_parental": conge_parental,
+                 "heures_mois": heures_mois,
+                 "heure_mois": heure_mois }
         
     def CheckFormule(self, formule, index):
         hg = MODE_HALTE_GARDERIE
@@ -1151,7 +1430,7 @@ class Creche(object):
     def UpdateFormuleTauxEffort(self, changed=True):
         if changed:
             print 'update formule_taux_effort', self.formule_taux_effort
-            sql_connection.execute('UPDATE CRECHE SET formule_taux_effort=?', (str(self.formule_taux_effort),))
+            sql_connection.UpdateField('CRECHE', 'formule_taux_effort', str(self.formule_taux_effort))
         self.conversion_formule_taux_effort = self.GetFormuleConversion(self.formule_taux_effort)
     
     def EvalTauxEffort(self, mode, handicap, revenus, enfants, jours, heures, reservataire, nom, parents, chomage, conge_parental, heures_mois, heure_mois):
@@ -1216,9 +1495,8 @@ class Creche(object):
         elif tranche is None:
             return self.GetHeuresAccueil(jour) / self.GetAmplitudeHoraire()
         else:
-            for start, end, value in self.tranches_capacite[jour].activites:
-                if tranche >= start and tranche < end:
-                    return value
+            for start, end, value in self.tranches_capacite[jour].activites.GetChevauchements(tranche+1, tranche):
+                return value
             else:
                 return 0
             
@@ -1229,17 +1507,16 @@ class Creche(object):
         return result / 12        
 
     def GetInscrit(self, idx):
-        for inscrit in self.inscrits:
-            if inscrit.idx == idx:
-                return inscrit
-        else:
-            return None
+        return self.inscrits.Get(idx)
+
+    def GetSalarie(self, idx):
+        return self.salaries.Get(idx)
                 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
-        if name in ['nom', 'adresse', 'code_postal', 'ville', 'telephone', 'ouverture', 'fermeture', 'affichage_min', 'affichage_max', 'granularite', 'preinscriptions', 'presences_previsionnelles', 'presences_supplementaires', 'modes_inscription', 'minimum_maladie', 'email', 'type', 'periode_revenus', 'mode_facturation', 'repartition', 'temps_facturation', 'conges_inscription', 'tarification_activites', 'traitement_maladie', 'facturation_jours_feries', 'facturation_periode_adaptation', 'gestion_alertes', 'age_maximum', 'seuil_alerte_inscription', 'cloture_factures', 'arrondi_heures', 'arrondi_facturation', 'arrondi_heures_salaries', 'gestion_maladie_hospitalisation', 'gestion_absences_non_prevenues', 'gestion_maladie_sans_justificatif', 'gestion_preavis_conges', 'gestion_depart_anticipe', 'alerte_depassement_planning', 'tri_planning', 'smtp_server', 'caf_email', 'mode_accueil_defaut', 'last_tablette_synchro', 'changement_groupe_auto', 'allergies', 'regularisation_fin_contrat'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE CRECHE SET %s=?' % name, (value,))
+        InvalideCalculs()
+        if name in ['nom', 'adresse', 'code_postal', 'ville', 'telephone', 'ouverture', 'fermeture', 'affichage_min', 'affichage_max', 'granularite', 'preinscriptions', 'presences_previsionnelles', 'presences_supplementaires', 'modes_inscription', 'minimum_maladie', 'email', 'type', 'periode_revenus', 'mode_facturation', 'repartition', 'temps_facturation', 'conges_inscription', 'tarification_activites', 'traitement_maladie', 'facturation_jours_feries', 'facturation_periode_adaptation', 'gestion_alertes', 'age_maximum', 'seuil_alerte_inscription', 'cloture_factures', 'arrondi_heures', 'arrondi_facturation', 'arrondi_heures_salaries', 'gestion_maladie_hospitalisation', 'gestion_absences_non_prevenues', 'gestion_maladie_sans_justificatif', 'gestion_preavis_conges', 'gestion_depart_anticipe', 'alerte_depassement_planning', 'tri_planning', 'smtp_server', 'caf_email', 'mode_accueil_defaut', 'last_tablette_synchro', 'last_tablette_offset', 'changement_groupe_auto', 'allergies', 'regularisation_fin_contrat'] and self.idx:
+            sql_connection.UpdateField('CRECHE', name, value)
 
 class Revenu(object):
     def __init__(self, parent, debut=None, fin=None, creation=True):
@@ -1259,16 +1536,19 @@ class Revenu(object):
         print 'nouveau revenu'
         result = sql_connection.execute('INSERT INTO REVENUS (idx, parent, debut, fin, revenu, chomage, conge_parental, regime) VALUES(NULL,?,?,?,?,?,?,?)', (self.parent.idx, self.debut, self.fin, self.revenu, self.chomage, self.conge_parental, self.regime))
         self.idx = result.lastrowid
+        factures_cache.InvalideInscrit(self.parent.inscrit)
         
     def delete(self):
         print 'suppression revenu'
         sql_connection.execute('DELETE FROM REVENUS WHERE idx=?', (self.idx,))
+        factures_cache.InvalideInscrit(self.parent.inscrit)
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['debut', 'fin', 'revenu', 'chomage', 'conge_parental', 'regime']:
+            factures_cache.InvalideInscrit(self.parent.inscrit)
         if name in ['debut', 'fin', 'revenu', 'chomage', 'conge_parental', 'regime'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE REVENUS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('REVENUS', name, value, self.idx)
 
 class Parent(object):
     def __init__(self, inscrit, relation=None, creation=True):
@@ -1301,10 +1581,12 @@ class Parent(object):
         self.idx = result.lastrowid
         for revenu in self.revenus:
             revenu.create()
+        factures_cache.InvalideInscrit(self.inscrit)
 
     def delete(self):
         print 'suppression parent'
         sql_connection.execute('DELETE FROM PARENTS WHERE idx=?', (self.idx,))
+        factures_cache.InvalideInscrit(self.inscrit)
         for revenu in self.revenus:
             revenu.delete()
         for bureau in creche.bureaux:
@@ -1315,8 +1597,7 @@ class Parent(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['relation', 'prenom', 'nom', 'telephone_domicile', 'telephone_domicile_notes', 'telephone_portable', 'telephone_portable_notes', 'telephone_travail', 'telephone_travail_notes', 'email'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE PARENTS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('PARENTS', name, value, self.idx)
 
 class Referent(SQLObject):
     table = "REFERENTS"
@@ -1338,8 +1619,7 @@ class Referent(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['prenom', 'nom', 'telephone'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE REFERENTS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('REFERENTS', name, value, self.idx)
 
 class TarifSpecial(SQLObject):
     table = "TARIFSSPECIAUX"
@@ -1356,12 +1636,18 @@ class TarifSpecial(SQLObject):
         print 'nouveau tarif special'
         result = sql_connection.execute('INSERT INTO TARIFSSPECIAUX (idx, label, type, unite, valeur) VALUES(NULL,?,?,?,?)', (self.label, self.type, self.unite, self.valeur))
         self.idx = result.lastrowid
+        factures_cache.Invalide()
+
+    def delete(self):
+        SQLObject.delete(self)
+        factures_cache.Invalide()
         
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['type', 'unite', 'valeur']:
+            factures_cache.Invalide()
         if name in ['label', 'type', 'unite', 'valeur'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE TARIFSSPECIAUX SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('TARIFSSPECIAUX', name, value, self.idx)
     
 class PlageHoraire(SQLObject):
     table = "PLAGESHORAIRES"
@@ -1384,8 +1670,7 @@ class PlageHoraire(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['debut', 'fin', 'flags'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE PLAGESHORAIRES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('PLAGESHORAIRES', name, value, self.idx)
     
 class Groupe(SQLObject):
     table = "GROUPES"
@@ -1408,8 +1693,7 @@ class Groupe(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['nom', 'ordre', 'age_maximum'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE GROUPES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('GROUPES', name, value, self.idx)
 
 class Categorie(SQLObject):
     table = "CATEGORIES"
@@ -1427,8 +1711,7 @@ class Categorie(SQLObject):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['nom'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE CATEGORIES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('CATEGORIES', name, value, self.idx)
 
 class Inscription(PeriodeReference):
     table = "INSCRIPTIONS"
@@ -1473,18 +1756,12 @@ class Inscription(PeriodeReference):
             return 0
         
     def GetNombreJoursCongesPoses(self):
-        jours = 0
         if self.debut and self.fin:
             date = self.debut
             if self.fin_periode_adaptation:
                 date = self.fin_periode_adaptation + datetime.timedelta(1)
-            while date < self.fin:
-                state = self.inscrit.GetState(date)
-                if state.state == VACANCES:
-                    # print date
-                    jours += 1
-                date += datetime.timedelta(1)
-        return jours
+            return self.inscrit.etats.GetNombreJoursVacances(date, self.fin)
+        return 0
     
     def IsNombreSemainesCongesAtteint(self, jalon):
         if self.debut:
@@ -1495,14 +1772,8 @@ class Inscription(PeriodeReference):
             date = self.debut
             if self.fin_periode_adaptation:
                 date = self.fin_periode_adaptation + datetime.timedelta(1)
-            while date < jalon:
-                state = self.inscrit.GetState(date)
-                if state.state == VACANCES:
-                    # print date
-                    restant -= 1
-                    if restant <= 0:
-                        return True
-                date += datetime.timedelta(1)
+            jours = self.inscrit.etats.GetNombreJoursVacances(date, jalon)
+            return jours > 0 and jours >= restant
         return False
     
     def GetDatesFromReference(self, index):
@@ -1539,21 +1810,24 @@ class Inscription(PeriodeReference):
         print 'nouvelle inscription'
         result = sql_connection.execute('INSERT INTO INSCRIPTIONS (idx, inscrit, debut, fin, depart, mode, forfait_mensuel, frais_inscription, allocation_mensuelle_caf, fin_periode_adaptation, duree_reference, forfait_heures_presence, semaines_conges) VALUES(NULL,?,?,?,?,?,?,?,?,?,?,?,?)', (self.inscrit.idx, self.debut, self.fin, self.depart, self.mode, self.forfait_mensuel, self.frais_inscription, self.allocation_mensuelle_caf, self.fin_periode_adaptation, self.duree_reference, self.forfait_heures_presence, self.semaines_conges))
         self.idx = result.lastrowid
+        InvalideCalculs(self.inscrit)
         
     def delete(self):
         SQLObject.delete(self)
         for object in self.reference:
             object.delete()
+        InvalideCalculs(self.inscrit)
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['debut', 'fin', 'depart', 'mode', 'forfait_mensuel', 'frais_inscription', 'fin_periode_adaptation', 'duree_reference', 'forfait_heures_presence', 'semaines_conges', 'preinscription', 'site', 'reservataire', 'heures_supplementaires']:
+            InvalideCalculs(self.inscrit)
         if name in ('site', 'professeur', 'reservataire', 'groupe') and value is not None and self.idx:
             value = value.idx
         elif name == "sites_preinscription":
             value = " ".join([str(value.idx) for value in value])
         if name in ['debut', 'fin', 'depart', 'mode', 'forfait_mensuel', 'frais_inscription', 'allocation_mensuelle_caf', 'fin_periode_adaptation', 'duree_reference', 'forfait_heures_presence', 'semaines_conges', 'preinscription', 'site', 'sites_preinscription', 'professeur', 'reservataire', 'groupe'] and self.idx:
-            print 'update', name, value
-            sql_connection.execute('UPDATE INSCRIPTIONS SET %s=? WHERE idx=?' % name, (value, self.idx))   
+            sql_connection.UpdateField('INSCRIPTIONS', name, value, self.idx)   
 
 class Frere_Soeur(object):
     def __init__(self, inscrit, creation=True):
@@ -1572,16 +1846,19 @@ class Frere_Soeur(object):
         print 'nouveau frere / soeur'
         result = sql_connection.execute('INSERT INTO FRATRIES (idx, inscrit, prenom, naissance, entree, sortie) VALUES(NULL,?,?,?,?,?)', (self.inscrit.idx, self.prenom, self.naissance, self.entree, self.sortie))
         self.idx = result.lastrowid
+        factures_cache.InvalideInscrit(self.inscrit)
         
     def delete(self):
         print 'suppression frere / soeur'
         sql_connection.execute('DELETE FROM FRATRIES WHERE idx=?', (self.idx,))
+        factures_cache.InvalideInscrit(self.inscrit)
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
+        if name in ['naissance', 'entree', 'sortie']:
+            factures_cache.InvalideInscrit(self.inscrit)
         if name in ['prenom', 'naissance', 'entree', 'sortie'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE FRATRIES SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('FRATRIES', name, value, self.idx)
 
 class NumeroFacture(SQLObject):
     table = "NUMEROS_FACTURE"
@@ -1602,9 +1879,9 @@ class NumeroFacture(SQLObject):
         self.__dict__[name] = value
         
         if self.ready and name in ['valeur']:
+            factures_cache.Invalide()
             if self.idx and self.valeur:
-                print 'update', name
-                sql_connection.execute('UPDATE NUMEROS_FACTURE SET %s=? WHERE idx=?' % name, (value, self.idx))
+                sql_connection.UpdateField('NUMEROS_FACTURE', name, value, self.idx)
             elif value and not self.idx:
                 self.create()
             elif self.idx and not self.valeur:
@@ -1636,16 +1913,117 @@ class Correction(SQLObject):
         self.__dict__[name] = value
         
         if self.ready and name in ['valeur', 'libelle']:
+            factures_cache.InvalideMois(self.inscrit, self.date)
             if self.idx and (self.valeur or self.libelle):
-                print 'update', name
-                sql_connection.execute('UPDATE CORRECTIONS SET %s=? WHERE idx=?' % name, (value, self.idx))
+                sql_connection.UpdateField('CORRECTIONS', name, value, self.idx)
             elif value and not self.idx:
                 self.create()
             elif self.idx and not self.valeur and not self.libelle:
                 self.delete()
 
+class CalendrierEtats(dict):
+    # etats (State) deja calcules d'un inscrit par date, avec les periodes de maladie
+    # et les cumuls de jours de vacances qui en decoulent
+    generation = 0 # incrementee quand un parametre commun a tous les inscrits change
+
+    def __init__(self, inscrit):
+        dict.__init__(self)
+        self.inscrit = inscrit
+        self.Invalide()
+
+    def Invalide(self, date=None):
+        if date is None:
+            self.clear()
+            self.debuts_maladie = {}
+            self.fins_maladie = {}
+            self.cumuls_vacances = {}
+            self.generation = CalendrierEtats.generation
+        else:
+            if date in self:
+                del self[date]
+            self.debuts_maladie.clear()
+            self.fins_maladie.clear()
+            for debut, cumul in self.cumuls_vacances.items():
+                if date >= debut:
+                    del cumul[(date - debut).days + 1:]
+
+    def GetState(self, date):
+        if self.generation != CalendrierEtats.generation:
+            self.Invalide()
+        if date not in self:
+            self[date] = self.inscrit.CalculeState(date)
+        return self[date]
+
+    def GetDebutMaladie(self, date):
+        # premier jour de la periode de maladie qui se termine a date et nombre de jours ouvres de maladie avant date
+        # les jours d'absence n'interrompent pas la periode
+        if date in self.debuts_maladie:
+            return self.debuts_maladie[date]
+        borne = self.inscrit.inscriptions[0].debut
+        jours = [date]
+        precedent = None
+        tmp = date
+        while tmp > borne:
+            tmp -= datetime.timedelta(1)
+            state = self.GetState(tmp).state
+            if state == MALADE:
+                if tmp in self.debuts_maladie:
+                    precedent = tmp
+                    break
+                jours.append(tmp)
+            elif state != ABSENT:
+                break
+        jours.reverse()
+        if precedent is None:
+            precedent = jours.pop(0)
+            self.debuts_maladie[precedent] = (precedent, 0)
+        premier, nombre = self.debuts_maladie[precedent]
+        for jour in jours:
+            if precedent not in creche.jours_fermeture:
+                nombre += 1
+            self.debuts_maladie[jour] = (premier, nombre)
+            precedent = jour
+        return self.debuts_maladie[date]
+
+    def GetFinMaladie(self, date):
+        # dernier jour de maladie consecutif a date
+        if date in self.fins_maladie:
+            return self.fins_maladie[date]
+        fin = self.inscrit.inscriptions[-1].fin
+        jours = [date]
+        dernier = tmp = date
+        while not fin or tmp < fin:
+            tmp += datetime.timedelta(1)
+            if self.GetState(tmp).state != MALADE:
+                break
+            if tmp in self.fins_maladie:
+                dernier = self.fins_maladie[tmp]
+                break
+            jours.append(tmp)
+            dernier = tmp
+        for jour in jours:
+            self.fins_maladie[jour] = dernier
+        return dernier
+
+    def GetNombreJoursVacances(self, debut, fin):
+        # nombre de jours de vacances entre debut (inclus) et fin (exclu)
+        if self.generation != CalendrierEtats.generation:
+            self.Invalide()
+        if debut not in self.cumuls_vacances:
+            self.cumuls_vacances[debut] = [0]
+        cumul = self.cumuls_vacances[debut]
+        jours = (fin - debut).days
+        while len(cumul) <= jours:
+            date = debut + datetime.timedelta(len(cumul) - 1)
+            if self.GetState(date).state == VACANCES:
+                cumul.append(cumul[-1] + 1)
+            else:
+                cumul.append(cumul[-1])
+        return cumul[max(0, jours)]
+
 class Inscrit(object):
     def __init__(self, creation=True):
+        self.etats = CalendrierEtats(self)
         self.idx = None
         self.prenom = ""
         self.nom = ""
@@ -1664,7 +2042,6 @@ class Inscrit(object):
         self.categorie = None
         self.tarifs = 0
         self.marche = None
-        self.photo = None
         self.combinaison = ""
         self.notes = ""
         self.notes_parents = ""
@@ -1673,7 +2050,7 @@ class Inscrit(object):
         self.referents = []
         self.inscriptions = []
         self.conges = []
-        self.journees = {}
+        self.journees = Journees(self)
         self.jours_conges = {}
         self.factures_cloturees = {}
         self.corrections = {}
@@ -1710,14 +2087,29 @@ class Inscrit(object):
         for obj in self.parents.values() + self.freres_soeurs + self.referents + self.inscriptions: # TODO + self.presences.values():
             if obj:
                 obj.create()
+        # les numeros de facture dependent de la position dans creche.inscrits
+        factures_cache.Invalide()
         
     def delete(self):
         print 'suppression inscrit'
         sql_connection.execute('DELETE FROM INSCRITS WHERE idx=?', (self.idx,))
+        factures_cache.Invalide()
         for obj in self.parents.values() + self.freres_soeurs + self.referents + self.inscriptions + self.journees.values():
             if obj is not None:
                 obj.delete()
 
+    def __getattr__(self, name):
+        # la photo n'est lue dans la base qu'au premier acces
+        if name == 'photo':
+            photo = None
+            if self.idx and sql_connection:
+                entry = sql_connection.execute('SELECT photo FROM INSCRITS WHERE idx=?', (self.idx,)).fetchone()
+                if entry and entry[0]:
+                    photo = binascii.a2b_base64(entry[0])
+            self.__dict__['photo'] = photo
+            return photo
+        raise AttributeError(name)
+
     def __setattr__(self, name, value):
         if name in self.__dict__:
             old_value = self.__dict__[name]
@@ -1728,9 +2120,10 @@ class Inscrit(object):
             value = binascii.b2a_base64(value)
         elif name in ('categorie', ) and value is not None and self.idx:
             value = value.idx
+        if name in ['prenom', 'nom', 'naissance', 'handicap', 'tarifs']:
+            factures_cache.InvalideInscrit(self)
         if name in ['prenom', 'nom', 'sexe', 'naissance', 'adresse', 'code_postal', 'ville', 'numero_securite_sociale', 'numero_allocataire_caf', 'handicap', 'tarifs', 'marche', 'photo', 'combinaison', 'notes', 'notes_parents', 'categorie', 'medecin_traitant', 'telephone_medecin_traitant', 'assureur', 'numero_police_assurance', 'allergies'] and self.idx:
-            print 'update', name, (old_value, value)
-            sql_connection.execute('UPDATE INSCRITS SET %s=? WHERE idx=?' % name, (value, self.idx))
+            sql_connection.UpdateField('INSCRITS', name, value, self.idx)
 
     def AddConge(self, conge, calcule=True):
         self.conges.append(conge)
@@ -1750,6 +2143,7 @@ class Inscrit(object):
         if parent is None:
             parent = creche
         self.jours_conges = {}
+        InvalideCalculs(self)
 
         def AddPeriode(debut, fin, conge):
             date = debut
@@ -1859,6 +2253,9 @@ class Inscrit(object):
         """Retourne les infos sur une journée
         \param date la journée
         """
+        return self.etats.GetState(date)
+
+    def CalculeState(self, date):
         if self.IsDateConge(date):
             return State(ABSENT)
         
@@ -1966,5 +2363,4 @@ class Alerte(object):
     def __setattr__(self, name, value):
         self.__dict__[name] = value
         if name in ['acquittement'] and self.idx:
-            print 'update', name
-            sql_connection.execute('UPDATE ALERTES SET %s=? WHERE idx=?' % name, (value, self.idx))
\ No newline at end of file
+            sql_connection.UpdateField('ALERTES', name, value, self.idx)
\ No newline at end of file
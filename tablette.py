@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+##    This file is part of Gertrude.
+##
+##    Gertrude is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation; either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    Gertrude is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with Gertrude; if not, see <http://www.gnu.org/licenses/>.
+
+import time, datetime
+from constants import *
+from parameters import today
+from functions import GetPrenomNom
+from sqlobjects import Journee
+
+class PeriodePresence(object):
+    def __init__(self, date, arrivee=None, depart=None, absent=False, malade=False):
+        self.date = date
+        self.arrivee = arrivee
+        self.depart = depart
+        self.absent = absent
+        self.malade = malade
+
+class JournalTablette(object):
+    # evenements du journal de la tablette, lus morceau par morceau au fil du telechargement
+    def __init__(self, reprise=None):
+        self.periodes = {}
+        self.derniere_ligne = None
+        # derniere ligne traitee par une synchronisation sans offset (versions precedentes) :
+        # les lignes jusqu'a celle-ci sont ignorees
+        self.reprise = reprise
+        self.lignes_reprise = []
+
+    def AjouteLigne(self, line):
+        try:
+            label, idx, date = line.split()
+            idx = int(idx)
+            tm = time.strptime(date, "%Y-%m-%d@%H:%M")
+            date = datetime.date(tm.tm_year, tm.tm_mon, tm.tm_mday)
+            periodes = self.periodes.setdefault(idx, [])
+            if label == "arrivee":
+                arrivee = tm.tm_hour * 12 + tm.tm_min / creche.granularite * (creche.granularite/BASE_GRANULARITY)
+                periodes.append(PeriodePresence(date, arrivee))
+            elif label == "depart":
+                depart = tm.tm_hour * 12 + (tm.tm_min+creche.granularite-1) / creche.granularite * (creche.granularite/BASE_GRANULARITY)
+                if len(periodes) and periodes[-1].date == date and periodes[-1].arrivee:
+                    periodes[-1].depart = depart
+                else:
+                    periodes.append(PeriodePresence(date, None, depart))
+            elif label == "absent":
+                periodes.append(PeriodePresence(date, absent=True))
+            elif label == "malade":
+                periodes.append(PeriodePresence(date, malade=True))
+            self.derniere_ligne = line
+        except Exception, e:
+            pass
+
+    def AjouteLignes(self, data):
+        for line in data.split("\n"):
+            if self.reprise is None:
+                self.AjouteLigne(line)
+            elif line == self.reprise:
+                self.reprise = None
+                self.lignes_reprise = []
+            else:
+                self.lignes_reprise.append(line)
+
+    def Termine(self):
+        # derniere ligne traitee introuvable : tout le journal est pris en compte
+        if self.reprise is not None:
+            self.reprise = None
+            for line in self.lignes_reprise:
+                self.AjouteLigne(line)
+            self.lignes_reprise = []
+
+    def Applique(self):
+        # chaque journee concernee est remise a zero une seule fois, puis recoit toutes ses periodes
+        errors = []
+        for key in self.periodes:
+            inscrit = creche.GetInscrit(key)
+            if not inscrit:
+                errors.append(u"Inscrit %d: Inconnu!" % key)
+                continue
+            journees = {}
+            for periode in self.periodes[key]:
+                value = 0
+                if periode.absent:
+                    value = VACANCES
+                elif periode.malade:
+                    value = MALADE
+                elif not periode.arrivee:
+                    if not periode.date in inscrit.journees:
+                        errors.append(u"%s : Pas d'arrivée enregistrée le %s" % (GetPrenomNom(inscrit), periode.date))
+                    reference = inscrit.GetJournee(periode.date)
+                    if reference:
+                        periode.arrivee = reference.GetPlageHoraire()[0]
+                        if periode.arrivee is None:
+                            periode.arrivee = int(creche.ouverture*(60 / BASE_GRANULARITY))
+                    else:
+                        continue
+                elif not periode.depart:
+                    if periode.date != today:
+                        errors.append(u"%s : Pas de départ enregistré le %s" % (GetPrenomNom(inscrit), periode.date))
+                    reference = inscrit.GetJournee(periode.date)
+                    if reference:
+                        periode.depart = reference.GetPlageHoraire()[-1]
+                        if periode.depart is None:
+                            periode.depart = int(creche.fermeture*(60 / BASE_GRANULARITY))
+                    else:
+                        continue
+
+                if periode.date not in journees:
+                    if periode.date in inscrit.journees:
+                        journee = inscrit.journees[periode.date]
+                        journee.RemoveActivities(0)
+                        journee.RemoveActivities(0|PREVISIONNEL)
+                    else:
+                        journee = inscrit.journees[periode.date] = Journee(inscrit, periode.date)
+                    journees[periode.date] = journee
+                if value < 0:
+                    journees[periode.date].SetState(value)
+                else:
+                    journees[periode.date].SetActivity(periode.arrivee, periode.depart, value)
+        return errors
+
+def SynchroniseTablette(connection):
+    # seuls les evenements ecrits depuis la derniere synchronisation sont telecharges (offset
+    # dans le journal du serveur), et les presences sont ecrites dans une seule transaction
+    offset = creche.last_tablette_offset or 0
+    reprise = None
+    if not offset and len(creche.last_tablette_synchro) > 20:
+        reprise = creche.last_tablette_synchro
+    journal = JournalTablette(reprise)
+    while True:
+        start, data = connection.LoadJournal(offset)
+        if start != offset:
+            # journal remis a zero sur le serveur
+            journal.reprise = None
+        if not data:
+            break
+        journal.AjouteLignes(data)
+        offset = start + len(data)
+    journal.Termine()
+    errors = journal.Applique()
+    if offset != creche.last_tablette_offset:
+        creche.last_tablette_offset = offset
+    if journal.derniere_ligne:
+        creche.last_tablette_synchro = journal.derniere_ligne
+    if sql_connection:
+        sql_connection.commit()
+    return errors
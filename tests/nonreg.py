@@ -4,11 +4,13 @@ import sys, os, __builtin__
 sys.path.append("..")
 import unittest
 import sqlinterface
+import data, backups
 from sqlobjects import *
 from cotisation import *
 from facture import Facture
 from doc_planning_detaille import PlanningDetailleModifications
 from doc_coordonnees_parents import CoordonneesModifications
+from doc_etat_presences import EtatsPresenceModifications
 from ooffice import GenerateOODocument
 
 __builtin__.first_date = datetime.date(2010, 1, 1) 
@@ -63,6 +65,10 @@ class GertrudeTestCase(unittest.TestCase):
         return result
         
 class DatabaseTests(unittest.TestCase):
+    def tearDown(self):
+        if os.path.isfile("gertrude.db"):
+            os.remove("gertrude.db")
+
     def test_creation(self):
         filename = "gertrude.db"
         if os.path.isfile(filename):
@@ -70,6 +76,387 @@ class DatabaseTests(unittest.TestCase):
         con = sqlinterface.SQLConnection(filename)
         con.Create()
 
+    def test_indexes(self):
+        filename = "gertrude.db"
+        if os.path.isfile(filename):
+            os.remove(filename)
+        con = sqlinterface.SQLConnection(filename)
+        con.Create()
+        self.assertEquals(con.CheckIndexes(None), [])
+        con.execute("DROP INDEX IDX_ACTIVITES_INSCRIT_DATE")
+        self.assertEquals(con.CheckIndexes(None), ["IDX_ACTIVITES_INSCRIT_DATE"])
+        con.close()
+
+    def test_ecriture_differee(self):
+        filename = "gertrude.db"
+        if os.path.isfile(filename):
+            os.remove(filename)
+        con = sqlinterface.SQLConnection(filename)
+        con.Create()
+        con.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (1, 'Gertrude', 'GPL')")
+        con.UpdateField('INSCRITS', 'prenom', 'Bertrand', 1)
+        con.UpdateField('INSCRITS', 'nom', 'Songis', 1)
+        con.UpdateField('INSCRITS', 'prenom', 'Hubert', 1)
+        con.UpdateField('CRECHE', 'nom', 'Les Petits Pouces')
+        self.assertEquals(con.modifications, {('INSCRITS', 1): {'prenom': 'Hubert', 'nom': 'Songis'}, ('CRECHE', None): {'nom': 'Les Petits Pouces'}})
+        self.assertEquals(con.execute("SELECT prenom, nom FROM INSCRITS WHERE idx=1").fetchall(), [('Hubert', 'Songis')])
+        self.assertEquals(con.modifications, {})
+        self.assertEquals(con.execute("SELECT nom FROM CRECHE").fetchall(), [('Les Petits Pouces',)])
+        # une ecriture en erreur ne perd pas les modifications en attente
+        con.UpdateField('INSCRITS', 'inconnu', 1, 1)
+        con.UpdateField('CRECHE', 'nom', 'Les Petits Mousses')
+        self.assertRaises(Exception, con.Flush)
+        self.assertEquals(con.modifications, {('INSCRITS', 1): {'inconnu': 1}, ('CRECHE', None): {'nom': 'Les Petits Mousses'}})
+        con.modifications = {}
+        con.close()
+
+    def test_photo_a_la_demande(self):
+        import binascii
+        filename = "gertrude.db"
+        if os.path.isfile(filename):
+            os.remove(filename)
+        __builtin__.sql_connection = sqlinterface.SQLConnection(filename)
+        sql_connection.Create()
+        sql_connection.execute("INSERT INTO INSCRITS (idx, prenom, nom, photo) VALUES (NULL, 'Gertrude', 'GPL', ?)", (binascii.b2a_base64("photo"),))
+        creche = sql_connection.Load(None)
+        inscrit = creche.inscrits[0]
+        self.assertFalse("photo" in inscrit.__dict__)
+        self.assertEquals(inscrit.photo, "photo")
+        inscrit.photo = "autre photo"
+        self.assertEquals(sql_connection.execute("SELECT photo FROM INSCRITS").fetchall(), [(binascii.b2a_base64("autre photo"),)])
+        sql_connection.close()
+
+    def test_chargement_partiel(self):
+        filename = "gertrude.db"
+        if os.path.isfile(filename):
+            os.remove(filename)
+        __builtin__.sql_connection = sqlinterface.SQLConnection(filename)
+        sql_connection.Create()
+        sql_connection.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (1, 'Gertrude', 'GPL')")
+        for date in (datetime.date(2009, 3, 2), datetime.date(2009, 3, 20), datetime.date(2009, 4, 1), first_date):
+            sql_connection.execute("INSERT INTO ACTIVITES (idx, inscrit, date, value, debut, fin) VALUES (NULL, 1, ?, 0, 96, 216)", (date,))
+        inscrit = sql_connection.Load(None).inscrits[0]
+        self.assertEquals(dict.keys(inscrit.journees), [first_date])
+        self.assertTrue(datetime.date(2009, 3, 2) in inscrit.journees)
+        self.assertEquals(sorted(dict.keys(inscrit.journees)), [datetime.date(2009, 3, 2), datetime.date(2009, 3, 20), first_date])
+        self.assertEquals(len(inscrit.journees), 4)
+        sql_connection.close()
+
+class ListeIndexeeTests(unittest.TestCase):
+    def test_index_par_idx(self):
+        inscrits = ListeIndexee()
+        for idx, prenom in ((5, "Gertrude"), (7, "Gertrude"), (None, "Bertrand")):
+            inscrit = Inscrit(creation=False)
+            inscrit.prenom, inscrit.idx = prenom, idx
+            inscrits.append(inscrit)
+        self.assertTrue(inscrits.Get(7) is inscrits[1])
+        self.assertEquals(inscrits.GetIndex(inscrits[1]), 1)
+        inscrits[2].idx = 9
+        self.assertTrue(inscrits.Get(9) is inscrits[2])
+        del inscrits[0]
+        self.assertEquals(inscrits.Get(5), None)
+        self.assertEquals(inscrits.GetIndex(inscrits[0]), 0)
+        self.assertRaises(ValueError, inscrits.GetIndex, Inscrit(creation=False))
+
+class BackupStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.filenames = ["sauvegarde.db", "sauvegarde.backups"]
+        self.tearDown()
+
+    def tearDown(self):
+        for filename in self.filenames:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_sauvegarde_restauration(self):
+        import filecmp, shutil
+        con = sqlinterface.SQLConnection("sauvegarde.db")
+        con.Create()
+        con.close()
+        store = backups.BackupStore("sauvegarde.backups")
+        premiere = store.Backup("sauvegarde.db")
+        pages = store.con.execute("SELECT COUNT(*) FROM PAGES").fetchone()[0]
+        shutil.copyfile("sauvegarde.db", "sauvegarde.db.orig")
+        self.filenames.append("sauvegarde.db.orig")
+        con.open()
+        con.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (NULL, 'Gertrude', 'GPL')")
+        con.close()
+        seconde = store.Backup("sauvegarde.db")
+        # seules les pages modifiees sont stockees une deuxieme fois
+        self.assertTrue(store.con.execute("SELECT COUNT(*) FROM PAGES").fetchone()[0] - pages < pages / 2)
+        self.assertTrue(store.Restore(premiere, "sauvegarde.db"))
+        self.assertTrue(filecmp.cmp("sauvegarde.db", "sauvegarde.db.orig", shallow=False))
+        # retention : la plus recente de chaque heure
+        store.con.execute("UPDATE SAUVEGARDES SET date=date-7200 WHERE idx=?", (premiere,))
+        troisieme = store.Backup("sauvegarde.db")
+        self.assertEquals(store.Purge((24, 0, 0)), 1)
+        self.assertEquals([idx for idx, date in store.Liste()], [troisieme, premiere])
+        self.assertEquals(store.Purge((1, 0, 0), keep=[premiere]), 0)
+        self.assertEquals(store.Purge((1, 0, 0)), 1)
+        self.assertTrue(store.Restore(troisieme, "sauvegarde.db"))
+        self.assertTrue(filecmp.cmp("sauvegarde.db", "sauvegarde.db.orig", shallow=False))
+        store.close()
+
+    def test_sauvegarde_wal(self):
+        import sqlite3
+        self.filenames.extend(["sauvegarde.db-wal", "sauvegarde.db-shm", "restauration.db"])
+        con = sqlite3.connect("sauvegarde.db")
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA wal_autocheckpoint=0")
+        con.execute("CREATE TABLE INSCRITS (idx INTEGER PRIMARY KEY, prenom VARCHAR)")
+        con.commit()
+        # un autre poste lit encore la version precedente : le journal ne peut pas etre reporte
+        lecteur = sqlite3.connect("sauvegarde.db")
+        lecteur.execute("BEGIN")
+        lecteur.execute("SELECT COUNT(*) FROM INSCRITS").fetchone()
+        con.execute("INSERT INTO INSCRITS (idx, prenom) VALUES (NULL, 'Gertrude')")
+        con.commit()
+        store = backups.BackupStore("sauvegarde.backups")
+        sauvegarde = store.Backup("sauvegarde.db")
+        self.assertFalse(os.path.exists("sauvegarde.db.copie"))
+        lecteur.rollback()
+        lecteur.close()
+        con.execute("INSERT INTO INSCRITS (idx, prenom) VALUES (NULL, 'Bertrand')")
+        con.commit()
+        self.assertEquals(store.Backup("sauvegarde.db"), sauvegarde + 1)
+        for idx, prenoms in ((sauvegarde, [("Gertrude",)]), (sauvegarde + 1, [("Gertrude",), ("Bertrand",)])):
+            self.assertTrue(store.Restore(idx, "restauration.db"))
+            restauration = sqlite3.connect("restauration.db")
+            self.assertEquals(restauration.execute("SELECT prenom FROM INSCRITS ORDER BY idx").fetchall(), prenoms)
+            restauration.close()
+        store.close()
+        con.close()
+
+class LiveFileConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.filename = "partage.db"
+        self.tearDown()
+
+    def tearDown(self):
+        for filename in (self.filename, self.filename + "-wal", self.filename + "-shm"):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_modifications_autre_poste(self):
+        connection = data.LiveFileConnection(self.filename, None, None)
+        __builtin__.creche, __builtin__.readonly = connection.Load()
+        self.assertEquals(sql_connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEquals(connection.Update(), (None, None))
+        poste = sqlinterface.SQLConnection(self.filename, "WAL")
+        poste.open()
+        poste.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (NULL, 'Gertrude', 'GPL')")
+        poste.commit()
+        _sql_connection, _creche = connection.Update()
+        self.assertEquals([inscrit.prenom for inscrit in _creche.inscrits], ["Gertrude"])
+        __builtin__.sql_connection, __builtin__.creche = _sql_connection, _creche
+        self.assertEquals(connection.Update(), (None, None))
+        # seule la journee modifiee par l'autre poste est relue
+        inscrit = creche.inscrits[0]
+        poste.execute("INSERT INTO ACTIVITES (idx, inscrit, date, value, debut, fin) VALUES (NULL, ?, ?, 0, 96, 120)", (inscrit.idx, datetime.date(2016, 1, 4)))
+        poste.commit()
+        self.assertEquals(connection.Update(), (sql_connection, creche))
+        self.assertTrue(creche.inscrits[0] is inscrit)
+        self.assertEquals(inscrit.journees[datetime.date(2016, 1, 4)].activites.keys(), [(96, 120, 0)])
+        poste.execute("DELETE FROM ACTIVITES")
+        poste.commit()
+        self.assertEquals(connection.Update(), (sql_connection, creche))
+        self.assertEquals(inscrit.journees, {})
+        # les modifications de ce poste ne sont pas relues
+        sql_connection.execute("INSERT INTO ACTIVITES (idx, inscrit, date, value, debut, fin) VALUES (NULL, ?, ?, 0, 96, 120)", (inscrit.idx, datetime.date(2016, 1, 5)))
+        sql_connection.commit()
+        self.assertEquals(sql_connection.LoadModifications(creche), [])
+        sql_connection.close()
+        poste.close()
+
+    def test_pas_de_restauration(self):
+        connection = data.LiveFileConnection(self.filename, None, None)
+        __builtin__.creche, __builtin__.readonly = connection.Load()
+        poste = sqlinterface.SQLConnection(self.filename, "WAL")
+        poste.open()
+        poste.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (NULL, 'Gertrude', 'GPL')")
+        poste.commit()
+        # la base ouverte par les autres postes n'est pas remplacee
+        self.assertFalse(connection.Restore())
+        self.assertEquals(poste.execute("SELECT prenom FROM INSCRITS").fetchall(), [("Gertrude",)])
+        sql_connection.close()
+        poste.close()
+
+class HttpConnectionTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile, threading, gertrude_server
+        __builtin__.force_token = False
+        self.directory = tempfile.mkdtemp()
+        self.server = gertrude_server.CreateServer(0, self.directory)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://localhost:%d/gertrude.php" % self.server.server_port
+        self.filenames = ["client1.db", "client2.db", "client1.db.version", "client2.db.version", data.TOKEN_FILENAME]
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        for filename in self.filenames:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_synchro_differences(self):
+        for filename in self.filenames:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.journal = []
+        client1 = data.HttpConnection(self.url, "client1.db", "client1")
+        self.assertTrue(client1.get_token())
+        self.assertEquals(client1.upload(), 1)
+        self.assertEquals(client1.version, 1)
+        client2 = data.HttpConnection(self.url, "client2.db", "client2")
+        client2.token = 0
+        client2.do_download()
+        self.assertEquals(client2.version, 1)
+        sql_connection.execute("INSERT INTO INSCRITS (idx, prenom, nom, naissance) VALUES (NULL, ?, ?, ?)", ("Gertrude", "GPL", datetime.date(2010, 1, 1)))
+        sql_connection.UpdateField("CRECHE", "nom", "Les Petits Pouces")
+        self.assertTrue(client1.save())
+        self.assertEquals(client1.upload(), 1)
+        self.assertEquals(client1.version, 2)
+        self.assertEquals(sql_connection.journal, [])
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "changes_2.gz")))
+        client2.do_download()
+        self.assertEquals(client2.version, 2)
+        con = sqlinterface.SQLConnection("client2.db")
+        con.open()
+        self.assertEquals(con.execute("SELECT prenom, naissance FROM INSCRITS").fetchall(), [("Gertrude", "2010-01-01")])
+        self.assertEquals(con.execute("SELECT nom FROM CRECHE").fetchall(), [("Les Petits Pouces",)])
+        con.close()
+        # version inconnue du serveur => retour au transfert complet
+        client1.version = 5
+        sql_connection.UpdateField("CRECHE", "nom", "Les Petits Mousses")
+        self.assertTrue(client1.save())
+        self.assertEquals(client1.upload(), 3)
+        self.assertEquals(client1.version, 3)
+        client2.do_download()
+        self.assertEquals(client2.version, 3)
+        self.assertTrue(client1.rel_token())
+        sql_connection.close()
+
+    def test_session_persistante(self):
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.journal = []
+        client1 = data.HttpConnection(self.url, "client1.db", "client1")
+        self.assertTrue(client1.get_token())
+        sock = client1.session.sock
+        self.assertEquals(client1.upload(), 1)
+        self.assertTrue(client1.session.sock is sock)
+        client1.Exit()
+        self.assertEquals(client1.session, None)
+        client2 = data.HttpConnection(self.url, "client2.db", "client2")
+        self.assertTrue(client2.do_download())
+        # jeton et modifications depuis la version locale en un seul aller-retour
+        actions = []
+        urlopen = client2.urlopen
+        def urlopen_trace(action, *args, **kwargs):
+            actions.append(action)
+            return urlopen(action, *args, **kwargs)
+        client2.urlopen = urlopen_trace
+        self.assertEquals(client2.download(), 1)
+        self.assertEquals(actions, ["token_download"])
+        self.assertEquals(client2.version, 1)
+        self.assertTrue(client2.rel_token())
+        sql_connection.close()
+
+    def test_transfert_par_morceaux(self):
+        import filecmp
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.close()
+        chunk_size, data.TRANSFER_CHUNK_SIZE = data.TRANSFER_CHUNK_SIZE, 1024
+        try:
+            client1 = data.HttpConnection(self.url, "client1.db", "client1")
+            self.assertTrue(client1.get_token())
+            self.assertEquals(client1.do_upload(), 1)
+            self.assertTrue(filecmp.cmp("client1.db", os.path.join(self.directory, "gertrude.db"), shallow=False))
+            size, md5, version = client1.urlopen("download_info", raw=True).split()
+            self.assertEquals(int(version), 1)
+            # un telechargement interrompu reprend sur le fichier partiel
+            part = "client2.db.%s.part" % md5
+            self.filenames.append(part)
+            f = file(part, "wb")
+            f.write(client1.urlopen("download_chunk", params={"offset": 0, "size": 1024}, raw=True))
+            f.close()
+            client2 = data.HttpConnection(self.url, "client2.db", "client2")
+            self.assertEquals(client2.do_download_gzip(), (int(size), 1))
+            self.assertFalse(os.path.exists(part))
+            self.assertTrue(filecmp.cmp("client1.db", "client2.db", shallow=False))
+            self.assertTrue(client1.rel_token())
+        finally:
+            data.TRANSFER_CHUNK_SIZE = chunk_size
+
+    def test_version_avec_la_base(self):
+        # la version est lue avec les donnees, jamais redemandee apres le telechargement
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.close()
+        client1 = data.HttpConnection(self.url, "client1.db", "client1")
+        self.assertTrue(client1.get_token())
+        self.assertEquals(client1.do_upload(), 1)
+        client2 = data.HttpConnection(self.url, "client2.db", "client2")
+        actions = []
+        urlopen = client2.urlopen
+        def urlopen_trace(action, *args, **kwargs):
+            actions.append(action)
+            result = urlopen(action, *args, **kwargs)
+            if action == "download_chunk":
+                # envoi d'un autre poste juste apres le telechargement
+                self.server.gertrude.set_full_version()
+            return result
+        client2.urlopen = urlopen_trace
+        self.assertTrue(client2.do_download())
+        self.assertFalse("version" in actions)
+        self.assertEquals(client2.version, 1)
+        self.assertEquals(client1.urlopen("download_version", raw=True).split("\n", 1)[0], "2")
+        self.assertTrue(client1.rel_token())
+        client1.close()
+        client2.close()
+
+    def test_envoi_jeton_perdu(self):
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.close()
+        client1 = data.HttpConnection(self.url, "client1.db", "client1")
+        self.assertTrue(client1.get_token())
+        # un autre poste force le jeton : le serveur refuse chaque morceau
+        self.server.gertrude.get_token(1)
+        self.assertEquals(client1.do_upload_gzip(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "gertrude.db")))
+        client1.close()
+
+    def test_synchro_tablette(self):
+        from tablette import SynchroniseTablette
+        __builtin__.sql_connection = sqlinterface.SQLConnection("client1.db")
+        sql_connection.Create()
+        sql_connection.execute("INSERT INTO INSCRITS (idx, prenom, nom) VALUES (1, 'Gertrude', 'GPL')")
+        __builtin__.creche = sql_connection.Load(None)
+        self.server.gertrude.journal_append("arrivee 1 2015-03-02@08:00\ndepart 1 2015-03-02@12:00\n")
+        client1 = data.HttpConnection(self.url, "client1.db", "client1")
+        chunk_size, data.TRANSFER_CHUNK_SIZE = data.TRANSFER_CHUNK_SIZE, 40
+        try:
+            self.assertEquals(SynchroniseTablette(client1), [])
+            self.assertEquals(creche.last_tablette_offset, 53)
+            self.assertEquals(client1.LoadJournal(53), (53, ""))
+            # seuls les nouveaux evenements sont telecharges
+            self.server.gertrude.journal_append("malade 1 2015-03-03@08:00\narrivee 1 2015-03")
+            self.assertEquals(SynchroniseTablette(client1), [])
+            self.assertEquals(creche.last_tablette_offset, 79)
+        finally:
+            data.TRANSFER_CHUNK_SIZE = chunk_size
+        self.assertEquals(sql_connection.execute("SELECT date, value, debut, fin FROM ACTIVITES ORDER BY date, value").fetchall()[0], (u"2015-03-02", 0, 96, 144))
+        self.assertEquals(sql_connection.execute("SELECT value FROM ACTIVITES WHERE date=?", (datetime.date(2015, 3, 3),)).fetchone(), (MALADE,))
+        self.assertEquals(sql_connection.execute("SELECT last_tablette_offset FROM CRECHE").fetchone(), (79,))
+        client1.close()
+        sql_connection.close()
+
 class PlanningTests(GertrudeTestCase):
     def setUp(self):
         GertrudeTestCase.setUp(self)
@@ -96,6 +483,50 @@ class PlanningTests(GertrudeTestCase):
         day.SetActivity(2, 8, 0)
         self.assertEquals(len(day.activites), 2)
 
+    def test_fusion_tranches(self):
+        day = Day()
+        day.SetActivity(0, 10, 0)
+        day.SetActivity(20, 30, 0)
+        day.SetActivity(40, 50, 0)
+        day.SetActivity(9, 41, 0)
+        self.assertEquals(day.activites.keys(), [(0, 50, 0)])
+        day.ClearActivity(20, 30, 0)
+        self.assertEquals(day.activites.GetTranches(0), [(0, 20), (30, 50)])
+        self.assertEquals(day.GetActivity(25), None)
+        reference = Day()
+        reference.SetActivity(15, 35, 0)
+        self.assertEquals(GetUnionHeures(day, reference), [(0, 50)])
+
+    def test_occupation(self):
+        occupation = Occupation([(0, 10, 20), (0, 15, 30), (1, 0, 288), (0, 30, 30)])
+        self.assertEquals(occupation[0][9:31], [0] + [1] * 5 + [2] * 5 + [1] * 10 + [0])
+        self.assertEquals(occupation[1], [1] * 288)
+        self.assertEquals(occupation[2], [0] * 288)
+        self.assertEquals(occupation.GetDepassements(0, 1), range(15, 20))
+        self.assertEquals(occupation.GetDepassements(2, 0), [])
+
+    def test_calendrier_etats(self):
+        inscrit = self.AddInscrit()
+        inscription = Inscription(inscrit, creation=False)
+        inscription.debut, inscription.fin = datetime.date(2010, 9, 6), datetime.date(2011, 7, 27)
+        for i in range(5):
+            inscription.reference[i].AddActivity(96, 180, 0, -1)
+        inscrit.inscriptions.append(inscription)
+        self.assertEquals(inscrit.GetState(datetime.date(2010, 9, 9)).state, PRESENT)
+        for jour in (9, 10, 13):
+            self.AddActivite(inscrit, datetime.date(2010, 9, jour), 96, 180, MALADE)
+        self.assertEquals(inscrit.GetState(datetime.date(2010, 9, 9)).state, MALADE)
+        self.assertEquals(inscrit.etats.GetDebutMaladie(datetime.date(2010, 9, 13)), (datetime.date(2010, 9, 9), 2))
+        self.assertEquals(inscrit.etats.GetFinMaladie(datetime.date(2010, 9, 9)), datetime.date(2010, 9, 10))
+        self.assertEquals(inscription.GetNombreJoursCongesPoses(), 0)
+        inscrit.journees[datetime.date(2010, 9, 10)].RemoveActivity(96, 180, MALADE)
+        self.assertEquals(inscrit.GetState(datetime.date(2010, 9, 10)).state, VACANCES)
+        self.assertEquals(inscrit.etats.GetDebutMaladie(datetime.date(2010, 9, 13)), (datetime.date(2010, 9, 13), 0))
+        self.assertEquals(inscrit.etats.GetFinMaladie(datetime.date(2010, 9, 9)), datetime.date(2010, 9, 9))
+        self.assertEquals(inscription.GetNombreJoursCongesPoses(), 1)
+        self.assertFalse(inscription.IsNombreSemainesCongesAtteint(datetime.date(2010, 9, 10)))
+        self.assertTrue(inscription.IsNombreSemainesCongesAtteint(datetime.date(2010, 9, 11)))
+
 class DocumentsTests(GertrudeTestCase):
     def setUp(self):
         GertrudeTestCase.setUp(self)
@@ -132,7 +563,150 @@ class DocumentsTests(GertrudeTestCase):
         errors = GenerateOODocument(modifications, filename="./test.odt", gauge=None)
         self.assertEquals(len(errors), 0)
         os.unlink("./test.odt")
+
+    def test_modele_compile(self):
+        import zipfile, ooffice
+        modifications = CoordonneesModifications(None, datetime.date(2010, 9, 7))
+        GenerateOODocument(modifications, filename="./test1.odt", gauge=None)
+        modele = ooffice.GetModele(GetTemplateFile(modifications.template))
+        GenerateOODocument(modifications, filename="./test2.odt", gauge=None)
+        self.assertTrue(ooffice.GetModele(GetTemplateFile(modifications.template)) is modele)
+        # styles.xml n'est pas modifie par le document : serialisation du modele reprise telle quelle
+        zip1, zip2 = zipfile.ZipFile("./test1.odt"), zipfile.ZipFile("./test2.odt")
+        self.assertEquals(zip1.namelist(), zip2.namelist())
+        for f in zip1.namelist():
+            self.assertEquals(zip1.read(f), zip2.read(f))
+        self.assertEquals(zip1.read("styles.xml"), modele.GetDom("styles.xml").toxml("UTF-8"))
+        zip1.close()
+        zip2.close()
+        os.unlink("./test1.odt")
+        os.unlink("./test2.odt")
         
+    def test_lignes_en_flux(self):
+        import zipfile
+        date = datetime.date(2010, 9, 7)
+        for i, inscrit in enumerate(creche.inscrits):
+            inscrit.prenom = "Enfant%d" % i
+        selection = {date: [(None, None, inscrit, 96, 180, 84, "") for inscrit in creche.inscrits]}
+        modifications = EtatsPresenceModifications(date, date, None, None, None, selection)
+        errors = GenerateOODocument(modifications, filename="./test.ods", gauge=None)
+        self.assertEquals(len(errors), 0)
+        zip = zipfile.ZipFile("./test.ods")
+        content = zip.read("content.xml")
+        zip.close()
+        self.assertFalse("gertrude-flux" in content)
+        positions = [content.find(">Enfant%d " % i) for i in range(10)]
+        self.assertTrue(-1 not in positions)
+        self.assertEquals(positions, sorted(positions))
+        os.unlink("./test.ods")
+
+    def test_travail_documents(self):
+        from ooffice import TravailDocuments
+        documents = [("./test%d.odt" % i, CoordonneesModifications(None, datetime.date(2010, 9, 7))) for i in range(3)]
+        notifications = []
+        def callback(valeur, message, errors, fin):
+            notifications.append((valeur, fin))
+            if message and message.startswith("Document 1/3"):
+                travail.Annule()
+        travail = TravailDocuments(documents, callback=callback)
+        travail.Execute()
+        # annulation apres le premier document
+        self.assertEquals(travail.termines, set([0]))
+        self.assertFalse(travail.IsTermine())
+        self.assertEquals(notifications[-1], (33, True))
+        self.assertFalse(os.path.exists("./test1.odt"))
+        # la reprise ne regenere pas le premier document
+        os.unlink("./test0.odt")
+        travail.Execute()
+        self.assertTrue(travail.IsTermine())
+        self.assertEquals(notifications[-1], (100, True))
+        self.assertFalse(os.path.exists("./test0.odt"))
+        self.assertEquals(travail.GetErrors(), {})
+        os.unlink("./test1.odt")
+        os.unlink("./test2.odt")
+
+    def test_conversion_pdf_par_lots(self):
+        import conversion
+        from ooffice import TravailDocuments
+        conversion.convertisseur = conversion.ConvertisseurTest()
+        conversion.TAILLE_LOT, taille_lot = 2, conversion.TAILLE_LOT
+        try:
+            documents = [("./test%d.odt" % i, CoordonneesModifications(None, datetime.date(2010, 9, 7))) for i in range(3)]
+            envois = []
+            travail = TravailDocuments(documents, pdf=True, envoi=lambda filename, modifications: envois.append(filename))
+            travail.Execute()
+            self.assertTrue(travail.IsTermine())
+            self.assertEquals(conversion.convertisseur.lots, [["./test0.odt", "./test1.odt"], ["./test2.odt"]])
+            self.assertEquals(envois, ["./test0.pdf", "./test1.pdf", "./test2.pdf"])
+            for i in range(3):
+                self.assertFalse(os.path.exists("./test%d.odt" % i))
+                self.assertTrue(file("./test%d.pdf" % i).read().startswith("%PDF"))
+                os.unlink("./test%d.pdf" % i)
+        finally:
+            conversion.convertisseur = None
+            conversion.TAILLE_LOT = taille_lot
+
+    def test_conversion_pdf_echec(self):
+        import conversion
+        from ooffice import TravailDocuments
+        class ConvertisseurEchec(conversion.ConvertisseurTest):
+            def Convertit(self, documents):
+                return dict((filename, Exception("echec")) for filename, pdffilename in documents)
+        conversion.convertisseur = ConvertisseurEchec()
+        try:
+            travail = TravailDocuments([("./test0.odt", CoordonneesModifications(None, datetime.date(2010, 9, 7)))], pdf=True)
+            travail.Execute()
+            self.assertFalse(travail.IsTermine())
+            self.assertTrue("./test0.pdf" in travail.GetErrors())
+            # le document ODF est garde quand sa conversion a echoue
+            self.assertTrue(os.path.exists("./test0.odt"))
+            os.unlink("./test0.odt")
+        finally:
+            conversion.convertisseur = None
+
+    def test_conversion_profil_prive(self):
+        # soffice ne doit pas rejoindre une instance LibreOffice deja ouverte par l'utilisateur
+        import conversion, tempfile, shutil, stat
+        repertoire = tempfile.mkdtemp()
+        try:
+            soffice = os.path.join(repertoire, "soffice")
+            file(soffice, "w").write('#!/bin/sh\necho "$@" > "%s"\n' % os.path.join(repertoire, "arguments"))
+            os.chmod(soffice, stat.S_IRWXU)
+            convertisseur = conversion.ConvertisseurLigneCommande(soffice)
+            self.assertTrue("./test.odt" in convertisseur.Convertit([("./test.odt", "./test.pdf")]))
+            profil = convertisseur.profil
+            self.assertTrue(os.path.isdir(profil))
+            arguments = file(os.path.join(repertoire, "arguments")).read().split()
+            self.assertEquals(arguments[0], "-env:UserInstallation=file://%s" % profil)
+            convertisseur.Arrete()
+            self.assertFalse(os.path.exists(profil))
+        finally:
+            shutil.rmtree(repertoire)
+
+class ChampsTests(unittest.TestCase):
+    def test_remplacement(self):
+        import xml.dom.minidom
+        from ooffice import ReplaceTextFields, ReplaceFields
+        dom = xml.dom.minidom.parseString('<r xmlns:text="t" xmlns:table="t" xmlns:office="o"><text:p>&lt;prenom&gt; &lt;NOM&gt; &lt;total&gt; &lt;repas(2, "midi")&gt; &lt;inconnu&gt;</text:p><table:table-cell><text:p>&lt;heures&gt;</text:p></table:table-cell></r>')
+        fields = [("prenom", "Gertrude"), ("nom", "Gpl"), ("total", 12.5, FIELD_EUROS), ("heures", 7), ("repas", lambda jour, repas: "%d %s" % (jour, repas))]
+        cell = dom.getElementsByTagName("table:table-cell")[0]
+        self.assertTrue(ReplaceFields(cell, fields))
+        self.assertEquals((cell.getAttribute("office:value-type"), cell.getAttribute("office:value")), ("float", "7"))
+        self.assertEquals(cell.firstChild.firstChild.wholeText, "7")
+        ReplaceTextFields(dom, fields)
+        self.assertEquals(dom.getElementsByTagName("text:p")[0].firstChild.wholeText, "Gertrude GPL 12.50 2 midi <inconnu>")
+
+class FormulesTests(unittest.TestCase):
+    def test_increment_formulas(self):
+        import xml.dom.minidom
+        from ooffice import IncrementFormulas, FLAG_SUM_MAX
+        dom = xml.dom.minidom.parseString('<r xmlns:table="t"><table:table-cell table:formula="of:=SUM([.A1:.A10])+[.B1]"/></r>')
+        cell = dom.getElementsByTagName("table:table-cell")[0]
+        IncrementFormulas(cell.parentNode, row=2, column=1)
+        self.assertEquals(cell.getAttribute("table:formula"), "of:=SUM([.B3:.B12])+[.C3]")
+        IncrementFormulas(cell.parentNode, row=5, flags=FLAG_SUM_MAX)
+        self.assertEquals(cell.getAttribute("table:formula"), "of:=SUM([.B3:.B17])+[.C3]")
+
 class PAJETests(GertrudeTestCase):
     def test_pas_de_taux_horaire(self):
         creche.mode_facturation = FACTURATION_PAJE
@@ -170,6 +744,73 @@ class PAJETests(GertrudeTestCase):
         facture = Facture(inscrit, 2010, 9, NO_ADDRESS|NO_PARENTS)
         self.assertEquals(float("%.2f" % facture.total), 1001.95)
         
+    def test_cache_factures(self):
+        creche.mode_facturation = FACTURATION_PAJE
+        creche.repartition = REPARTITION_MENSUALISATION_CONTRAT_DEBUT_FIN_INCLUS
+        creche.formule_taux_horaire = [["", 6.70]]
+        creche.UpdateFormuleTauxHoraire(changed=False)
+        bureau = Bureau(creation=False)
+        bureau.debut = datetime.date(2010, 1, 1)
+        creche.bureaux.append(bureau)
+        inscrit = self.AddInscrit()
+        inscription = Inscription(inscrit, creation=False)
+        inscription.debut, inscription.fin = datetime.date(2010, 9, 6), datetime.date(2011, 7, 27)
+        for i in range(5):
+            inscription.reference[i].AddActivity(96, 180, 0, -1)
+        inscrit.inscriptions.append(inscription)
+        septembre, octobre, novembre = Facture(inscrit, 2010, 9), Facture(inscrit, 2010, 10), Facture(inscrit, 2010, 11)
+        self.assertTrue(Facture(inscrit, 2010, 9) is septembre)
+        inscrit.journees[datetime.date(2010, 9, 7)] = journee = Journee(inscrit, datetime.date(2010, 9, 7))
+        journee.SetActivity(96, 204, 0)
+        self.assertFalse(Facture(inscrit, 2010, 9) is septembre)
+        self.assertFalse(Facture(inscrit, 2010, 10) is octobre)
+        self.assertTrue(Facture(inscrit, 2010, 11) is novembre)
+        self.assertEquals(float("%.2f" % Facture(inscrit, 2010, 9).total), float("%.2f" % (septembre.total + 2 * 6.70)))
+        inscription.semaines_conges = 5
+        self.assertFalse(Facture(inscrit, 2010, 11) is novembre)
+
+    def test_calcule_factures(self):
+        import facture
+        creche.mode_facturation = FACTURATION_PAJE
+        creche.repartition = REPARTITION_MENSUALISATION_CONTRAT_DEBUT_FIN_INCLUS
+        creche.formule_taux_horaire = [["", 6.70]]
+        creche.UpdateFormuleTauxHoraire(changed=False)
+        bureau = Bureau(creation=False)
+        bureau.debut = datetime.date(2010, 1, 1)
+        creche.bureaux.append(bureau)
+        for i in range(4):
+            inscrit = self.AddInscrit()
+            inscription = Inscription(inscrit, creation=False)
+            inscription.debut, inscription.fin = datetime.date(2010, 9, 6), datetime.date(2011, 7, 27)
+            for j in range(1+i):
+                inscription.reference[j].AddActivity(96, 180, 0, -1)
+            inscrit.inscriptions.append(inscription)
+        inscrit.prenom = ""
+        factures_par_processus = facture.FACTURES_PAR_PROCESSUS
+        try:
+            for facture.FACTURES_PAR_PROCESSUS in (factures_par_processus, 1):
+                resultats = facture.CalculeFactures(creche.inscrits, 2010, 10)
+                self.assertEquals(len(resultats), 4)
+                for inscrit, resultat in zip(creche.inscrits[:3], resultats):
+                    self.assertTrue(resultat.inscrit is inscrit)
+                    self.assertEquals(resultat.errors, [])
+                    self.assertEquals(resultat.total, Facture(inscrit, 2010, 10).total)
+                    self.assertEquals(resultat.jours_presence_selon_contrat, Facture(inscrit, 2010, 10).jours_presence_selon_contrat)
+                self.assertNotEquals(resultats[3].errors, [])
+            # hors du thread principal (generation des documents), pas de fork
+            import threading
+            pool, facture.multiprocessing.Pool = facture.multiprocessing.Pool, None
+            try:
+                resultats = []
+                thread = threading.Thread(target=lambda: resultats.extend(facture.CalculeFactures(creche.inscrits, 2010, 10)))
+                thread.start()
+                thread.join()
+                self.assertEquals([resultat.total for resultat in resultats[:3]], [Facture(inscrit, 2010, 10).total for inscrit in creche.inscrits[:3]])
+            finally:
+                facture.multiprocessing.Pool = pool
+        finally:
+            facture.FACTURES_PAR_PROCESSUS = factures_par_processus
+
     def test_microcosmos(self):
         creche.mode_facturation = FACTURATION_PAJE
         creche.repartition = REPARTITION_MENSUALISATION_12MOIS
@@ -230,6 +871,37 @@ class PAJETests(GertrudeTestCase):
         facture = Facture(inscrit, 2014, 11, NO_ADDRESS|NO_PARENTS)
         self.assertEquals(float("%.2f" % facture.total), 1054.69)
 
+    def test_tarif_par_tranches(self):
+        creche.mode_facturation = FACTURATION_PAJE
+        bureau = Bureau(creation=False)
+        bureau.debut = datetime.date(2010, 1, 1)
+        creche.bureaux.append(bureau)
+        inscrit = self.AddInscrit()
+        inscription = Inscription(inscrit, creation=False)
+        inscription.debut, inscription.fin = datetime.date(2010, 9, 6), datetime.date(2011, 7, 27)
+        for i in range(5):
+            inscription.reference[i].AddActivity(96, 180, 0, -1)
+        inscrit.inscriptions.append(inscription)
+        formules = [[["heure_mois < 100", 6.70], ["", 8.0]],
+                    [["heure_mois <= 50.5", 5.0], ["mode=hg et heure_mois > 120", 9.5], ["heure_mois >= heures_mois", 10.0], ["", 7.0]],
+                    [["heure_mois = 12", 4.0], ["30 < heure_mois <= 31", 3.0], ["", 6.0]],
+                    [["heure_mois * 2 > 100", 6.70], ["", 8.0]]]
+        for repartition in (REPARTITION_MENSUALISATION_CONTRAT_DEBUT_FIN_INCLUS, REPARTITION_MENSUALISATION_12MOIS):
+            creche.repartition = repartition
+            for formule in formules:
+                creche.formule_taux_horaire = formule
+                creche.UpdateFormuleTauxHoraire(changed=False)
+                cotisation = Cotisation(inscrit, datetime.date(2010, 9, 6), NO_ADDRESS|NO_PARENTS)
+                reference = cotisation.CalculeFraisGardeHeureParHeure(cotisation.heures_periode, cotisation.heures_mois)
+                self.assertAlmostEquals(cotisation.cotisation_periode, reference[0], 6)
+                self.assertEquals(cotisation.montants_heure_garde, reference[1])
+                for heures in (0, 0.5, 1, 12, 12.25, 30.5, 50.5, 99.9, 100, 100.1, 150, 250.75, cotisation.heures_mois):
+                    for heures_mois in (heures, cotisation.heures_mois):
+                        result, tarifs = cotisation.CalculeFraisGardeComplete(heures, heures_mois)
+                        reference = cotisation.CalculeFraisGardeHeureParHeure(heures, heures_mois)
+                        self.assertAlmostEquals(result, reference[0], 6)
+                        self.assertEquals(tarifs, reference[1])
+
 class MarmousetsTests(GertrudeTestCase):
     def test_1(self):
         creche.mode_facturation = FACTURATION_PSU